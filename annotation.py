@@ -1,12 +1,22 @@
 import sys
 import os
 import csv
+import hashlib
 import shutil
 import tempfile
 import datetime
+import threading
+import time
 
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
 from pathlib import Path
 
+import annotation_cache
+import tool_runner
+from config import ANNOTATION_CPU_BUDGET
+from scheduler import CpuScheduler
 from bakta import Bakta
 from rgi import Rgi
 
@@ -79,7 +89,7 @@ def create_fasta_file(seq, output_dir, comment="> sequence:\n", file_name="temp"
     return myfile_name
 
 def run_RGI(
-        input_file, output_dir, seq_description, include_loose=False, delete_rgi_files=False
+        input_file, output_dir, seq_description, include_loose=False, delete_rgi_files=False, threads=None
 ):
     """
     To run RGI and annotate AMRs in the sequence
@@ -90,6 +100,7 @@ def run_RGI(
         output_dir:  the path for the output directory
         seq_description: a small description of the sequence used for naming
         include_loose: Whether to include loose annotations
+        threads: the number of threads RGI may use
     Return:
         the list of extracted annotation information for the sequence
     """
@@ -110,6 +121,7 @@ def run_RGI(
         input_sequence=Path(input_file),
         output_file=Path(output_file_name),
         include_loose=include_loose,
+        threads=threads,
     )
 
     # delete temp files
@@ -120,6 +132,167 @@ def run_RGI(
 
     return rgi.result.data
 
+# Separates the sequence name from the original ORF ID in a batched RGI input
+ORF_NAMESPACE_SEPARATOR = "__"
+
+def run_RGI_batch(
+        faa_files, output_dir, batch_description, include_loose=False, delete_rgi_files=False, threads=None
+):
+    """
+    To run RGI once over the proteins of many sequences, instead of once per sequence
+    # The proteins are concatenated with each ORF ID prefixed by its sequence's
+    # name, and every RGI row is routed back to that sequence with the prefix
+    # removed, so each sequence gets the rows run_RGI() would have returned.
+    Parameters:
+        faa_files: the file containing the proteins annotated by Bakta, by sequence name
+        output_dir:  the path for the output directory
+        batch_description: a small description of the batch used for naming
+        include_loose: Whether to include loose annotations
+        threads: the number of threads RGI may use
+    Return:
+        the list of extracted annotation information, by sequence name
+    """
+    rgi_dir = os.path.join(output_dir, "rgi_dir")
+    os.makedirs(rgi_dir, exist_ok=True)
+    input_file = os.path.join(rgi_dir, "rgi_input_" + batch_description + ".faa")
+    with open(input_file, "w") as batch_file:
+        for name, faa_file in faa_files.items():
+            with open(faa_file) as read_obj:
+                for line in read_obj:
+                    if line.startswith(">"):
+                        line = ">" + name + ORF_NAMESPACE_SEPARATOR + line[1:]
+                    batch_file.write(line)
+
+    output_file_name = os.path.join(
+        rgi_dir,
+        "rgi_output_"
+        + batch_description
+        + "_"
+        + datetime.datetime.now().strftime("%Y-%m-%d_%H-%M"),
+    )
+    rgi = Rgi.run_for_sarand(
+        input_sequence=Path(input_file),
+        output_file=Path(output_file_name),
+        include_loose=include_loose,
+        threads=threads,
+    )
+
+    out = {name: [] for name in faa_files}
+    for item in rgi.result.data:
+        name, _, orf_id = item["ORF_ID"].partition(ORF_NAMESPACE_SEPARATOR)
+        item["ORF_ID"] = orf_id
+        out[name].append(item)
+
+    if delete_rgi_files:
+        for path in (input_file, output_file_name + ".txt", output_file_name + ".json"):
+            if os.path.isfile(path):
+                os.remove(path)
+    return out
+
+def best_rgi_hits(RGI_output_list):
+    """
+    To index RGI findings by the locus tag of their ORF, keeping one per ORF
+    # When RGI reports several hits for an ORF, the one with the highest
+    # best_identities is kept, and the first reported of those on a tie.
+    Parameters:
+        RGI_output_list: the RGI findings of a sequence
+    Return:
+        the best RGI finding of each locus tag
+    """
+    hits = {}
+    for item in RGI_output_list:
+        locus_tag = item["ORF_ID"].split(" ", 1)[0]
+        best = hits.get(locus_tag)
+        if best is None or item["best_identities"] > best["best_identities"]:
+            hits[locus_tag] = item
+    return hits
+
+def incorporate_annotations(seq, seq_info, RGI_output_list):
+    """
+    To attach the sequence to its Bakta features and incorporate the RGI findings
+    Parameters:
+        seq: the annotated sequence
+        seq_info: the features found by Bakta, updated in place
+        RGI_output_list: the RGI hits of the sequence's proteins (or None)
+    """
+    # This re-appends the sequence as per the original implementation, however
+    # this could be extracted from the JSON
+    for seq_info_new_item in seq_info:
+        seq_info_new_item['seq_value'] = seq[:-1]
+
+    # incorporate RGI findings into Prokka's, joining on the locus tag
+    if RGI_output_list:
+        hits = best_rgi_hits(RGI_output_list)
+        for gene_info in seq_info:
+            item = hits.get(gene_info["locus_tag"])
+            if item is not None:
+                gene_info["gene"] = item["gene"]
+                gene_info["RGI_prediction_type"] = item["prediction_type"]
+                gene_info["family"] = item["family"]
+
+def annotation_cache_key(cache, seq, no_RGI=False, RGI_include_loose=False):
+    """
+    To find the address of a sequence's annotation in the annotation cache
+    Parameters:
+        cache: the annotation cache
+        seq: the sequence to be annotated
+        no_RGI: if True, RGI is not used to annotate AMRs
+        RGI_include_loose: Whether to include loose annotations
+    Return:
+        the cache key of the sequence under the current options and tool versions
+    """
+    # Placeholder paths: only the options that change the annotation are used
+    bakta_options = Bakta.params_for_sarand(Path(), "", Path(), locus_tag=locus_tag_prefix(seq)).options()
+    rgi_options = None
+    versions = {"bakta": Bakta.version()}
+    if not no_RGI:
+        rgi_options = Rgi.params_for_sarand(Path(), Path(), RGI_include_loose).options()
+        versions["rgi"] = Rgi.version()
+    return cache.key(seq, bakta_options, rgi_options, versions)
+
+def locus_tag_prefix(seq):
+    """
+    The locus tag prefix of a sequence's features, derived from the sequence
+        so that it is the same whether the sequence is annotated alone or in a batch
+    """
+    return "S" + hashlib.sha1(seq.strip().encode()).hexdigest()[:8].upper()
+
+def renumber_loci(by_contig, prefixes):
+    """
+    To give the features of a batched Bakta run the locus tags Bakta gives
+        each sequence when annotating it alone
+    # Bakta numbers the loci of a genome in one series, in steps of the
+    # number of its first locus, so each contig's loci are numbered afresh
+    # from that step under the prefix of its sequence.
+    Parameters:
+        by_contig: the features of each contig, updated in place
+        prefixes: the locus tag prefix of each contig
+    Return:
+        the new locus tag of each old one
+    """
+    renamed = {}
+    step = None
+    for contig, seq_info in by_contig.items():
+        number = 0
+        for gene_info in seq_info:
+            locus_tag = gene_info["locus_tag"]
+            if not locus_tag:
+                continue
+            digits = locus_tag.rpartition("_")[2]
+            if step is None:
+                step = int(digits)
+            number += step
+            gene_info["locus_tag"] = prefixes[contig] + "_" + str(number).zfill(len(digits))
+            renamed[locus_tag] = gene_info["locus_tag"]
+    return renamed
+
+def add_timing(timings, stage, started):
+    """
+    To add the seconds since `started` to a stage's timing, if timings are kept
+    """
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + time.monotonic() - started
+
 def annotate_sequence(
         seq,
         seq_description,
@@ -127,6 +300,9 @@ def annotate_sequence(
         no_RGI=False,
         RGI_include_loose=False,
         delete_prokka_dir=False,
+        cache=None,
+        threads=None,
+        timings=None,
 ):
     """
     To run Prokka/BAKTA for a sequence and extract required information from its
@@ -136,66 +312,83 @@ def annotate_sequence(
         seq_description: a small description of the sequence used for naming
         output_dir:  the path for the output directory
         no_RGI:	RGI annotations incorporated for AMR annotation
+        cache: the annotation cache to reuse results from, by default the one
+            configured with ANNOTATION_CACHE_DIR (if any)
+        threads: the number of threads Bakta and RGI may use (default = every CPU)
+        timings: if given, the seconds each tool ran for are added to it by
+            stage ("bakta", "rgi")
     Return:
         the list of extracted annotation information for the sequence
     """
-    # write the sequence into a temporary file
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        seq_file_name = create_fasta_file(
-            seq,
-            tmp_dir,
-            file_name="temp_"
-                      + datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-                      + seq_description,
-        )
-        pid = os.getpid()
-        prokka_dir = (
-                "bakta_dir_"
-                + seq_description
-                + "_"
-                + str(pid)
-                + "_"
-                + datetime.datetime.now().strftime("%Y-%m-%d_%H-%M")
-        )
-        prefix_name = "neighbourhood_" + seq_description
+    if cache is None:
+        cache = annotation_cache.default_cache()
+    cache_key = None
+    cached = None
+    if cache is not None:
+        cache_key = annotation_cache_key(cache, seq, no_RGI, RGI_include_loose)
+        cached = cache.get(cache_key)
 
-        # Run Bakta
-        ba = Bakta.run_for_sarand(
-            genome=Path(seq_file_name),
-            prefix=prefix_name,
-            out_dir=Path(output_dir) / prokka_dir,
-        )
+    prokka_dir = None
+    if cached is not None:
+        # A cache hit skips both Bakta and RGI
+        seq_info = cached["bakta"]
+        RGI_output_list = cached["rgi"]
+    else:
+        # write the sequence into a temporary file
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            seq_file_name = create_fasta_file(
+                seq,
+                tmp_dir,
+                file_name="temp_"
+                          + datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+                          + seq_description,
+            )
+            pid = os.getpid()
+            prokka_dir = (
+                    "bakta_dir_"
+                    + seq_description
+                    + "_"
+                    + str(pid)
+                    + "_"
+                    + datetime.datetime.now().strftime("%Y-%m-%d_%H-%M")
+            )
+            prefix_name = "neighbourhood_" + seq_description
 
-    # This re-appends the sequence as per the original implementation, however
-    # this could be extracted from the JSON
-    seq_info = ba.result.get_for_sarand()
-    for seq_info_new_item in seq_info:
-        seq_info_new_item['seq_value'] = seq[:-1]
+            # Run Bakta
+            started = time.monotonic()
+            ba = Bakta.run_for_sarand(
+                genome=Path(seq_file_name),
+                prefix=prefix_name,
+                out_dir=Path(output_dir) / prokka_dir,
+                threads=threads,
+                locus_tag=locus_tag_prefix(seq),
+            )
+            add_timing(timings, "bakta", started)
 
-    RGI_output_list = None
-    if not no_RGI:
-        RGI_output_list = run_RGI(
-            str(ba.params.path_faa.absolute()),
-            output_dir,
-            seq_description,
-            RGI_include_loose,
-            delete_prokka_dir,
-        )
+        seq_info = ba.result.get_for_sarand()
 
-    # incorporate RGI findings into Prokka's
-    if RGI_output_list:
-        for item in RGI_output_list:
-            for gene_info in seq_info:
-                if item["ORF_ID"].split(" ")[0] == gene_info["locus_tag"]:
-                    gene_info["gene"] = item["gene"]
-                    gene_info["RGI_prediction_type"] = item["prediction_type"]
-                    gene_info["family"] = item["family"]
-                    break
+        RGI_output_list = None
+        if not no_RGI:
+            started = time.monotonic()
+            RGI_output_list = run_RGI(
+                str(ba.params.path_faa.absolute()),
+                output_dir,
+                seq_description,
+                RGI_include_loose,
+                delete_prokka_dir,
+                threads,
+            )
+            add_timing(timings, "rgi", started)
+
+        if cache is not None:
+            cache.put(cache_key, {"bakta": seq_info, "rgi": RGI_output_list})
+
+    incorporate_annotations(seq, seq_info, RGI_output_list)
 
     # remove temporary files and folder
     # if os.path.isfile(seq_file_name):
     #     os.remove(seq_file_name)
-    if delete_prokka_dir:
+    if delete_prokka_dir and prokka_dir is not None:
         try:
             shutil.rmtree(prokka_dir)
         except OSError as e:
@@ -203,6 +396,160 @@ def annotate_sequence(
 
     return seq_info
 
+def split_faa(faa_file, output_dir, groups, renamed=None):
+    """
+    To split the proteins of a batched Bakta run into one file per sequence
+    Parameters:
+        faa_file: the proteins annotated by Bakta
+        output_dir: the directory to write the split files into
+        groups: the name of the file (sequence) each locus tag belongs to
+        renamed: the locus tag to write in place of each old one, if any
+    Return:
+        the address of each file written, by name
+    """
+    files = {}
+    out = None
+    with open(faa_file) as read_obj:
+        for line in read_obj:
+            if line.startswith(">"):
+                locus_tag, _, rest = line[1:].partition(" ")
+                locus_tag = locus_tag.strip()
+                name = groups.get(locus_tag)
+                if name is None:
+                    out = None
+                    continue
+                if renamed and locus_tag in renamed:
+                    line = ">" + renamed[locus_tag] + (" " + rest if rest else "\n")
+                if name not in files:
+                    files[name] = open(os.path.join(output_dir, name + ".faa"), "w")
+                out = files[name]
+            if out is not None:
+                out.write(line)
+    for f in files.values():
+        f.close()
+    return {name: f.name for name, f in files.items()}
+
+def annotate_sequences(
+        seq_pairs,
+        output_dir,
+        no_RGI=False,
+        RGI_include_loose=False,
+        delete_prokka_dir=False,
+        cache=None,
+        rgi_threads=None,
+        threads=None,
+        timings=None,
+):
+    """
+    To annotate a batch of sequences with a single Bakta run over a multi-FASTA
+        and a single RGI run over all their proteins, instead of paying each
+        tool's startup and database loading per sequence
+    # Each record is named after its sequence ("extracted<counter>") and the
+    # contig headers are kept, so Bakta's features are split back by contig.
+    # Gene prediction is per contig in metagenome mode, and the loci are
+    # renumbered per contig under each sequence's prefix, so the features
+    # match annotate_sequence()'s.
+    Parameters:
+        seq_pairs: the (counter, sequence) pairs to be annotated
+        output_dir:  the path for the output directory
+        no_RGI:	RGI annotations incorporated for AMR annotation
+        RGI_include_loose: Whether to include loose annotations
+        cache: the annotation cache to reuse results from, by default the one
+            configured with ANNOTATION_CACHE_DIR (if any)
+        rgi_threads: the number of threads the batch's RGI run may use (default = threads)
+        threads: the number of threads the batch's Bakta and RGI runs may use
+        timings: if given, the seconds each tool ran for are added to it by
+            stage ("bakta", "rgi")
+    Return:
+        the list of extracted annotation information for each sequence, in order
+    """
+    if cache is None:
+        cache = annotation_cache.default_cache()
+    results = {}
+    cache_keys = {}
+    todo = []
+    for counter, seq in seq_pairs:
+        if cache is not None:
+            cache_keys[counter] = annotation_cache_key(cache, seq, no_RGI, RGI_include_loose)
+            cached = cache.get(cache_keys[counter])
+            if cached is not None:
+                results[counter] = (cached["bakta"], cached["rgi"])
+                continue
+        todo.append((counter, seq))
+
+    prokka_dir = None
+    if todo:
+        batch_description = "batch" + str(todo[0][0]) + "-" + str(todo[-1][0])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            batch_file_name = os.path.join(tmp_dir, "temp_" + batch_description + ".fasta")
+            with open(batch_file_name, "w") as batch_file:
+                for counter, seq in todo:
+                    batch_file.write(">extracted" + str(counter) + "\n" + seq.strip() + "\n")
+            prokka_dir = (
+                    "bakta_dir_"
+                    + batch_description
+                    + "_"
+                    + str(os.getpid())
+                    + "_"
+                    + datetime.datetime.now().strftime("%Y-%m-%d_%H-%M")
+            )
+            started = time.monotonic()
+            ba = Bakta.run_batch_for_sarand(
+                genome=Path(batch_file_name),
+                prefix="neighbourhood_" + batch_description,
+                out_dir=Path(output_dir) / prokka_dir,
+                threads=threads,
+            )
+            add_timing(timings, "bakta", started)
+        by_contig = ba.result.get_for_sarand_by_contig()
+        groups = {
+            gene_info["locus_tag"]: contig
+            for contig, seq_info in by_contig.items() for gene_info in seq_info
+        }
+        renamed = renumber_loci(
+            by_contig, {"extracted" + str(counter): locus_tag_prefix(seq) for counter, seq in todo}
+        )
+
+        faa_files = {}
+        if not no_RGI:
+            faa_files = split_faa(ba.params.path_faa, str(ba.params.output), groups, renamed)
+
+        # A single RGI run covers the proteins of the whole batch
+        rgi_outputs = {}
+        if faa_files:
+            started = time.monotonic()
+            rgi_outputs = run_RGI_batch(
+                faa_files,
+                output_dir,
+                batch_description,
+                RGI_include_loose,
+                delete_prokka_dir,
+                rgi_threads or threads,
+            )
+            add_timing(timings, "rgi", started)
+
+        for counter, seq in todo:
+            seq_description = "extracted" + str(counter)
+            seq_info = by_contig.get(seq_description, [])
+            # As run_RGI() returns for a sequence without hits, or without proteins
+            RGI_output_list = None if no_RGI else rgi_outputs.get(seq_description, [])
+            if cache is not None:
+                cache.put(cache_keys[counter], {"bakta": seq_info, "rgi": RGI_output_list})
+            results[counter] = (seq_info, RGI_output_list)
+
+    out = []
+    for counter, seq in seq_pairs:
+        seq_info, RGI_output_list = results[counter]
+        incorporate_annotations(seq, seq_info, RGI_output_list)
+        out.append(seq_info)
+
+    if delete_prokka_dir and prokka_dir is not None:
+        try:
+            shutil.rmtree(prokka_dir)
+        except OSError as e:
+            print("Error: %s - %s." % (e.filename, e.strerror))
+    return out
+
 def extract_seq_annotation(annotate_dir, no_RGI, RGI_include_loose, seq_pair):
     """
     The function used in parallel anntation to call the function for annotating a sequence
@@ -226,70 +573,310 @@ def extract_seq_annotation(annotate_dir, no_RGI, RGI_include_loose, seq_pair):
     return seq_info_list
 
 
-def extract_graph_seqs_annotation(
+def extract_batch_annotation(annotate_dir, no_RGI, RGI_include_loose, rgi_threads, seq_pairs):
+    """
+    The function used in parallel annotation to annotate a batch of sequences
+        with one Bakta run
+    Parameters:
+        annotate_dir: the directory to store annotation output
+        no_RGI: if True we want to call RGI for annotating AMRs
+        RGI_include_loose: if True loose mode is used
+        rgi_threads: the number of threads each batch's RGI run may use
+        seq_pairs: the indexes and the values of the sequences to be annotated
+    Return:
+        the list of annotated genes of each sequence
+    """
+    return annotate_sequences(
+        seq_pairs, annotate_dir, no_RGI, RGI_include_loose, rgi_threads=rgi_threads
+    )
+
+
+def read_graph_seqs(neighborhood_seq_file):
+    """
+    To read the sequences extracted from the graph lazily, one line at a time
+    Parameters:
+        neighborhood_seq_file: the file containing extracted sequences, one per line
+    Return:
+        a generator of the index (from 1) and the value of each sequence
+    """
+    with open(neighborhood_seq_file, "r") as read_obj:
+        for counter, line in enumerate(read_obj, start=1):
+            yield counter, line
+
+
+def annotate_graph_seqs_unit(
+        annotate_dir, no_RGI, RGI_include_loose, rgi_threads, batched, task
+):
+    """
+    The function used in streaming annotation to annotate a unit of work: a
+        sequence with its own Bakta and RGI runs, or a batch of sequences sharing them
+    Parameters:
+        annotate_dir: the directory to store annotation output
+        no_RGI: if True RGI is not used for AMR annotation
+        RGI_include_loose: if True loose mode is used
+        rgi_threads: the number of threads each batch's RGI run may use
+            (default = the threads granted to the unit)
+        batched: if True the unit is annotated with annotate_sequences
+        task: the position of the unit in the file, its list of (index, value)
+            of sequences and the number of threads granted to it
+    Return:
+        the position of the unit, the (index, list of annotated genes) of its
+            sequences and the seconds each tool ran for
+    """
+    position, seq_pairs, threads = task
+    timings = {}
+    if batched:
+        seq_info_list = annotate_sequences(
+            seq_pairs,
+            annotate_dir,
+            no_RGI,
+            RGI_include_loose,
+            rgi_threads=rgi_threads,
+            threads=threads,
+            timings=timings,
+        )
+    else:
+        seq_info_list = [
+            annotate_sequence(
+                seq,
+                "extracted" + str(counter),
+                annotate_dir,
+                no_RGI,
+                RGI_include_loose,
+                threads=threads,
+                timings=timings,
+            )
+            for counter, seq in seq_pairs
+        ]
+    return position, [
+        (counter, seq_info) for (counter, _), seq_info in zip(seq_pairs, seq_info_list)
+    ], timings
+
+
+# Marks the end of an iterator in with_following()
+_END = object()
+
+
+def unit_bases(seq_pairs):
+    """
+    The number of bases in a unit of sequences
+    """
+    return sum(len(seq.strip()) for _, seq in seq_pairs)
+
+
+def with_following(items):
+    """
+    Each item of an iterable with 1 if another item follows it, else 0, for
+    the scheduler's pending jobs
+    """
+    items = iter(items)
+    current = next(items, _END)
+    while current is not _END:
+        following = next(items, _END)
+        yield current, int(following is not _END)
+        current = following
+
+
+def iter_graph_seqs_annotation(
         neighborhood_seq_file,
         annotate_dir,
         core_num,
         no_RGI,
         RGI_include_loose,
-        annotation_writer,
+        batch_size=1,
+        rgi_threads=None,
+        window=None,
+        ordered=True,
+        scheduler=None,
 ):
     """
-    To annotate neighborhood sequences of AMR extracted from the graph in parallel
+    To annotate neighborhood sequences of AMR extracted from the graph in parallel,
+        as a stream: the file is read lazily, at most `window` units (sequences,
+        or batches of batch_size sequences) are read but not yet yielded, and the
+        genes of each sequence are yielded as soon as its unit is annotated.
+        Each unit is started once the scheduler grants it threads, which are
+        passed to its Bakta and RGI runs, and its timings are fed back to the
+        scheduler
     Parameters:
         neighborhood_seq_file: the file containing extracted sequences
         annotate_dir: the directory to sore annotation results
-        core_num: the number of core for parallel processing
+        core_num: the number of CPUs for parallel processing, split between the
+            units annotated at once and their threads when no scheduler is given
         no_RGI: if True RGI is not used for AMR annotation
         RGI_include_loose: if True use loose mode in RGI
-        annotation_writer: the file to store annotation results
+        batch_size: the number of sequences annotated by each Bakta and RGI run
+        rgi_threads: the number of threads each batch's RGI run may use
+        window: the number of units in flight, by default twice the number of jobs
+        ordered: if True sequences are yielded in the order of the file,
+            otherwise in the order their annotation completes
+        scheduler: the CpuScheduler splitting the CPUs between the units, by
+            default one over core_num CPUs (at most ANNOTATION_CPU_BUDGET)
     Return:
-        the list of annotated genes and their details
+        a generator of the index and the list of annotated genes of each sequence
     """
-    # find the list of all extracted sequences
     print("Reading seq file")
-    sequence_list = []
-    counter = 1
-    with open(neighborhood_seq_file, "r") as read_obj:
-        for line in read_obj:
-            sequence_list.append((counter, line))
-            counter += 1
+    if scheduler is None:
+        scheduler = CpuScheduler(budget=min(core_num, ANNOTATION_CPU_BUDGET))
+    seq_pairs = read_graph_seqs(neighborhood_seq_file)
+    batch_size = max(1, batch_size)
+    units = enumerate(iter(lambda: list(islice(seq_pairs, batch_size)), []))
+    p_annotation = partial(
+        annotate_graph_seqs_unit,
+        annotate_dir, no_RGI, RGI_include_loose, rgi_threads, batch_size > 1,
+    )
+
+    def finished(seq_pairs, threads, timings):
+        scheduler.release(threads)
+        for stage, seconds in timings.items():
+            scheduler.record(stage, unit_bases(seq_pairs), threads, seconds)
 
-    # Parallel annotation
     """
     AM: Do not initialise a multiprocessing pool if only one thread is required.
     """
-    if core_num == 1:
-        seq_info_list = list()
-        for x in sequence_list:
-            seq_info_list.append(extract_seq_annotation(annotate_dir, no_RGI, RGI_include_loose, x))
-    else:
-        p_annotation = partial(
-            extract_seq_annotation, annotate_dir, no_RGI, RGI_include_loose
-        )
-        with Pool(core_num) as p:
-            seq_info_list = p.map(p_annotation, sequence_list)
+    if scheduler.max_jobs == 1:
+        for position, unit in units:
+            threads = scheduler.acquire(unit_bases(unit))
+            try:
+                _, seq_infos, timings = p_annotation((position, unit, threads))
+            except BaseException:
+                scheduler.release(threads)
+                raise
+            finished(unit, threads, timings)
+            yield from seq_infos
+        return
 
-    # Further processing of result of parallel annotation
-    for i, seq_info in enumerate(seq_info_list):
+    # The pool reads its tasks from feed() in a thread of its own, which blocks
+    # once `window` units are waiting to be yielded or until the scheduler
+    # grants the next unit its threads
+    slots = threading.Semaphore(max(1, window or 2 * scheduler.max_jobs))
+    stopped = threading.Event()
+    granted = {}
+    granted_lock = threading.Lock()
+
+    def feed():
+        # The next unit is read ahead, so a unit with others behind it
+        # leaves them their share of the CPUs
+        for (position, unit), pending in with_following(units):
+            slots.acquire()
+            threads = 0 if stopped.is_set() else scheduler.acquire(unit_bases(unit), pending)
+            with granted_lock:
+                if stopped.is_set() or not threads:
+                    if threads:
+                        scheduler.release(threads)
+                    return
+                granted[position] = (unit, threads)
+            yield position, unit, threads
+
+    def stop():
+        # Let feed() return if the caller stopped early or a unit failed, so
+        # the pool can shut down, and return the CPUs of the unfinished units
+        with granted_lock:
+            stopped.set()
+            for _, threads in granted.values():
+                scheduler.release(threads)
+            granted.clear()
+        slots.release()
+
+    completed = {}
+    next_position = 0
+    # Workers terminated by the pool, or interrupted, kill their tool runs
+    with Pool(scheduler.max_jobs, initializer=tool_runner.install_signal_handlers) as p:
+        try:
+            for position, seq_infos, timings in p.imap_unordered(p_annotation, feed()):
+                with granted_lock:
+                    unit, threads = granted.pop(position)
+                finished(unit, threads, timings)
+                if not ordered:
+                    slots.release()
+                    yield from seq_infos
+                    continue
+                completed[position] = seq_infos
+                while next_position in completed:
+                    slots.release()
+                    yield from completed.pop(next_position)
+                    next_position += 1
+        finally:
+            stop()
+
+
+def extract_graph_seqs_annotation(
+        neighborhood_seq_file,
+        annotate_dir,
+        core_num,
+        no_RGI,
+        RGI_include_loose,
+        annotation_writer,
+        batch_size=1,
+        rgi_threads=None,
+        window=None,
+        ordered=True,
+        scheduler=None,
+):
+    """
+    To annotate neighborhood sequences of AMR extracted from the graph in parallel,
+        writing the genes of each sequence as soon as it is annotated
+    Parameters:
+        neighborhood_seq_file: the file containing extracted sequences
+        annotate_dir: the directory to sore annotation results
+        core_num: the number of core for parallel processing
+        no_RGI: if True RGI is not used for AMR annotation
+        RGI_include_loose: if True use loose mode in RGI
+        annotation_writer: the file to store annotation results
+        batch_size: the number of sequences annotated by each Bakta and RGI run
+        rgi_threads: the number of threads each batch's RGI run may use
+        window: the number of units in flight, see iter_graph_seqs_annotation
+        ordered: if True sequences are written in the order of the file
+        scheduler: the CpuScheduler splitting the CPUs between the Bakta and RGI runs
+    Return:
+        the list of annotated genes and their details
+    """
+    seq_info_list = []
+    for _, seq_info in iter_graph_seqs_annotation(
+        neighborhood_seq_file,
+        annotate_dir,
+        core_num,
+        no_RGI,
+        RGI_include_loose,
+        batch_size,
+        rgi_threads,
+        window,
+        ordered,
+        scheduler,
+    ):
         # write annotation onfo into the files
-        for j, gene_info in enumerate(seq_info):
+        for gene_info in seq_info:
             write_info_in_annotation_file(
                 annotation_writer, gene_info, no_RGI
             )
+        seq_info_list.append(seq_info)
     return seq_info_list
 
-def neighborhood_annotation(
+def annotation_detail_file(output_dir, output_name=""):
+    """
+    The address of the file neighborhood annotation writes gene details to
+    """
+    return os.path.join(
+        output_dir, "annotation" + output_name, "annotation_detail" + output_name + ".csv"
+    )
+
+def iter_neighborhood_annotation(
         neighborhood_seq_file,
         output_dir,
         no_RGI=False,
         RGI_include_loose=False,
         output_name="",
         core_num=4,
+        batch_size=1,
+        rgi_threads=None,
+        window=None,
+        ordered=True,
+        scheduler=None,
 ):
     """
-    To annotate reference genomes sequences, and summarize the results
-        in a couple of formats
+    To annotate reference genomes sequences as a stream. The genes of each
+        sequence are written to annotation_detail_file(output_dir, output_name)
+        and flushed before they are yielded, so the file grows as the annotation
+        progresses and nothing is kept in memory once a sequence is yielded
     Parameters:
         neighborhood_seq_file:	the address of the file containing all extracted
              neighborhood sequences from assembly graph
@@ -297,9 +884,17 @@ def neighborhood_annotation(
         no_RGI:	RGI annotations not incorporated for AMR annotation
         RGI_include_loose: Whether to include loose annotaions in RGI
         output_name:the name used to distinguish different output files usually based on the name of AMR
+        core_num: the number of core for parallel processing
+        batch_size: the number of sequences annotated by each Bakta and RGI run
+            (1 runs both tools per sequence)
+        rgi_threads: the number of threads each batch's RGI run may use
+        window: the number of sequences or batches in flight, by default twice core_num
+        ordered: if True sequences are written and yielded in the order of the
+            file, otherwise in the order their annotation completes
+        scheduler: the CpuScheduler splitting the CPUs between the Bakta and RGI
+            runs, by default one over core_num CPUs (at most ANNOTATION_CPU_BUDGET)
     Return:
-        the address of files stroing annotation information (annotation_detail_name,
-            trimmed_annotation_info, gene_file_name, visual_annotation)
+        a generator of the index and the list of annotated genes of each sequence
     """
     # initializing required files and directories
     annotate_dir = os.path.join(
@@ -312,54 +907,119 @@ def neighborhood_annotation(
         except OSError as e:
             print("Error: %s - %s." % (e.filename, e.strerror))
     os.makedirs(annotate_dir)
-    annotation_detail_name = os.path.join(
-        annotate_dir, "annotation_detail" + output_name + ".csv"
-    )
-    annotation_detail = open(annotation_detail_name, mode="w", newline="")
-    annotation_writer = csv.writer(annotation_detail)
-    gene_info = {
-        "seq_value": "seq_value",
-        "gene": "gene",
-        "product": "product",
-        "length": "length",
-        "start_pos": "start_pos",
-        "end_pos": "end_pos",
-        "RGI_prediction_type": "RGI_prediction_type",
-        "family": "family",
-    }
-    write_info_in_annotation_file(
-        annotation_writer,
-        gene_info,
-        no_RGI,
-        "seq_length",
-    )
+    annotation_detail_name = annotation_detail_file(output_dir, output_name)
+    with open(annotation_detail_name, mode="w", newline="") as annotation_detail:
+        annotation_writer = csv.writer(annotation_detail)
+        gene_info = {
+            "seq_value": "seq_value",
+            "gene": "gene",
+            "product": "product",
+            "length": "length",
+            "start_pos": "start_pos",
+            "end_pos": "end_pos",
+            "RGI_prediction_type": "RGI_prediction_type",
+            "family": "family",
+        }
+        write_info_in_annotation_file(
+            annotation_writer,
+            gene_info,
+            no_RGI,
+            "seq_length",
+        )
 
-    # annotate the sequences extraced from assembly graph
-    all_seq_info_list = extract_graph_seqs_annotation(
-        neighborhood_seq_file,
-        annotate_dir,
-        core_num,
-        no_RGI,
-        RGI_include_loose,
-        annotation_writer,
-    )
+        if scheduler is None:
+            scheduler = CpuScheduler(budget=min(core_num, ANNOTATION_CPU_BUDGET))
+
+        # annotate the sequences extraced from assembly graph
+        for counter, seq_info in iter_graph_seqs_annotation(
+            neighborhood_seq_file,
+            annotate_dir,
+            core_num,
+            no_RGI,
+            RGI_include_loose,
+            batch_size,
+            rgi_threads,
+            window,
+            ordered,
+            scheduler,
+        ):
+            for gene_info in seq_info:
+                write_info_in_annotation_file(
+                    annotation_writer, gene_info, no_RGI
+                )
+            annotation_detail.flush()
+            yield counter, seq_info
     print(
         "The comparison of neighborhood sequences are available in "
         + annotation_detail_name
     )
-    annotation_detail.close()
-
-    return all_seq_info_list, annotation_detail_name
-
-n = ""
-with open(file="sequence.fasta", mode="r") as file:
-    n = file.read()
-
-seq_info = annotate_sequence(
-    seq = n,
-    seq_description="",
-    output_dir="output/"
-)
+    stats = scheduler.stats()
+    print(
+        "Annotation ran %d jobs on %d CPUs at %.0f%% utilisation"
+        % (stats["jobs"], stats["budget"], 100 * stats["utilisation"])
+    )
 
+def neighborhood_annotation(
+        neighborhood_seq_file,
+        output_dir,
+        no_RGI=False,
+        RGI_include_loose=False,
+        output_name="",
+        core_num=4,
+        batch_size=1,
+        rgi_threads=None,
+        window=None,
+        ordered=True,
+        scheduler=None,
+):
+    """
+    To annotate reference genomes sequences, and summarize the results
+        in a couple of formats. This collects iter_neighborhood_annotation(),
+        which should be used instead when the sequences are too many to hold
+        their annotation in memory
+    Parameters:
+        neighborhood_seq_file:	the address of the file containing all extracted
+             neighborhood sequences from assembly graph
+        output_dir:	the path for the output directory
+        no_RGI:	RGI annotations not incorporated for AMR annotation
+        RGI_include_loose: Whether to include loose annotaions in RGI
+        output_name:the name used to distinguish different output files usually based on the name of AMR
+        batch_size: the number of sequences annotated by each Bakta and RGI run
+            (1 runs both tools per sequence)
+        rgi_threads: the number of threads each batch's RGI run may use
+        window: the number of sequences or batches in flight, by default twice core_num
+        ordered: if False sequences are written and returned in the order their
+            annotation completes
+        scheduler: the CpuScheduler splitting the CPUs between the Bakta and RGI
+            runs, by default one over core_num CPUs (at most ANNOTATION_CPU_BUDGET)
+    Return:
+        the address of files stroing annotation information (annotation_detail_name,
+            trimmed_annotation_info, gene_file_name, visual_annotation)
+    """
+    all_seq_info_list = [
+        seq_info for _, seq_info in iter_neighborhood_annotation(
+            neighborhood_seq_file,
+            output_dir,
+            no_RGI,
+            RGI_include_loose,
+            output_name,
+            core_num,
+            batch_size,
+            rgi_threads,
+            window,
+            ordered,
+            scheduler,
+        )
+    ]
+    return all_seq_info_list, annotation_detail_file(output_dir, output_name)
 
+if __name__ == "__main__":
+    n = ""
+    with open(file="sequence.fasta", mode="r") as file:
+        n = file.read()
 
+    seq_info = annotate_sequence(
+        seq = n,
+        seq_description="",
+        output_dir="output/"
+    )
@@ -0,0 +1,239 @@
+import atexit
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+from config import ANNOTATION_CACHE_DIR, ANNOTATION_CACHE_MAX_BYTES
+
+"""
+Content-addressed on-disk cache of sequence annotations.
+
+An entry holds the parsed Bakta features (BaktaResult.get_for_sarand()) and
+RGI hits (RgiResult.data) of one sequence, stored as JSON under the SHA-256
+of the sequence, the Bakta/RGI options and the tool versions, so any change
+to those misses the cache. Entries are written to a temporary file and
+renamed into place, so concurrent pool workers never see a partial entry.
+Looking up an entry takes no lock. Each process counts its hits, misses and
+writes in memory and merges them into a stats file shared by every process
+using the cache at most every STATS_FLUSH_SECONDS, when it writes an entry
+and at exit, skipping the merge while another process holds the stats lock.
+The stats file is replaced atomically, so a crash never leaves it partly
+written. The least recently used entries are evicted once the total size
+passes max_bytes.
+"""
+
+STATS = ('hits', 'misses', 'writes', 'evictions', 'bytes')
+STATS_FLUSH_SECONDS = 1.0
+
+
+class AnnotationCache:
+    """
+    Annotations of sequences, on disk under `path`.
+    """
+    __slots__ = ('path', 'max_bytes', '_pending', '_flushed', '_pid')
+
+    def __init__(self, path: Path, max_bytes: int = ANNOTATION_CACHE_MAX_BYTES):
+        """
+        Args:
+            path: Directory of the cache, created if missing
+            max_bytes: Total size of the entries beyond which the least recently used are evicted
+        """
+        self.path: Path = Path(path)
+        self.max_bytes: int = max_bytes
+        self.path.mkdir(parents=True, exist_ok=True)
+        # This process's counts not yet merged into the stats file
+        self._pending: dict = dict.fromkeys(STATS, 0)
+        self._flushed: float = time.monotonic()
+        self._pid: int = os.getpid()
+
+    @staticmethod
+    def key(seq: str, bakta_options: dict, rgi_options: Optional[dict], versions: dict) -> str:
+        """
+        The address of a sequence's annotation. rgi_options is None when RGI is not run.
+        """
+        identity = json.dumps(
+            {"bakta": bakta_options, "rgi": rgi_options, "versions": versions},
+            sort_keys=True, default=str,
+        )
+        digest = hashlib.sha256()
+        digest.update(seq.strip().encode())
+        digest.update(b"\0")
+        digest.update(identity.encode())
+        return digest.hexdigest()
+
+    def _entry(self, key: str) -> Path:
+        return self.path / key[:2] / f"{key}.json"
+
+    def _read_stats(self) -> dict:
+        stats = dict.fromkeys(STATS, 0)
+        try:
+            with open(self.path / "stats.json") as f:
+                stats.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        return stats
+
+    def _write_stats(self, stats: dict):
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".tmp-stats-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(json.dumps(stats))
+            os.replace(tmp, self.path / "stats.json")
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    @contextmanager
+    def _stats_file(self, blocking: bool = True):
+        """
+        The shared stats under the stats lock, written back on exit, or None
+        if not blocking and another process holds the lock
+        """
+        with open(self.path / "stats.lock", "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield None
+                return
+            try:
+                stats = self._read_stats()
+                yield stats
+                self._write_stats(stats)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _count(self, **deltas):
+        if os.getpid() != self._pid:
+            # Forked from the process that counted these
+            self._pending = dict.fromkeys(STATS, 0)
+            self._pid = os.getpid()
+        for name, delta in deltas.items():
+            self._pending[name] += delta
+
+    def flush(self, blocking: bool = False) -> Optional[dict]:
+        """
+        To merge this process's counts into the stats file
+        Return:
+            the merged stats, or None if not blocking and the file was locked
+        """
+        if not any(self._pending.values()):
+            return self._read_stats()
+        with self._stats_file(blocking) as stats:
+            if stats is None:
+                return None
+            for name, delta in self._pending.items():
+                stats[name] += delta
+            self._pending = dict.fromkeys(STATS, 0)
+            self._flushed = time.monotonic()
+            return dict(stats)
+
+    def _maybe_flush(self):
+        if time.monotonic() - self._flushed >= STATS_FLUSH_SECONDS:
+            self.flush()
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        The cached annotation, or None
+        """
+        entry = self._entry(key)
+        try:
+            with entry.open() as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            self._count(misses=1)
+            self._maybe_flush()
+            return None
+        # The modification time orders entries for eviction
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        self._count(hits=1)
+        self._maybe_flush()
+        return value
+
+    def put(self, key: str, value: dict):
+        """
+        To store an annotation, atomically
+        """
+        entry = self._entry(key)
+        entry.parent.mkdir(exist_ok=True)
+        body = json.dumps(value, separators=(',', ':')).encode()
+        fd, tmp = tempfile.mkstemp(dir=entry.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(body)
+            replaced = entry.stat().st_size if entry.exists() else 0
+            os.replace(tmp, entry)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self._count(writes=1, bytes=len(body) - replaced)
+        # Only a process that could merge its counts knows the total size
+        stats = self.flush()
+        if stats is not None and stats['bytes'] > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        To remove the least recently used entries until the cache is within
+        90% of max_bytes
+        """
+        self.flush(blocking=True)
+        with self._stats_file() as stats:
+            entries = []
+            for entry in self.path.glob("*/*.json"):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry))
+            total = sum(size for _, size, _ in entries)
+            entries.sort()
+            for _, size, entry in entries:
+                if total <= self.max_bytes * 0.9:
+                    break
+                try:
+                    entry.unlink()
+                except OSError:
+                    continue
+                total -= size
+                stats['evictions'] += 1
+            stats['bytes'] = total
+
+    def stats(self) -> dict:
+        """
+        The shared stats, with the counts of this process not merged yet
+        """
+        stats = self._read_stats()
+        if os.getpid() == self._pid:
+            for name, delta in self._pending.items():
+                stats[name] += delta
+        return dict(stats, max_bytes=self.max_bytes)
+
+
+_default: Optional[AnnotationCache] = None
+
+
+def default_cache() -> Optional[AnnotationCache]:
+    """
+    The cache configured with ANNOTATION_CACHE_DIR, or None when it is not set
+    """
+    global _default
+    if _default is None and ANNOTATION_CACHE_DIR:
+        _default = AnnotationCache(Path(ANNOTATION_CACHE_DIR), ANNOTATION_CACHE_MAX_BYTES)
+        atexit.register(_flush_default)
+    return _default
+
+
+def _flush_default():
+    if _default is not None and os.getpid() == _default._pid:
+        _default.flush(blocking=True)
@@ -0,0 +1,80 @@
+import gzip
+import hashlib
+import json
+from typing import Iterable, List, Optional
+
+from flask import Response, request
+
+import cache
+from queries import json_default
+
+"""
+Helpers for the JSON API routes.
+
+Responses carry a weak ETag derived from the write versions of the tables
+they are read from, so a poller sending If-None-Match gets a 304 without the
+database being touched until one of those tables is written, by the app or,
+as data_version.sync() finds, by anyone else. The versions are the ones the
+database keeps, so any worker process can answer with the 304.
+"""
+
+# Bodies smaller than this are not worth compressing
+GZIP_MIN_SIZE = 1024
+
+
+def etag_for(route: str, params: tuple, tables: Iterable[str], columns: Optional[List[str]] = None) -> str:
+    """
+    The ETag of the response of `route` for `params`, projected onto `columns`,
+    while `tables` are not written
+    """
+    state = (route, params, tuple(columns or ()), cache.results.tag(tables))
+    return hashlib.sha1(repr(state).encode()).hexdigest()
+
+
+def not_modified(etag: str) -> Optional[Response]:
+    """
+    A 304 response if the client already holds `etag`, otherwise None
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+    return None
+
+
+def projected_columns(available: List[str]) -> List[str]:
+    """
+    The columns requested with ?columns=a,b, defaulting to all of them.
+    Raise ValueError on an unknown column.
+    """
+    requested = request.args.get('columns')
+    if not requested:
+        return list(available)
+    columns = [column.strip() for column in requested.split(',') if column.strip()]
+    unknown = [column for column in columns if column not in available]
+    if unknown:
+        raise ValueError(f"Unknown columns: {', '.join(unknown)}")
+    return columns
+
+
+def rows_as_dicts(rows, columns: List[str], available: Optional[List[str]] = None) -> List[dict]:
+    """
+    Project rows onto `columns`. Rows are dicts, or tuples in the order of
+    `available`.
+    """
+    if available is not None:
+        index = [available.index(column) for column in columns]
+        return [{column: row[i] for column, i in zip(columns, index)} for row in rows]
+    return [{column: row[column] for column in columns} for row in rows]
+
+
+def json_response(payload, etag: Optional[str] = None) -> Response:
+    body = json.dumps(payload, default=json_default, separators=(',', ':')).encode()
+    response = Response(body, mimetype='application/json')
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    response.vary.add('Accept-Encoding')
+    if len(body) >= GZIP_MIN_SIZE and 'gzip' in request.accept_encodings:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
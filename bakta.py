@@ -1,11 +1,16 @@
+import asyncio
 import os
 import json
 import re
-import subprocess
+import sys
+from array import array
 from pathlib import Path
-from typing import Optional, List
+from typing import Dict, Iterable, Iterator, Optional, List
 
-from config import CONDA_BAKTA_NAME, CONDA_EXE_NAME, CONDA_BAKTA_DB
+import tool_resolver
+import tool_runner
+from tool_resolver import PROGRAM_VERSION_NA
+from config import BAKTA_TIMEOUT, CONDA_BAKTA_NAME, CONDA_BAKTA_DB, TOOL_VERSION_TIMEOUT
 #from sarand.util.logger import LOG
 
 
@@ -172,6 +177,28 @@ class BaktaParams:
         else:
             return self.output / f"{self.genome.stem}.faa"
 
+    def path_log(self, stream: str) -> Path:
+        """
+        The file Bakta's stdout or stderr is written to. It is kept beside the
+        output directory, which Bakta creates itself.
+        """
+        if self.output:
+            return self.output.parent / f"{self.output.name}.{stream}.log"
+        return Path(f"{self.prefix or self.genome.stem}.{stream}.log")
+
+    # Options that only say where the inputs and outputs are or how fast to
+    # run, and so do not change the annotation
+    RUN_OPTIONS = ('genome', 'prefix', 'output', 'threads', 'tmp_dir', 'verbose', 'debug')
+
+    def options(self) -> dict:
+        """
+        The options that determine the annotation, e.g. for cache keys
+        """
+        return {
+            name: str(getattr(self, name)) if isinstance(getattr(self, name), Path) else getattr(self, name)
+            for name in self.__slots__ if name not in self.RUN_OPTIONS
+        }
+
     def as_cmd(self) -> List[str]:
         cmd: List[str] = ['bakta']
 
@@ -254,106 +281,313 @@ class BaktaParams:
         return cmd
 
 
+# The size of the reads of a Bakta JSON, grown while a value does not fit
+JSON_CHUNK_SIZE = 1 << 20
+# What may follow the part of a number decoded so far, if it goes on
+_NUMBER_TAIL = re.compile(r'[\d.eE+-]*')
+
+
+class _JsonStream:
+    """
+    A JSON document read in chunks, decoding one value at a time.
+    """
+    __slots__ = ('file', 'buf', 'pos', 'eof', 'decoder')
+
+    def __init__(self, file):
+        self.file = file
+        self.buf: str = ''
+        self.pos: int = 0
+        self.eof: bool = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self, size: int = JSON_CHUNK_SIZE):
+        chunk = self.file.read(size)
+        self.eof = not chunk
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self) -> str:
+        while True:
+            self.pos = json.decoder.WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self.fill()
+
+    def take(self, expected: str) -> str:
+        char = self.peek()
+        if char not in expected:
+            raise ValueError(f"Malformed Bakta JSON: expected {expected!r}, got {char!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        size = JSON_CHUNK_SIZE
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number running to the end of the buffer, e.g. 12 of 123 or
+                # -1 of -1.5 cut after the dot, may go on in the next chunk
+                whole = self.buf[end - 1] in '"]}' or _NUMBER_TAIL.match(self.buf, end).end() < len(self.buf)
+                if whole or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Grow the reads, so that a large value is decoded a bounded number of times
+            self.fill(size)
+            size *= 2
+
+
+def iter_features(path: Path) -> Iterator[dict]:
+    """
+    The features of a Bakta JSON, decoded one at a time. Reading stops at
+    the end of the features, so the contig sequences that Bakta writes
+    after them are never read.
+    """
+    with open(path, encoding='utf-8') as f:
+        stream = _JsonStream(f)
+        stream.take('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            key = stream.value()
+            stream.take(':')
+            if key == 'features':
+                stream.take('[')
+                if stream.peek() == ']':
+                    return
+                while True:
+                    yield stream.value()
+                    if stream.take(',]') == ']':
+                        return
+            stream.value()
+            if stream.take(',}') == '}':
+                return
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    # Products, genes and contigs repeat across features
+    return sys.intern(value) if value is not None else None
+
+
+class BaktaFeatures:
+    """
+    The fields of Bakta's features read by Sarand, stored column-wise.
+    """
+    __slots__ = ('locus', 'gene', 'product', 'contig', 'start', 'stop', 'forward')
+
+    def __init__(self):
+        self.locus: List[Optional[str]] = []
+        self.gene: List[Optional[str]] = []
+        self.product: List[str] = []
+        self.contig: List[Optional[str]] = []
+        self.start: array = array('q')
+        self.stop: array = array('q')
+        # 1 for features on the + strand
+        self.forward: bytearray = bytearray()
+
+    @classmethod
+    def from_features(cls, features: Iterable[dict]) -> 'BaktaFeatures':
+        table = cls()
+        for feature in features:
+            table.append(feature)
+        return table
+
+    def append(self, feature: dict):
+        self.locus.append(feature.get('locus'))
+        self.gene.append(_intern(feature.get('gene')))
+        self.product.append(_intern(feature['product']))
+        self.contig.append(_intern(feature.get('contig')))
+        self.start.append(feature['start'])
+        self.stop.append(feature['stop'])
+        self.forward.append(feature['strand'] == '+')
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def for_sarand(self, i: int) -> dict:
+        """
+        The i-th feature as Sarand reads it
+
+        AM:
+        - The Locus tag is different from Prokka
+        - Length is off by 1, this is either due to exclusive bounds, or from Bandage?
+        - Product name is different (more verbose than prokka)
+        - The stop/start are flipped for reverse strand as per the previous implementation
+        """
+        start, stop = self.start[i], self.stop[i]
+        forward = self.forward[i]
+        return {
+            "locus_tag": self.locus[i],
+            "gene": self.gene[i] or '',  # AM: This matches the expected output
+            "length": str((stop - start) + 1),
+            # AM: This matches the expected output but should probably remain int
+            "product": self.product[i],
+            "start_pos": start if forward else stop,
+            "end_pos": stop if forward else start,
+            # "prokka_gene_name": 'TO REMOVE',
+            "RGI_prediction_type": None,
+            "coverage": None,
+            "family": None,
+            "seq_value": None,
+            "seq_name": None,
+            "target_amr": None,
+        }
+
+
 class BaktaResult:
-    __slots__ = ('data',)
+    """
+    The features of a Bakta run. The whole JSON, with the sequences, is only
+    read if `data` is used.
+    """
+    __slots__ = ('features', 'path', '_data')
 
-    def __init__(self, data: dict):
-        self.data: dict = data
+    def __init__(
+            self,
+            data: Optional[dict] = None,
+            path: Optional[Path] = None,
+            features: Optional[BaktaFeatures] = None,
+    ):
+        """
+        Args:
+            data: The decoded Bakta JSON
+            path: The Bakta JSON, read when data is not given
+            features: The features, by default those of data
+        """
+        self._data: Optional[dict] = data
+        self.path: Optional[Path] = path
+        if features is None:
+            features = BaktaFeatures.from_features(self.data['features'])
+        self.features: BaktaFeatures = features
 
-    def get_for_sarand(self):
-        out = list()
+    @classmethod
+    def from_json(cls, path: Path) -> 'BaktaResult':
+        """
+        The result of a Bakta JSON, parsing only the fields of its features Sarand reads
+        """
+        return cls(path=path, features=BaktaFeatures.from_features(iter_features(path)))
 
+    @staticmethod
+    def read_json(path: Path) -> dict:
+        with path.open() as f:
+            return json.load(f)
+
+    @property
+    def data(self) -> dict:
+        if self._data is None:
+            self._data = self.read_json(self.path)
+        return self._data
+
+    def iter_for_sarand(self) -> Iterator[dict]:
+        """
+        get_for_sarand(), building each dict as it is consumed
+        """
+        for i in range(len(self.features)):
+            yield self.features.for_sarand(i)
+
+    def get_for_sarand(self):
         """
         AM: The sequence can also be obtained from the self.data method if needed.
         """
-        for feature in self.data['features']:
-            """
-            AM:
-            - The Locus tag is different from Prokka
-            - Length is off by 1, this is either due to exclusive bounds, or from Bandage?
-            - Product name is different (more verbose than prokka)
-            - The stop/start are flipped for reverse strand as per the previous implementation
-            """
-            out.append({
-                "locus_tag": feature.get('locus'),
-                "gene": feature.get('gene') or '',  # AM: This matches the expected output
-                "length": str((feature['stop'] - feature['start']) + 1),
-                # AM: This matches the expected output but should probably remain int
-                "product": feature['product'],
-                "start_pos": feature['start'] if feature['strand'] == '+' else feature['stop'],
-                "end_pos": feature['stop'] if feature['strand'] == '+' else feature['start'],
-                # "prokka_gene_name": 'TO REMOVE',
-                "RGI_prediction_type": None,
-                "coverage": None,
-                "family": None,
-                "seq_value": None,
-                "seq_name": None,
-                "target_amr": None,
-            })
+        return list(self.iter_for_sarand())
+
+    def get_for_sarand_by_contig(self) -> Dict[str, List[dict]]:
+        """
+        get_for_sarand() split by the contig each feature is on, for batched
+        runs over a multi-FASTA. Contigs without features are missing.
+        """
+        out: Dict[str, List[dict]] = {}
+        for i, contig in enumerate(self.features.contig):
+            out.setdefault(contig, []).append(self.features.for_sarand(i))
         return out
 
 
 class Bakta:
+    # The version of the Bakta binary, once checked
+    _version: Optional[str] = None
+
     def __init__(self, params: BaktaParams, result: BaktaResult):
         self.params = params
         self.result = result
 
     @classmethod
-    def run(cls, params: BaktaParams):
-        cmd = params.as_cmd()
-
-        # If this is being run in the Docker container, then activate the env first
-        if CONDA_BAKTA_NAME:
-            cmd = [
-                      CONDA_EXE_NAME,
-                      'run',
-                      '-n',
-                      CONDA_BAKTA_NAME,
-                  ] + cmd
-        #LOG.debug(' '.join(map(str, cmd)))
-        proc = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8'
-        )
-        stdout, stderr = proc.communicate()
-        if proc.returncode != 0:
-            raise Exception(f"Error running Bakta: {stderr}")
-
-        with params.path_json.open() as f:
-            result = BaktaResult(json.load(f))
+    def run(cls, params: BaktaParams, timeout: Optional[float] = BAKTA_TIMEOUT):
+        return asyncio.run(cls.run_async(params, timeout))
 
+    @classmethod
+    async def run_async(cls, params: BaktaParams, timeout: Optional[float] = BAKTA_TIMEOUT):
+        """
+        To run Bakta from an event loop. Its output is written to
+        params.path_log(), which is removed once Bakta succeeds.
+        """
+        # If this is being run in the Docker container, then run the binary
+        # of the env with the env's activation applied
+        cmd, env = await tool_resolver.command('bakta', CONDA_BAKTA_NAME, params.as_cmd()[1:])
+        #LOG.debug(' '.join(map(str, cmd)))
+        stdout, stderr = params.path_log('stdout'), params.path_log('stderr')
+        stdout.parent.mkdir(parents=True, exist_ok=True)
+        returncode = await tool_runner.run(cmd, stdout, stderr, timeout, env)
+        if returncode != 0:
+            raise Exception(f"Error running Bakta ({stderr}): {tool_runner.tail(stderr)}")
+
+        result = await asyncio.to_thread(BaktaResult.from_json, params.path_json)
+        tool_runner.remove_logs(stdout, stderr)
         return cls(params, result)
 
-    @classmethod
-    def run_for_sarand(cls, genome: Path, prefix: str, out_dir: Path):
-        params = BaktaParams(
+    @staticmethod
+    def params_for_sarand(
+            genome: Path, prefix: str, out_dir: Path, threads: Optional[int] = None,
+            locus_tag: Optional[str] = None,
+    ) -> BaktaParams:
+        return BaktaParams(
             db=Path(CONDA_BAKTA_DB) if CONDA_BAKTA_DB else None,
             genome=genome,
             prefix=prefix,
             meta=True,
             skip_trna=True,
             output=out_dir,
+            threads=threads,
+            locus_tag=locus_tag,
         )
+
+    @classmethod
+    def run_for_sarand(
+            cls, genome: Path, prefix: str, out_dir: Path, threads: Optional[int] = None,
+            locus_tag: Optional[str] = None,
+    ):
+        return cls.run(cls.params_for_sarand(genome, prefix, out_dir, threads, locus_tag))
+
+    @classmethod
+    def run_batch_for_sarand(cls, genome: Path, prefix: str, out_dir: Path, threads: Optional[int] = None):
+        """
+        run_for_sarand() over a multi-FASTA. Contig headers are kept so each
+        feature's contig is the ID of the record it was found on.
+        """
+        params = cls.params_for_sarand(genome, prefix, out_dir, threads)
+        params.keep_contig_headers = True
         return cls.run(params)
 
-    @staticmethod
-    def version() -> str:
-        cmd = ['bakta', '--version']
-        if CONDA_BAKTA_NAME:
-            cmd = [
-                      CONDA_EXE_NAME,
-                      'run',
-                      '-n',
-                      CONDA_BAKTA_NAME,
-                  ] + cmd
+    @classmethod
+    def version(cls) -> str:
+        if cls._version is None:
+            return asyncio.run(cls.version_async())
+        return cls._version
+
+    @classmethod
+    async def version_async(cls) -> str:
+        if cls._version is not None:
+            return cls._version
+        cmd, env = await tool_resolver.command('bakta', CONDA_BAKTA_NAME, ['--version'])
+        cls._version = tool_resolver.cached_version('bakta', CONDA_BAKTA_NAME)
+        if cls._version is not None:
+            return cls._version
         #LOG.debug(' '.join(map(str, cmd)))
-        proc = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8'
-        )
-        stdout, stderr = proc.communicate()
-        if proc.returncode != 0:
+        returncode, stdout, stderr = await tool_runner.capture(cmd, TOOL_VERSION_TIMEOUT, env)
+        if returncode != 0:
             raise Exception(f"Bakta binary not found.")
         hit = re.match(r'bakta ([\d.]+)', stdout)
-        if hit:
-            return hit.group(1)
-        #return PROGRAM_VERSION_NA
-        return 1
+        cls._version = hit.group(1) if hit else PROGRAM_VERSION_NA
+        tool_resolver.store_version('bakta', CONDA_BAKTA_NAME, cls._version)
+        return cls._version
@@ -0,0 +1,151 @@
+"""
+Benchmark of reading Bakta's JSON output.
+
+Compares loading the whole JSON with json.load() and building Sarand's
+feature dicts from it, as BaktaResult used to, with the streaming,
+column-wise BaktaResult.from_json(), over synthetic Bakta outputs of
+growing numbers of features. Each feature carries its amino acid and
+nucleotide sequences and the contigs are written after the features, as
+Bakta does. Reports the time to parse and to build the dicts, the peak
+memory while parsing, and the memory the result keeps.
+
+    python benchmarks/bench_bakta_json.py
+    python benchmarks/bench_bakta_json.py --features 1000 10000 100000 --cds-length 900
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bakta import BaktaResult
+
+PRODUCTS = ["hypothetical protein", "DNA-binding protein", "ABC transporter permease",
+            "Beta-lactamase", "Transposase", "50S ribosomal protein L2"]
+
+
+def generate(path: Path, features: int, cds_length: int, rng: random.Random):
+    """
+    To write a Bakta-like JSON with `features` CDSs over contigs of 100 of them each
+    """
+    contigs = max(1, features // 100)
+    with path.open("w") as f:
+        f.write('{"genome": {"genus": "Escherichia", "species": "coli", "complete": false}, ')
+        f.write('"stats": {"no_sequences": %d, "size": %d}, "features": [' % (contigs, features * cds_length))
+        for i in range(features):
+            start = (i % 100) * cds_length + 1
+            nt = "".join(rng.choice("ACGT") for _ in range(cds_length))
+            aa = "M" + "".join(rng.choice("ACDEFGHIKLMNPQRSTVWY") for _ in range(cds_length // 3 - 1))
+            feature = {
+                "type": "cds", "contig": f"contig_{i // 100 + 1}", "start": start,
+                "stop": start + cds_length - 1, "strand": rng.choice("+-"), "frame": 1,
+                "gene": rng.choice([None, f"gen{i % 50}"]), "product": rng.choice(PRODUCTS),
+                "db_xrefs": ["SO:0001217", f"UniRef:UniRef50_{i:06d}"], "nt": nt, "aa": aa,
+                "aa_hexdigest": f"{i:032x}", "start_type": "ATG", "rbs_motif": None,
+                "genes": [], "locus": f"ABCDEF_{(i + 1) * 5:05d}", "id": f"ABCDEF_{(i + 1) * 5:05d}",
+                "ups": {"uniparc_id": f"UPI{i:010d}", "ncbi_nrp_id": f"WP_{i:09d}.1"},
+            }
+            f.write(("," if i else "") + json.dumps(feature))
+        f.write('], "sequences": [')
+        for i in range(contigs):
+            nt = "".join(rng.choice("ACGT") for _ in range(100 * cds_length))
+            f.write(("," if i else "") + json.dumps({"id": f"contig_{i + 1}", "nt": nt, "length": len(nt)}))
+        f.write('], "version": {"bakta": "1.9.1", "db": "5.1"}}')
+
+
+def feature_for_sarand(feature: dict) -> dict:
+    """
+    A decoded feature as Sarand reads it, built as BaktaResult used to
+    """
+    return {
+        "locus_tag": feature.get('locus'),
+        "gene": feature.get('gene') or '',
+        "length": str((feature['stop'] - feature['start']) + 1),
+        "product": feature['product'],
+        "start_pos": feature['start'] if feature['strand'] == '+' else feature['stop'],
+        "end_pos": feature['stop'] if feature['strand'] == '+' else feature['start'],
+        "RGI_prediction_type": None,
+        "coverage": None,
+        "family": None,
+        "seq_value": None,
+        "seq_name": None,
+        "target_amr": None,
+    }
+
+
+def eager(path: Path):
+    with path.open() as f:
+        data = json.load(f)
+    parsed = time.perf_counter()
+    dicts = [feature_for_sarand(feature) for feature in data["features"]]
+    return data, parsed, dicts
+
+
+def lazy(path: Path):
+    result = BaktaResult.from_json(path)
+    parsed = time.perf_counter()
+    dicts = result.get_for_sarand()
+    return result, parsed, dicts
+
+
+def timed(read, path: Path, repeat: int):
+    best_parse, best_dicts = float("inf"), float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        _, parsed, _ = read(path)
+        best_parse = min(best_parse, parsed - started)
+        best_dicts = min(best_dicts, time.perf_counter() - parsed)
+    return best_parse, best_dicts
+
+
+def memory(read, path: Path):
+    """
+    The peak traced memory while parsing, and what the parsed result keeps (MB)
+    """
+    gc.collect()
+    tracemalloc.start()
+    kept, _, dicts = read(path)
+    del dicts
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return peak / 2 ** 20, current / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--features", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--cds-length", type=int, default=900, help="nucleotides per feature")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'features':>9} {'MB':>7} | {'parse s':>15} {'dicts s':>15} | "
+          f"{'peak MB':>15} {'kept MB':>15}   (json.load / streaming)")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for features in args.features:
+            path = Path(tmp_dir) / f"bakta_{features}.json"
+            generate(path, features, args.cds_length, rng)
+            size = path.stat().st_size / 2 ** 20
+            (eager_parse, eager_dicts), (lazy_parse, lazy_dicts) = (
+                timed(eager, path, args.repeat), timed(lazy, path, args.repeat)
+            )
+            (eager_peak, eager_kept), (lazy_peak, lazy_kept) = memory(eager, path), memory(lazy, path)
+            print(f"{features:9d} {size:7.1f} | {eager_parse:7.3f} {lazy_parse:7.3f} "
+                  f"{eager_dicts:7.3f} {lazy_dicts:7.3f} | {eager_peak:7.1f} {lazy_peak:7.1f} "
+                  f"{eager_kept:7.1f} {lazy_kept:7.1f}")
+            path.unlink()
+
+
+if __name__ == "__main__":
+    main()
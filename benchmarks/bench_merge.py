@@ -0,0 +1,95 @@
+"""
+Micro-benchmark of merging RGI findings into Bakta's features.
+
+Compares the indexed merge in annotation.incorporate_annotations() with the
+nested loop it replaced, which scanned every feature for every RGI hit, over
+growing numbers of features with an RGI hit for a fraction of them (some
+with several hits).
+
+    python benchmarks/bench_merge.py
+    python benchmarks/bench_merge.py --features 100 1000 10000 --hit-rate 0.3
+"""
+import argparse
+import copy
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from annotation import incorporate_annotations
+
+
+def nested_loop_merge(seq_info, RGI_output_list):
+    """
+    The merge as it was: O(RGI hits x features)
+    """
+    for item in RGI_output_list:
+        for gene_info in seq_info:
+            if item["ORF_ID"].split(" ")[0] == gene_info["locus_tag"]:
+                gene_info["gene"] = item["gene"]
+                gene_info["RGI_prediction_type"] = item["prediction_type"]
+                gene_info["family"] = item["family"]
+                break
+
+
+def indexed_merge(seq_info, RGI_output_list):
+    incorporate_annotations("", seq_info, RGI_output_list)
+
+
+def generate(features: int, hit_rate: float, rng: random.Random):
+    seq_info = [
+        {"locus_tag": f"ABCDEF_{i * 5:05d}", "gene": "", "RGI_prediction_type": None,
+         "family": None, "seq_value": None}
+        for i in range(features)
+    ]
+    hits = []
+    for gene_info in rng.sample(seq_info, int(features * hit_rate)):
+        for k in range(rng.choice((1, 1, 1, 2, 3))):
+            hits.append({
+                "ORF_ID": f"{gene_info['locus_tag']} # 1 # 300 # 1 # ID=1_{k}",
+                "gene": f"aro{k}",
+                "prediction_type": "Strict",
+                "best_identities": rng.uniform(40, 100),
+                "family": "family",
+            })
+    rng.shuffle(hits)
+    return seq_info, hits
+
+
+def timed(merge, seq_info, hits, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        data = copy.deepcopy(seq_info)
+        started = time.perf_counter()
+        merge(data, hits)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--features", type=int, nargs="+", default=[10, 100, 1000, 5000, 20000])
+    parser.add_argument("--hit-rate", type=float, default=0.2, help="fraction of features with an RGI hit")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-nested", type=int, default=20000,
+                        help="skip the nested loop above this many features")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'features':>9} {'hits':>7} {'nested ms':>11} {'indexed ms':>11} {'speedup':>8}")
+    for features in args.features:
+        seq_info, hits = generate(features, args.hit_rate, rng)
+        indexed = timed(indexed_merge, seq_info, hits, args.repeat)
+        if features <= args.max_nested:
+            nested = timed(nested_loop_merge, seq_info, hits, args.repeat)
+            print(f"{features:9d} {len(hits):7d} {nested * 1000:11.3f} {indexed * 1000:11.3f} "
+                  f"{nested / indexed:7.1f}x")
+        else:
+            print(f"{features:9d} {len(hits):7d} {'-':>11} {indexed * 1000:11.3f} {'-':>8}")
+
+
+if __name__ == "__main__":
+    main()
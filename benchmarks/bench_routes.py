@@ -0,0 +1,233 @@
+"""
+Benchmark harness for the app's routes.
+
+Drives every route through the Flask test client (in-process latency) and
+then through a real HTTP server with a pool of concurrent clients (latency
+under contention and throughput), and writes p50/p95/p99 latency, throughput
+and peak RSS to a JSON file tagged with the current commit. Compare two runs
+to spot regressions.
+
+    python benchmarks/fixtures.py --lines 1000000 --sqlite bench.db
+    python benchmarks/bench_routes.py --sqlite bench.db --out results.json
+    python benchmarks/bench_routes.py --compare before.json after.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# (name, method, path, form data). Cursors for later pages are filled in at runtime.
+ROUTES = [
+    ("index", "GET", "/", None),
+    ("show-table suppliers", "POST", "/show-table", {"name": "suppliers"}),
+    ("show-table parts", "POST", "/show-table", {"name": "parts"}),
+    ("show-table orders", "POST", "/show-table", {"name": "orders"}),
+    ("show-table orders page 2", "GET", "/show-table?name=orders&cursor={orders_cursor}", None),
+    ("filter-table orders sup_id", "POST", "/filter-table/orders", {"filter_column": "Sup_id", "filter_value": "1"}),
+    ("filter-table suppliers name", "POST", "/filter-table/suppliers",
+     {"filter_column": "Name", "filter_value": "Supplier 00001"}),
+    ("get-annual-expense", "GET", "/get-annual-expense/2016/2023", None),
+    ("project-budget", "POST", "/project-budget", {"numYears": "10", "rate": "3"}),
+    ("api show-table orders", "GET", "/api/show-table/orders", None),
+    ("api annual-expense", "GET", "/api/annual-expense/2016/2023", None),
+    ("api project-budget", "GET", "/api/project-budget?numYears=10&rate=3", None),
+    ("api spend top suppliers", "GET", "/api/spend/suppliers?top=10", None),
+    ("api spend top parts", "GET", "/api/spend/parts?top=10", None),
+    ("api spend supplier", "GET", "/api/spend/suppliers/1", None),
+    ("api spend month", "GET", "/api/spend/months/2022/6?top=10", None),
+    ("dashboard", "GET", "/dashboard", None),
+]
+
+
+def percentile(samples, q: float) -> float:
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def summarize(samples, elapsed: float, errors: int) -> dict:
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p95_ms": percentile(samples, 0.95) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "throughput_rps": len(samples) / elapsed if elapsed else 0.0,
+    }
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if platform.system() == "Darwin" else rss / 1024
+
+
+def resolve(path: str, context: dict) -> str:
+    return path.format(**context)
+
+
+def first_cursor(client) -> str:
+    body = client.get("/api/show-table/orders").get_json()
+    return body.get("next_cursor") or ""
+
+
+def bench_test_client(app, iterations: int, context: dict, fresh_cache: bool) -> dict:
+    import cache
+    client = app.test_client()
+    results = {}
+    for name, method, path, data in ROUTES:
+        samples = []
+        errors = 0
+        started = time.perf_counter()
+        for _ in range(iterations):
+            if fresh_cache:
+                cache.results.clear()
+            t = time.perf_counter()
+            response = client.open(resolve(path, context), method=method, data=data)
+            response.get_data()
+            samples.append(time.perf_counter() - t)
+            errors += response.status_code >= 400
+        results[name] = summarize(samples, time.perf_counter() - started, errors)
+    return results
+
+
+def _request(base: str, method: str, path: str, data):
+    body = urllib.parse.urlencode(data).encode() if data else None
+    request = urllib.request.Request(base + path, data=body, method=method)
+    t = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            response.read()
+        ok = True
+    except (urllib.error.URLError, OSError):
+        ok = False
+    return time.perf_counter() - t, ok
+
+
+def bench_http(app, concurrency: int, duration: float, context: dict) -> dict:
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    results = {}
+    try:
+        for name, method, path, data in ROUTES:
+            samples = []
+            errors = 0
+            lock = threading.Lock()
+            deadline = time.perf_counter() + duration
+
+            def worker():
+                nonlocal errors
+                while time.perf_counter() < deadline:
+                    elapsed, ok = _request(base, method, resolve(path, context), data)
+                    with lock:
+                        samples.append(elapsed)
+                        errors += not ok
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(concurrency) as pool:
+                for _ in range(concurrency):
+                    pool.submit(worker)
+            results[name] = summarize(samples, time.perf_counter() - started, errors)
+    finally:
+        server.shutdown()
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(before_path: str, after_path: str, threshold: float) -> int:
+    """
+    Print the change of every metric between two result files
+    Return:
+        1 if any p95 latency regressed by more than threshold (a fraction), else 0
+    """
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    regressed = False
+    print(f"{before['commit'][:10]} -> {after['commit'][:10]}")
+    for mode in ("test_client", "http"):
+        for name, new in after.get(mode, {}).items():
+            old = before.get(mode, {}).get(name)
+            if not old:
+                continue
+            change = (new["p95_ms"] - old["p95_ms"]) / old["p95_ms"] if old["p95_ms"] else 0.0
+            flag = ""
+            if change > threshold:
+                flag = "  REGRESSION"
+                regressed = True
+            print(f"{mode:12} {name:32} p95 {old['p95_ms']:9.2f} -> {new['p95_ms']:9.2f} ms "
+                  f"({change:+.0%}) rps {old['throughput_rps']:8.1f} -> {new['throughput_rps']:8.1f}{flag}")
+    print(f"peak RSS {before['peak_rss_mb']:.1f} -> {after['peak_rss_mb']:.1f} MB")
+    return 1 if regressed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sqlite", help="benchmark against this SQLite stand-in (see fixtures.py)")
+    parser.add_argument("--iterations", type=int, default=50, help="test client requests per route")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent HTTP clients")
+    parser.add_argument("--duration", type=float, default=5, help="seconds of HTTP load per route")
+    parser.add_argument("--no-http", action="store_true", help="skip the concurrent HTTP load")
+    parser.add_argument("--cold", action="store_true", help="clear the result cache before every request")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    parser.add_argument("--threshold", type=float, default=0.10, help="p95 regression that fails --compare")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(compare(args.compare[0], args.compare[1], args.threshold))
+
+    if args.sqlite:
+        # Must be set before main (and config) are imported
+        os.environ["DB_BACKEND"] = "sqlite"
+        os.environ["DB_SQLITE_PATH"] = os.path.abspath(args.sqlite)
+    from main import app
+
+    context = {"orders_cursor": first_cursor(app.test_client())}
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "test_client": bench_test_client(app, args.iterations, context, args.cold),
+    }
+    if not args.no_http:
+        results["http"] = bench_http(app, args.concurrency, args.duration, context)
+    results["peak_rss_mb"] = peak_rss_mb()
+
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    for mode in ("test_client", "http"):
+        for name, r in results.get(mode, {}).items():
+            print(f"{mode:12} {name:32} p50 {r['p50_ms']:8.2f} p95 {r['p95_ms']:8.2f} "
+                  f"p99 {r['p99_ms']:8.2f} ms {r['throughput_rps']:8.1f} rps errors {r['errors']}")
+    print(f"peak RSS {results['peak_rss_mb']:.1f} MB, results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+Synthetic data generator for benchmarking the app.
+
+Builds the schema with schema.migrate() and fills it with suppliers, their
+telephone numbers, parts, orders and order lines. Order dates follow a
+seasonal pattern with growth over the years, line quantities are heavy
+tailed, and part prices are log-normal, so aggregates and indexes behave
+roughly like production data.
+
+    python benchmarks/fixtures.py --lines 1000000 --sqlite bench.db
+    python benchmarks/fixtures.py --lines 10000000 --mysql   # uses main.py's DB settings
+"""
+import argparse
+import datetime
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import rollup
+import schema
+import spend
+
+CHUNK_SIZE = 10000
+FIRST_YEAR = 2016
+LAST_YEAR = 2023
+
+
+class _Connection:
+    """
+    Minimal stand-in for PooledConnection over a raw backend connection.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.raw = backend.connect()
+        self.dialect = backend.dialect
+
+    def cursor(self, dict_rows=False, server_side=False):
+        return self.backend.cursor(self.raw, dict_rows=dict_rows, server_side=server_side)
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+
+def _order_dates(rng: random.Random, count: int):
+    """
+    Sorted order dates, weighted towards later years and towards spring and autumn
+    """
+    days = []
+    for year in range(FIRST_YEAR, LAST_YEAR + 1):
+        start = datetime.date(year, 1, 1)
+        length = (datetime.date(year + 1, 1, 1) - start).days
+        for day in range(length):
+            season = 1 + 0.4 * math.sin(4 * math.pi * day / length)
+            growth = 1.15 ** (year - FIRST_YEAR)
+            days.append((start + datetime.timedelta(days=day), season * growth))
+    dates, weights = zip(*days)
+    return sorted(rng.choices(dates, weights=weights, k=count))
+
+
+def _insert(conn, sql: str, rows):
+    cur = conn.cursor()
+    for start in range(0, len(rows), CHUNK_SIZE):
+        cur.executemany(sql, rows[start:start + CHUNK_SIZE])
+        conn.commit()
+    cur.close()
+
+
+def generate(conn, lines: int, suppliers: int = None, parts: int = None, seed: int = 0) -> dict:
+    """
+    To populate an empty database
+    Parameters:
+        conn: the connection to write with
+        lines: the number of order lines (part_orders rows) to create
+        suppliers: the number of suppliers (default scales with lines)
+        parts: the number of parts (default scales with lines)
+        seed: the random seed, so runs are reproducible
+    Return:
+        the number of rows written to each table
+    """
+    rng = random.Random(seed)
+    suppliers = suppliers or max(10, lines // 1000)
+    parts = parts or max(20, lines // 500)
+
+    schema.migrate(conn)
+    _insert(conn, "INSERT INTO supplier (_id, name, email) VALUES (%s, %s, %s)", [
+        (i, f"Supplier {i:07d}", f"supplier{i}@example.com") for i in range(1, suppliers + 1)
+    ])
+    telephones = [
+        (i, f"+1-555-{i % 10000:04d}-{n}")
+        for i in range(1, suppliers + 1) for n in range(rng.choice((1, 1, 2, 3)))
+    ]
+    _insert(conn, "INSERT INTO telephone (sup_id, tel) VALUES (%s, %s)", telephones)
+    _insert(conn, "INSERT INTO parts (_id, price, description) VALUES (%s, %s, %s)", [
+        (i, round(rng.lognormvariate(3, 1), 2), f"Part {i:07d}") for i in range(1, parts + 1)
+    ])
+
+    orders = 0
+    written = 0
+    dates = iter(_order_dates(rng, max(1, lines // 3)))
+    order_rows = []
+    line_rows = []
+    while written < lines:
+        orders += 1
+        date = next(dates, None) or datetime.date(LAST_YEAR, 12, 31)
+        order_rows.append((orders, date, rng.randint(1, suppliers)))
+        for part_id in rng.sample(range(1, parts + 1), min(parts, rng.randint(1, 5))):
+            if written == lines:
+                break
+            # Mostly small quantities with the occasional bulk order
+            line_rows.append((orders, part_id, min(1000, int(rng.paretovariate(1.5)))))
+            written += 1
+        if len(line_rows) >= CHUNK_SIZE:
+            _insert(conn, "INSERT INTO orders (_id, order_date, sup_id) VALUES (%s, %s, %s)", order_rows)
+            _insert(conn, "INSERT INTO part_orders (order_id, part_id, qty) VALUES (%s, %s, %s)", line_rows)
+            order_rows, line_rows = [], []
+    _insert(conn, "INSERT INTO orders (_id, order_date, sup_id) VALUES (%s, %s, %s)", order_rows)
+    _insert(conn, "INSERT INTO part_orders (order_id, part_id, qty) VALUES (%s, %s, %s)", line_rows)
+    rollup.rebuild(conn)
+    spend.rebuild(conn)
+    return {
+        "supplier": suppliers, "telephone": len(telephones), "parts": parts,
+        "orders": orders, "part_orders": written,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=10000, help="order lines to generate (10k to 10M)")
+    parser.add_argument("--suppliers", type=int)
+    parser.add_argument("--parts", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--sqlite", help="path of the SQLite stand-in database to create")
+    target.add_argument("--mysql", action="store_true", help="write to the MySQL database configured in main.py")
+    args = parser.parse_args()
+
+    if args.sqlite:
+        if os.path.exists(args.sqlite):
+            os.remove(args.sqlite)
+        backend = db.SQLiteBackend(args.sqlite)
+    else:
+        from main import DB_HOST, DB_USER, DB_PASSWORD, DB_NAME
+        backend = db.MySQLBackend(host=DB_HOST, user=DB_USER, passwd=DB_PASSWORD, db=DB_NAME)
+
+    started = time.perf_counter()
+    counts = generate(_Connection(backend), args.lines, args.suppliers, args.parts, args.seed)
+    print(f"Generated {counts} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+import cache
+import queries
+import rollup
+import schema
+
+"""
+Budget projection engine.
+
+The base year's spend is read with a single query grouped by supplier and
+part, and cached until orders change. Totals and per-part or per-supplier
+breakdowns are all sums over that one aggregate, so any number of what-if
+scenarios (inflation rates x horizon) costs at most one database query.
+Projections are computed in one pass over a shared table of growth factors
+rather than re-deriving (1 + rate)^i for every line.
+"""
+
+# Tables the base aggregate is read from, for cache invalidation and ETags
+BASE_TABLES = ('orders', 'part_orders', 'parts')
+YEAR_TABLES = rollup.READ_TABLES
+
+BREAKDOWNS = ('part', 'supplier')
+
+class BaseYear:
+    """
+    The spend of the base year, per (supplier, part).
+    """
+    __slots__ = ('year', 'spend')
+
+    def __init__(self, year: int, spend: Dict[Tuple[int, int], float]):
+        self.year: int = year
+        self.spend: Dict[Tuple[int, int], float] = spend
+
+    @property
+    def total(self) -> float:
+        return sum(self.spend.values())
+
+    def by(self, breakdown: str) -> Dict[int, float]:
+        """
+        The spend summed per part or per supplier
+        """
+        # spend is keyed by (sup_id, part_id)
+        position = 1 if breakdown == 'part' else 0
+        out: Dict[int, float] = {}
+        for key, spend in self.spend.items():
+            out[key[position]] = out.get(key[position], 0.0) + spend
+        return out
+
+
+def latest_complete_year(connect: Callable, today: Optional[datetime.date] = None) -> Optional[int]:
+    """
+    The latest year with orders that has ended, or the latest year with orders
+    if none has. Read from the expense rollup and cached until it changes.
+    connect() is only called on a cache miss.
+    """
+    today = today or datetime.date.today()
+
+    def fetch():
+        conn = connect()
+        cur = conn.cursor()
+        cur.execute(rollup.readable(conn, "SELECT MAX(year) FROM expense_rollup WHERE year < %s"), (today.year,))
+        year = cur.fetchone()[0]
+        if year is None:
+            cur.execute(rollup.readable(conn, "SELECT MAX(year) FROM expense_rollup"))
+            year = cur.fetchone()[0]
+        cur.close()
+        return year
+    return cache.results.get_or_compute('budget-latest-year', (today.year,), YEAR_TABLES, fetch)
+
+
+def base_year(connect: Callable, year: int) -> BaseYear:
+    """
+    The base year's aggregate, cached until orders change. connect() is only
+    called on a cache miss.
+    """
+    def fetch():
+        cur = connect().cursor()
+        cur.execute(queries.EXPENSE_BY_SUPPLIER_PART, schema.year_range(year, year))
+        spend = {(sup_id, part_id): float(total) for sup_id, part_id, total in cur.fetchall()}
+        cur.close()
+        return BaseYear(year, spend)
+    return cache.results.get_or_compute('budget-base', (year,), BASE_TABLES, fetch)
+
+
+def growth_factors(rates: List[float], years: int) -> List[List[float]]:
+    """
+    (1 + rate/100)^i for every rate and i = 1..years
+    """
+    return [[((100 + rate) / 100) ** i for i in range(1, years + 1)] for rate in rates]
+
+
+def project(base: BaseYear, rates: List[float], years: int, breakdown: Optional[str] = None) -> List[dict]:
+    """
+    To project the base year's spend forward under several inflation rates
+    Parameters:
+        base: the base year aggregate
+        rates: inflation rates in percent, one scenario each
+        years: the number of years to project
+        breakdown: None, 'part' or 'supplier' to also project each part's or supplier's spend
+    Return:
+        one dict per rate with the projected (year, total) rows and, with a
+        breakdown, the projected spend of every part or supplier
+    """
+    if breakdown is not None and breakdown not in BREAKDOWNS:
+        raise ValueError(f"breakdown must be one of {', '.join(BREAKDOWNS)}")
+    total = base.total
+    parts = base.by(breakdown) if breakdown else None
+    project_years = [base.year + i for i in range(1, years + 1)]
+    scenarios = []
+    for rate, factors in zip(rates, growth_factors(rates, years)):
+        scenario = {
+            "rate": rate,
+            "rows": [(year, round(total * f, 2)) for year, f in zip(project_years, factors)],
+        }
+        if parts is not None:
+            scenario["breakdown"] = {
+                key: [round(spend * f, 2) for f in factors] for key, spend in parts.items()
+            }
+        scenarios.append(scenario)
+    return scenarios
@@ -0,0 +1,296 @@
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from config import (
+    RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL,
+    RESULT_CACHE_SHARED_PATH,
+)
+
+"""
+Write-versioned result cache for the read routes.
+
+Every table carries a write version that the write paths bump after they
+commit. A cached result is keyed by its route, its parameters and the
+versions of the tables it was read from, so a write makes exactly the
+results that depend on the written tables unreachable, and they are dropped
+straight away. Entries also expire after a TTL, and the cache is bounded by
+both entry count and (pickled) size, evicting the least recently used.
+
+With RESULT_CACHE_SHARED_PATH set, versions and entries are also kept in a
+local SQLite file so every worker process sees the same writes and can reuse
+each other's results. Without it, each process follows the versions the
+database keeps of its tables (see data_version.sync()), which every process
+reads alike, so ETags derived from them match across workers. Only a table
+this process wrote since it last followed the database has a version of its
+own, tagged with a per-process epoch, until the next sync catches up.
+"""
+
+
+class SharedStore:
+    """
+    Table versions and cached results in a SQLite file shared by the worker
+    processes on this host.
+    """
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS versions (tbl TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+        conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+            key BLOB PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL,
+            expires REAL NOT NULL, used REAL NOT NULL)""")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            self._local.conn = conn
+        return conn
+
+    def versions(self, tables: Iterable[str]) -> Dict[str, int]:
+        tables = list(tables)
+        rows = self._conn().execute(
+            "SELECT tbl, version FROM versions WHERE tbl IN (" + ", ".join("?" * len(tables)) + ")",
+            tables,
+        ).fetchall()
+        out = dict.fromkeys(tables, 0)
+        out.update(rows)
+        return out
+
+    def bump(self, tables: Iterable[str]):
+        conn = self._conn()
+        conn.executemany(
+            """INSERT INTO versions (tbl, version) VALUES (?, 1)
+            ON CONFLICT (tbl) DO UPDATE SET version = version + 1""",
+            [(table,) for table in tables],
+        )
+        conn.commit()
+
+    def get(self, key: bytes):
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT value FROM entries WHERE key = ? AND expires > ?", (key, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE entries SET used = ? WHERE key = ?", (time.time(), key))
+        conn.commit()
+        return row[0]
+
+    def set(self, key: bytes, value: bytes, ttl: float):
+        conn = self._conn()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO entries (key, value, size, expires, used) VALUES (?, ?, ?, ?, ?)",
+            (key, value, len(value), now + ttl, now),
+        )
+        conn.execute("DELETE FROM entries WHERE expires <= ?", (now,))
+        # Evict least recently used entries until the store fits its bound
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total > self.max_bytes:
+            for entry_key, size in conn.execute("SELECT key, size FROM entries ORDER BY used").fetchall():
+                conn.execute("DELETE FROM entries WHERE key = ?", (entry_key,))
+                total -= size
+                if total <= self.max_bytes:
+                    break
+        conn.commit()
+
+
+class ResultCache:
+    """
+    In-process LRU + TTL cache of route results, invalidated by table write
+    versions.
+    """
+    def __init__(
+            self,
+            max_entries: int = 1024,
+            max_bytes: int = 64 * 1024 * 1024,
+            ttl: float = 300,
+            store: Optional[SharedStore] = None,
+    ):
+        """
+        Args:
+            max_entries: Maximum number of cached results
+            max_bytes: Maximum total pickled size of the cached results
+            ttl: Seconds a result is served for before it is recomputed
+            store: Shared store for versions and results across processes
+        """
+        self.max_entries: int = max_entries
+        self.max_bytes: int = max_bytes
+        self.ttl: float = ttl
+        self.store: Optional[SharedStore] = store
+        # Tags versions only meaningful within this process
+        self.epoch: str = uuid.uuid4().hex
+
+        self._lock = threading.Lock()
+        # key -> (value, size, expires, tables)
+        self._entries: OrderedDict = OrderedDict()
+        self._bytes = 0
+        # table -> writes by this process since its version was followed
+        self._versions: Dict[str, int] = {}
+        # table -> the version the database keeps of it, as last followed
+        self._followed: Dict[str, object] = {}
+        self._stats = {
+            'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0,
+            'invalidations': 0, 'shared_hits': 0,
+        }
+
+    def versions(self, tables: Iterable[str]) -> Tuple[Tuple[str, object], ...]:
+        tables = sorted(set(tables))
+        if self.store is not None:
+            current = self.store.versions(tables)
+        else:
+            with self._lock:
+                current = {table: (self._followed.get(table), self._versions.get(table, 0)) for table in tables}
+        return tuple((table, current[table]) for table in tables)
+
+    def tag(self, tables: Iterable[str]) -> tuple:
+        """
+        The versions of `tables`, tagged with this process's epoch unless every
+        other process derives the same versions for the same data: those in the
+        shared store, or followed from the database and not written since.
+        """
+        versions = self.versions(tables)
+        if self.store is None and any(followed is None or writes for _, (followed, writes) in versions):
+            return self.epoch, versions
+        return versions
+
+    def bump(self, *tables: str):
+        """
+        Record a committed write to `tables`, dropping every result read from them
+        """
+        if self.store is not None:
+            self.store.bump(tables)
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+            self._invalidate(tables)
+
+    def follow(self, versions: Dict[str, object]) -> List[str]:
+        """
+        Adopt the versions the database keeps of tables, dropping every result
+        read from a table whose version changed since they were last followed.
+        Parameters:
+            versions: table -> its version in the database
+        Return:
+            the tables whose version changed
+        """
+        with self._lock:
+            changed = sorted(
+                table for table, version in versions.items()
+                if table not in self._followed or self._followed[table] != version
+            )
+            for table in changed:
+                self._followed[table] = versions[table]
+                self._versions.pop(table, None)
+            self._invalidate(changed)
+        if self.store is not None and changed:
+            self.store.bump(changed)
+        return changed
+
+    def _invalidate(self, tables: Iterable[str]):
+        tables = set(tables)
+        stale = [key for key, entry in self._entries.items() if set(entry[3]) & tables]
+        for key in stale:
+            self._drop(key)
+        self._stats['invalidations'] += len(stale)
+
+    def _drop(self, key):
+        _, size, _, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def get_or_compute(self, route: str, params: tuple, tables: Iterable[str], compute: Callable):
+        """
+        The cached result of `route` for `params`, or the result of compute()
+        which is cached against the current versions of `tables`
+        """
+        tables = tuple(tables)
+        # Versions are read before computing so a write racing with compute()
+        # leaves the result under the old, now unreachable, versions
+        key = (route, params, self.versions(tables))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[2] > now:
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return entry[0]
+                self._drop(key)
+                self._stats['expirations'] += 1
+
+        shared_key = pickle.dumps(key) if self.store is not None else None
+        if shared_key is not None:
+            blob = self.store.get(shared_key)
+            if blob is not None:
+                value = pickle.loads(blob)
+                self._put(key, value, len(blob), tables)
+                with self._lock:
+                    self._stats['shared_hits'] += 1
+                return value
+
+        with self._lock:
+            self._stats['misses'] += 1
+        value = compute()
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self._put(key, value, len(blob), tables)
+        if shared_key is not None:
+            self.store.set(shared_key, blob, self.ttl)
+        return value
+
+    def _put(self, key, value, size: int, tables: tuple):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (value, size, time.monotonic() + self.ttl, tables)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(
+                self._stats,
+                entries=len(self._entries),
+                bytes=self._bytes,
+                max_entries=self.max_entries,
+                max_bytes=self.max_bytes,
+            )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+results = ResultCache(
+    max_entries=RESULT_CACHE_MAX_ENTRIES,
+    max_bytes=RESULT_CACHE_MAX_BYTES,
+    ttl=RESULT_CACHE_TTL,
+    store=SharedStore(RESULT_CACHE_SHARED_PATH, RESULT_CACHE_MAX_BYTES) if RESULT_CACHE_SHARED_PATH else None,
+)
+
+
+def bump(*tables: str):
+    """
+    Record a committed write to `tables` in the app's result cache
+    """
+    results.bump(*tables)
+
+
+def follow(versions: Dict[str, object]) -> List[str]:
+    """
+    Follow the versions the database keeps of tables in the app's result cache
+    """
+    return results.follow(versions)
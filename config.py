@@ -1,5 +1,5 @@
 import os
-from typing import Optional
+from typing import List, Optional
 
 """
 Configuration options for running dependencies through "conda run -n".
@@ -11,3 +11,127 @@ CONDA_BAKTA_NAME: Optional[str] = os.environ.get('CONDA_BAKTA_NAME')
 CONDA_RGI_NAME: Optional[str] = os.environ.get('CONDA_RGI_NAME')
 CONDA_EXE_NAME: Optional[str] = os.environ.get('CONDA_EXE_NAME', 'conda')
 CONDA_BAKTA_DB: Optional[str] = os.environ.get('BAKTA_DB')
+
+"""
+Configuration options for the web app's database connection pool.
+
+Setting DB_BACKEND=sqlite replaces the MySQL server with a local SQLite
+stand-in (DB_SQLITE_PATH, in memory by default) so the app runs offline.
+"""
+DB_BACKEND: str = os.environ.get('DB_BACKEND', 'mysql')
+DB_SQLITE_PATH: str = os.environ.get('DB_SQLITE_PATH', ':memory:')
+DB_POOL_MIN_SIZE: int = int(os.environ.get('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE: int = int(os.environ.get('DB_POOL_MAX_SIZE', 10))
+DB_POOL_RECYCLE: float = float(os.environ.get('DB_POOL_RECYCLE', 3600))
+DB_POOL_TIMEOUT: float = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_PING: bool = os.environ.get('DB_POOL_PING', '1') != '0'
+
+"""
+Configuration options for the read routes' result cache.
+
+If RESULT_CACHE_SHARED_PATH is supplied, table versions and cached results
+are also kept in that SQLite file so every worker process on the host shares
+them.
+"""
+RESULT_CACHE_MAX_ENTRIES: int = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 1024))
+RESULT_CACHE_MAX_BYTES: int = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+RESULT_CACHE_TTL: float = float(os.environ.get('RESULT_CACHE_TTL', 300))
+RESULT_CACHE_SHARED_PATH: Optional[str] = os.environ.get('RESULT_CACHE_SHARED_PATH')
+
+"""
+Configuration options for noticing writes made outside the app.
+
+At most every DATA_VERSION_POLL_SECONDS (0 = on every request) the versions
+the database's triggers keep of the base tables are read, and the cached
+results and ETags of any table written since are invalidated.
+"""
+DATA_VERSION_POLL_SECONDS: float = float(os.environ.get('DATA_VERSION_POLL_SECONDS', 1))
+
+"""
+Configuration options for read replicas.
+
+Read-only queries are routed to DB_REPLICA_HOSTS (or, with DB_BACKEND=sqlite,
+the stand-in databases in DB_SQLITE_REPLICA_PATHS), both comma separated.
+DB_REPLICA_STRATEGY is either round_robin or least_latency.
+"""
+DB_REPLICA_HOSTS: List[str] = [h for h in os.environ.get('DB_REPLICA_HOSTS', '').split(',') if h]
+DB_SQLITE_REPLICA_PATHS: List[str] = [p for p in os.environ.get('DB_SQLITE_REPLICA_PATHS', '').split(',') if p]
+DB_REPLICA_STRATEGY: str = os.environ.get('DB_REPLICA_STRATEGY', 'round_robin')
+DB_STICKY_SECONDS: float = float(os.environ.get('DB_STICKY_SECONDS', 5))
+DB_REPLICA_RETRY_SECONDS: float = float(os.environ.get('DB_REPLICA_RETRY_SECONDS', 30))
+
+"""
+Configuration options for request and query metrics.
+
+Queries taking at least METRICS_SLOW_QUERY_SECONDS are logged to the
+muc.slow_query logger. The slow query log is off unless this is supplied.
+"""
+METRICS_SLOW_QUERY_SECONDS: Optional[float] = (
+    float(os.environ['METRICS_SLOW_QUERY_SECONDS']) if os.environ.get('METRICS_SLOW_QUERY_SECONDS') else None
+)
+
+"""
+Configuration options for the dashboard.
+
+Each dashboard section is read on its own thread from DASHBOARD_WORKERS and
+given DASHBOARD_TIMEOUT seconds, after which the last value it produced is
+shown instead. The budget section projects DASHBOARD_BUDGET_YEARS ahead at
+DASHBOARD_BUDGET_RATE percent.
+"""
+DASHBOARD_WORKERS: int = int(os.environ.get('DASHBOARD_WORKERS', 4))
+DASHBOARD_TIMEOUT: float = float(os.environ.get('DASHBOARD_TIMEOUT', 2))
+DASHBOARD_BUDGET_YEARS: int = int(os.environ.get('DASHBOARD_BUDGET_YEARS', 5))
+DASHBOARD_BUDGET_RATE: float = float(os.environ.get('DASHBOARD_BUDGET_RATE', 3))
+
+"""
+Configuration options for the annotation cache.
+
+If ANNOTATION_CACHE_DIR is supplied, annotate_sequence() keeps the Bakta and
+RGI results of every sequence it annotates there, keyed by the sequence, the
+options and the tool versions, and reuses them instead of running the tools
+again. The least recently used results are evicted beyond
+ANNOTATION_CACHE_MAX_BYTES.
+"""
+ANNOTATION_CACHE_DIR: Optional[str] = os.environ.get('ANNOTATION_CACHE_DIR')
+ANNOTATION_CACHE_MAX_BYTES: int = int(os.environ.get('ANNOTATION_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+
+"""
+Configuration options for the annotation CPU scheduler.
+
+Neighborhood annotation keeps the Bakta and RGI runs in flight within
+ANNOTATION_CPU_BUDGET CPUs (by default every CPU of the machine), splitting
+them between concurrent runs and the --threads of each run. Every run of
+Bakta loads its database, so at most ANNOTATION_MAX_JOBS run at once, by
+default as many as fit in the machine's memory at ANNOTATION_JOB_MEMORY_MB
+each.
+"""
+ANNOTATION_CPU_BUDGET: int = int(os.environ.get('ANNOTATION_CPU_BUDGET', 0)) or (os.cpu_count() or 1)
+ANNOTATION_MAX_JOBS: int = int(os.environ.get('ANNOTATION_MAX_JOBS', 0))
+ANNOTATION_JOB_MEMORY_MB: int = int(os.environ.get('ANNOTATION_JOB_MEMORY_MB', 4096))
+
+"""
+Configuration options for running Bakta and RGI.
+
+At most TOOL_MAX_CONCURRENCY runs of the tools are started at once from an
+event loop. A run of Bakta or RGI is killed, together with any process it
+started, after BAKTA_TIMEOUT or RGI_TIMEOUT seconds and a version check
+after TOOL_VERSION_TIMEOUT seconds (0 never times out). Killed processes
+get TOOL_KILL_GRACE_SECONDS to exit on SIGTERM before they are sent SIGKILL.
+"""
+TOOL_MAX_CONCURRENCY: int = int(os.environ.get('TOOL_MAX_CONCURRENCY', 0)) or (os.cpu_count() or 1)
+BAKTA_TIMEOUT: Optional[float] = float(os.environ.get('BAKTA_TIMEOUT', 3600)) or None
+RGI_TIMEOUT: Optional[float] = float(os.environ.get('RGI_TIMEOUT', 3600)) or None
+TOOL_VERSION_TIMEOUT: Optional[float] = float(os.environ.get('TOOL_VERSION_TIMEOUT', 60)) or None
+TOOL_KILL_GRACE_SECONDS: float = float(os.environ.get('TOOL_KILL_GRACE_SECONDS', 5))
+
+"""
+Configuration options for resolving the tools.
+
+The executable and activated environment of each tool, and its version, are
+found once and kept in TOOL_CACHE_FILE, so that the tools are run directly
+instead of through "conda run". An entry is found again when the conda
+environment (or the executable) is modified.
+"""
+TOOL_CACHE_FILE: str = os.environ.get(
+    'TOOL_CACHE_FILE', os.path.join(os.path.expanduser('~'), '.cache', 'muc-app', 'tools.json')
+)
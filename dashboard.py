@@ -0,0 +1,175 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Any, Callable, Dict, Optional
+
+from flask import copy_current_request_context, has_request_context
+
+import budget
+import cache
+import rollup
+from config import DASHBOARD_WORKERS, DASHBOARD_TIMEOUT, DASHBOARD_BUDGET_YEARS, DASHBOARD_BUDGET_RATE
+
+"""
+The dashboard: every report on one page, read concurrently.
+
+Each section runs on a thread of its own with its own pooled connection, so
+the page takes as long as its slowest section rather than the sum of all of
+them. A section that fails or takes longer than DASHBOARD_TIMEOUT is shown
+with the last value it produced, marked stale, instead of holding up the
+page. The queries of a section are aborted by the database once its time is
+up, so the thread and its connection are freed for the next page, and a
+section that never started is cancelled. Should the threads still be busy
+with sections given up on, new sections are shown stale at once rather than
+queued behind them. Sections run in the request's context, so their queries
+are counted under the dashboard's route.
+"""
+
+
+class _Connector:
+    """
+    Checks out one connection on first use, so sections served from the
+    result cache never touch the pool.
+    """
+    __slots__ = ('acquire', 'deadline', 'conn')
+
+    def __init__(self, acquire: Callable, deadline: Optional[float] = None):
+        self.acquire = acquire
+        # time.perf_counter() after which the section's queries are aborted
+        self.deadline: Optional[float] = deadline
+        self.conn = None
+
+    def __call__(self):
+        if self.conn is None:
+            self.conn = self.acquire()
+            if self.deadline is not None:
+                # A query that would outlive the section fails rather than holding the connection
+                self.conn.set_statement_timeout(max(1e-3, self.deadline - time.perf_counter()))
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def _fetchone(connect: Callable, sql: str) -> tuple:
+    cur = connect().cursor()
+    cur.execute(sql)
+    row = cur.fetchone()
+    cur.close()
+    return row
+
+
+def supplier_count(connect: Callable) -> int:
+    return cache.results.get_or_compute(
+        'dashboard-suppliers', (), ('supplier',),
+        lambda: _fetchone(connect, "SELECT COUNT(*) FROM supplier")[0],
+    )
+
+
+def parts_summary(connect: Callable) -> dict:
+    def fetch():
+        count, low, high, average = _fetchone(
+            connect, "SELECT COUNT(*), MIN(price), MAX(price), AVG(price) FROM parts")
+        return {"count": count, "min_price": low, "max_price": high, "avg_price": average}
+    return cache.results.get_or_compute('dashboard-parts', (), ('parts',), fetch)
+
+
+def yearly_expense(connect: Callable) -> list:
+    return cache.results.get_or_compute(
+        'dashboard-expense', (), rollup.READ_TABLES,
+        lambda: [list(row) for row in rollup.yearly_totals(connect(), 0, 9999)],
+    )
+
+
+def budget_projection(connect: Callable) -> dict:
+    year = budget.latest_complete_year(connect)
+    if year is None:
+        return {"base_year": None, "rate": DASHBOARD_BUDGET_RATE, "rows": []}
+    base = budget.base_year(connect, year)
+    scenario = budget.project(base, [DASHBOARD_BUDGET_RATE], DASHBOARD_BUDGET_YEARS)[0]
+    return {"base_year": year, "rate": DASHBOARD_BUDGET_RATE, "rows": scenario["rows"]}
+
+
+SECTIONS: Dict[str, Callable[[Callable], Any]] = {
+    "supplier_count": supplier_count,
+    "parts_summary": parts_summary,
+    "yearly_expense": yearly_expense,
+    "budget": budget_projection,
+}
+
+_executor = ThreadPoolExecutor(max_workers=DASHBOARD_WORKERS, thread_name_prefix='dashboard')
+_lock = threading.Lock()
+# section -> the last value it produced, served when it next fails or times out
+_last_good: Dict[str, Any] = {}
+# Sections that timed out but are still running on the executor
+_abandoned = 0
+
+
+def _finished_abandoned(future):
+    global _abandoned
+    with _lock:
+        _abandoned -= 1
+
+
+def _run(section: Callable, acquire: Callable, deadline: float):
+    connect = _Connector(acquire, deadline)
+    started = time.perf_counter()
+    try:
+        return section(connect), time.perf_counter() - started
+    finally:
+        connect.close()
+
+
+def collect(acquire: Callable, timeout: float = DASHBOARD_TIMEOUT) -> Dict[str, dict]:
+    """
+    To read every dashboard section concurrently
+    Parameters:
+        acquire: checks out a connection for a section, see db.read_acquirer
+        timeout: seconds to wait for each section
+    Return:
+        section -> {"value", "stale", "error", "seconds"}. A section that
+        failed, timed out or found the threads busy has its last good value
+        (or None) with stale set, and no seconds.
+    """
+    global _abandoned
+    deadline = time.perf_counter() + timeout
+    futures = {}
+    for name, section in SECTIONS.items():
+        with _lock:
+            busy = _abandoned >= DASHBOARD_WORKERS
+        if busy:
+            futures[name] = None
+            continue
+        # A copy of the request context each, as every thread pushes its own
+        run = copy_current_request_context(_run) if has_request_context() else _run
+        futures[name] = _executor.submit(run, section, acquire, deadline)
+    out = {}
+    for name, future in futures.items():
+        error = None
+        if future is None:
+            error = "busy"
+        else:
+            try:
+                # Sections run in parallel, so each waits only for what is left of its own timeout
+                value, seconds = future.result(timeout=max(0.0, deadline - time.perf_counter()))
+            except TimeoutError:
+                error = "timed out"
+                # Cancelled if it never started, otherwise counted until its queries are aborted
+                if not future.cancel():
+                    with _lock:
+                        _abandoned += 1
+                    future.add_done_callback(_finished_abandoned)
+            except Exception as e:
+                # A query aborted at the deadline can fail the section just before it
+                error = "timed out" if time.perf_counter() >= deadline else str(e) or type(e).__name__
+        if error is None:
+            with _lock:
+                _last_good[name] = value
+            out[name] = {"value": value, "stale": False, "error": None, "seconds": seconds}
+        else:
+            with _lock:
+                fallback = _last_good.get(name)
+            out[name] = {"value": fallback, "stale": True, "error": error, "seconds": None}
+    return out
@@ -0,0 +1,370 @@
+import logging
+import re
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import cache
+from config import DATA_VERSION_POLL_SECONDS
+
+"""
+Write versions of the base tables, kept by the database itself.
+
+Triggers created by schema.migrate() bump a table's row in data_version on
+every insert, update and delete, whichever client makes it, so the app can
+notice writes it did not make. Every write to the order lines, orders and
+parts also bumps the aggregate_inputs counter: an order line only joins once
+its order and part exist, so even inserting a part can change the totals.
+
+The precomputed aggregates are kept current by fold triggers rather than
+rebuilt when they fall behind: a rebuild aggregates every order line, so
+after each write made outside the app the routes would pay for that scan
+again. Each write instead adds the order lines it joins to their groups, and
+subtracts the ones it unjoins, in the writer's transaction, which costs the
+writer one indexed join per aggregate table. Each aggregate records in
+aggregate_state the aggregate_inputs counter it is current for: rebuilds set
+it, the fold triggers move it forward with the counter, and any write the
+aggregate does not fold leaves it behind, as does a write made before its
+triggers existed. readable() then reads the live aggregate in place of the
+stale table until the next rebuild. An aggregate that was never built is at
+-1, and so never current. sync() hands the versions to the result cache, so
+results cached in the app, and their ETags, follow writes the app did not
+make, and every worker process derives the same ETags from them.
+
+On MySQL the triggers serialize writers to a table on its version row, and
+writers of the same groups on the aggregate rows. Several triggers on one
+table and event need MySQL 5.7.2 or later.
+"""
+
+TABLES = ('supplier', 'telephone', 'parts', 'orders', 'part_orders')
+AGGREGATE_INPUTS = 'aggregate_inputs'
+# table -> the writes to it that can change the aggregates
+AGGREGATE_EVENTS = {
+    'part_orders': ('INSERT', 'UPDATE', 'DELETE'),
+    'orders': ('INSERT', 'UPDATE', 'DELETE'),
+    'parts': ('INSERT', 'UPDATE', 'DELETE'),
+}
+# The precomputed aggregates: the expense rollup and the spend tables
+AGGREGATES = ('expense_rollup', 'spend')
+EVENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+# The order lines the aggregates sum, each joined with its order and part
+LINE_TABLES = ('part_orders', 'parts', 'orders')
+LINE_JOIN = "part_orders.part_id = parts._id AND orders._id = part_orders.order_id"
+# table -> the columns the aggregates read, an update of any other changes no total
+LINE_COLUMNS = {
+    'part_orders': ('order_id', 'part_id', 'qty'),
+    'orders': ('_id', 'order_date', 'sup_id'),
+    'parts': ('_id', 'price'),
+}
+
+# (aggregate table, ((key column, expression), ...), ((value column, expression), ...))
+# with the expressions over LINE_TABLES. The value columns are sums, and
+# include line_count, the number of order lines in the group.
+Fold = Tuple[str, Tuple[Tuple[str, str], ...], Tuple[Tuple[str, str], ...]]
+
+# 'column changed' of an update, as NOT (NEW.column <=> OLD.column AND ...)
+NULL_SAFE_EQUAL = {'mysql': '<=>', 'sqlite': 'IS'}
+
+CREATE_TABLES = [
+    """CREATE TABLE IF NOT EXISTS data_version (
+        table_name VARCHAR(64) NOT NULL PRIMARY KEY,
+        version BIGINT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS aggregate_state (
+        name VARCHAR(64) NOT NULL PRIMARY KEY,
+        version BIGINT NOT NULL
+    )""",
+]
+
+INSERT_IGNORE = {
+    'mysql': "INSERT IGNORE INTO {table} VALUES (%s, %s)",
+    'sqlite': "INSERT OR IGNORE INTO {table} VALUES (%s, %s)",
+}
+
+TRIGGER_EXISTS = {
+    'mysql': """SELECT 1 FROM information_schema.triggers
+    WHERE trigger_schema = DATABASE() AND trigger_name = %s LIMIT 1""",
+    'sqlite': "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = %s",
+}
+
+TABLE_EXISTS = {
+    'mysql': """SELECT 1 FROM information_schema.tables
+    WHERE table_schema = DATABASE() AND table_name = %s LIMIT 1""",
+    'sqlite': "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s",
+}
+
+# Dialects seen with migrated version tables, which are never dropped
+_migrated = set()
+
+log = logging.getLogger('muc.data_version')
+
+# When the last sync() ran
+_synced: float = float('-inf')
+_sync_lock = threading.Lock()
+
+
+def triggers() -> List[Tuple[str, str, str, Tuple[str, ...]]]:
+    """
+    (trigger name, table, event, versions bumped) of every version trigger
+    """
+    out = []
+    for table in TABLES:
+        for event in EVENTS:
+            bumped = (table,)
+            if event in AGGREGATE_EVENTS.get(table, ()):
+                bumped += (AGGREGATE_INPUTS,)
+            out.append((f"trg_version_{table}_{event.lower()}", table, event, bumped))
+    return out
+
+
+def _create_trigger(dialect: str, name: str, table: str, event: str, bumped: Tuple[str, ...]) -> str:
+    body = (f"UPDATE data_version SET version = version + 1 WHERE table_name IN "
+            f"({', '.join(repr(version) for version in bumped)})")
+    if dialect == 'mysql':
+        return f"CREATE TRIGGER {name} AFTER {event} ON {table} FOR EACH ROW {body}"
+    return f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table} FOR EACH ROW BEGIN {body}; END"
+
+
+def _fold_statements(dialect: str, fold: Fold, table: str, row: str, sign: str, where: str) -> List[str]:
+    """
+    The statements adding (sign '') or subtracting (sign '-') the order lines
+    that `row` of `table` joins to the groups of an aggregate table, and for a
+    subtraction, deleting the groups left without a line
+    """
+    target, keys, values = fold
+
+    def own(expr: str) -> str:
+        return re.sub(rf"\b{table}\.", f"{row}.", expr)
+
+    others = ', '.join(line_table for line_table in LINE_TABLES if line_table != table)
+    where = f"{own(LINE_JOIN)}{where}"
+    key_exprs = ', '.join(own(expr) for _, expr in keys)
+    columns = ', '.join(column for column, _ in keys + values)
+    upsert = (f"INSERT INTO {target} ({columns}) SELECT {key_exprs}, "
+              + ', '.join(f"{sign}({own(expr)})" for _, expr in values)
+              + f" FROM {others} WHERE {where}")
+    if dialect == 'mysql':
+        upsert += " ON DUPLICATE KEY UPDATE " + ', '.join(
+            f"{target}.{column} = {target}.{column} + VALUES({column})" for column, _ in values)
+    else:
+        upsert += f" ON CONFLICT ({', '.join(column for column, _ in keys)}) DO UPDATE SET " + ', '.join(
+            f"{column} = {column} + excluded.{column}" for column, _ in values)
+    if not sign:
+        return [upsert]
+    return [upsert, (
+        f"DELETE FROM {target} WHERE line_count = 0 AND ({', '.join(column for column, _ in keys)}) "
+        f"IN (SELECT {key_exprs} FROM {others} WHERE {where})"
+    )]
+
+
+def fold_triggers(dialect: str, name: str, folds: List[Fold]) -> List[Tuple[str, str]]:
+    """
+    (trigger name, CREATE TRIGGER) of the triggers folding every write to the
+    order lines, orders and parts into the tables of aggregate `name`, in the
+    writer's transaction. Each also moves the aggregate's state forward with
+    aggregate_inputs, so an aggregate that was current stays so.
+    """
+    out = []
+    for table in LINE_TABLES:
+        changed = ' AND '.join(f"NEW.{column} {NULL_SAFE_EQUAL[dialect]} OLD.{column}"
+                               for column in LINE_COLUMNS[table])
+        for event in EVENTS:
+            statements = []
+            for fold in folds:
+                if event == 'INSERT':
+                    statements += _fold_statements(dialect, fold, table, 'NEW', '', '')
+                elif event == 'DELETE':
+                    statements += _fold_statements(dialect, fold, table, 'OLD', '-', '')
+                else:
+                    # Only updates of the columns read move lines between groups
+                    statements += _fold_statements(dialect, fold, table, 'OLD', '-', f" AND NOT ({changed})")
+                    statements += _fold_statements(dialect, fold, table, 'NEW', '', f" AND NOT ({changed})")
+            statements.append(f"UPDATE aggregate_state SET version = version + 1 "
+                              f"WHERE name = '{name}' AND version >= 0")
+            trigger = f"trg_fold_{name}_{table}_{event.lower()}"
+            body = ' '.join(f"{statement};" for statement in statements)
+            if dialect == 'mysql':
+                create = f"CREATE TRIGGER {trigger} AFTER {event} ON {table} FOR EACH ROW BEGIN {body} END"
+            else:
+                create = f"CREATE TRIGGER IF NOT EXISTS {trigger} AFTER {event} ON {table} FOR EACH ROW BEGIN {body} END"
+            out.append((trigger, create))
+    return out
+
+
+def migrate(cur, dialect: str, folded: Optional[Dict[str, List[Fold]]] = None) -> List[str]:
+    """
+    To create the version tables and triggers, inside schema.migrate()
+    Parameters:
+        cur: a cursor of the connection to migrate
+        dialect: the connection's dialect
+        folded: aggregate -> the tables its fold triggers keep current
+    Return:
+        the names of the triggers that were created
+    """
+    for statement in CREATE_TABLES:
+        cur.execute(statement)
+    cur.executemany(INSERT_IGNORE[dialect].format(table='data_version'),
+                    [(name, 0) for name in TABLES + (AGGREGATE_INPUTS,)])
+    cur.executemany(INSERT_IGNORE[dialect].format(table='aggregate_state'),
+                    [(name, -1) for name in AGGREGATES])
+    created = []
+    for name, table, event, bumped in triggers():
+        cur.execute(TRIGGER_EXISTS[dialect], (name,))
+        if cur.fetchone():
+            continue
+        cur.execute(_create_trigger(dialect, name, table, event, bumped))
+        created.append(name)
+    # After the version triggers, so MySQL runs them first and a writer waits
+    # for a rebuild on aggregate_inputs before it touches an aggregate table
+    for aggregate, folds in (folded or {}).items():
+        for name, create in fold_triggers(dialect, aggregate, folds):
+            cur.execute(TRIGGER_EXISTS[dialect], (name,))
+            if cur.fetchone():
+                continue
+            cur.execute(create)
+            created.append(name)
+    return created
+
+
+def is_migrated(conn) -> bool:
+    if conn.dialect in _migrated:
+        return True
+    cur = conn.cursor()
+    try:
+        cur.execute(TABLE_EXISTS[conn.dialect], ('aggregate_state',))
+        found = cur.fetchone() is not None
+    finally:
+        cur.close()
+    if found:
+        _migrated.add(conn.dialect)
+    return found
+
+
+def versions(conn) -> Dict[str, int]:
+    """
+    The version of every base table and aggregate, or nothing before the migration
+    """
+    if not is_migrated(conn):
+        return {}
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT table_name, version FROM data_version")
+        out = {name: version for name, version in cur.fetchall()}
+        cur.execute("SELECT name, version FROM aggregate_state")
+        out.update((f"aggregate:{name}", version) for name, version in cur.fetchall())
+    finally:
+        cur.close()
+    return out
+
+
+def current(conn, names: Iterable[str]) -> List[str]:
+    """
+    Of the aggregates `names`, those that are current
+    """
+    names = list(names)
+    if not names or not is_migrated(conn):
+        return []
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            "SELECT aggregate_state.name FROM aggregate_state, data_version "
+            "WHERE data_version.table_name = %s AND aggregate_state.version = data_version.version "
+            "AND aggregate_state.name IN (" + ", ".join(["%s"] * len(names)) + ")",
+            [AGGREGATE_INPUTS] + names,
+        )
+        return [row[0] for row in cur.fetchall()]
+    finally:
+        cur.close()
+
+
+def lock_current(cur, dialect: str) -> List[str]:
+    """
+    To lock out other writers to the aggregate inputs for the rest of the
+    caller's transaction
+    Return:
+        the aggregates that are current
+    """
+    cur.execute(
+        "SELECT version FROM data_version WHERE table_name = %s" + (" FOR UPDATE" if dialect == 'mysql' else ""),
+        (AGGREGATE_INPUTS,),
+    )
+    inputs = cur.fetchone()[0]
+    cur.execute("SELECT name, version FROM aggregate_state")
+    return [name for name, version in cur.fetchall() if version == inputs]
+
+
+def mark_current(cur, names: Iterable[str]):
+    """
+    To record aggregates as current with the writes of the caller's transaction
+    """
+    names = list(names)
+    if not names:
+        return
+    cur.execute(
+        "UPDATE aggregate_state SET version = "
+        "(SELECT version FROM data_version WHERE table_name = %s) "
+        "WHERE name IN (" + ", ".join(["%s"] * len(names)) + ")",
+        [AGGREGATE_INPUTS] + names,
+    )
+
+
+def readable(conn, sql: str, live: Dict[str, Tuple[str, str]]) -> str:
+    """
+    A query of aggregate tables, with the tables of aggregates that are not
+    current replaced by their live aggregates
+    Parameters:
+        conn: the connection the query is run on
+        sql: the query
+        live: aggregate table -> (the aggregate it belongs to, its live aggregate query)
+    """
+    read = {table: entry for table, entry in live.items()
+            if re.search(rf"\bFROM {table}\b", sql)}
+    if not read:
+        return sql
+    fresh = set(current(conn, {name for name, _ in read.values()}))
+    for table, (name, query) in read.items():
+        if name not in fresh:
+            sql = re.sub(rf"\bFROM {table}\b", f"FROM ({query}) AS {table}", sql)
+    return sql
+
+
+def sync(connect: Callable, aggregates: Dict[str, Tuple[str, ...]]) -> List[str]:
+    """
+    To have the result cache follow the versions of the base tables and
+    aggregates, so cached results and ETags follow writes made by this
+    process or any other client. An aggregate's tables are versioned by the
+    aggregate and the aggregate_inputs counter, which moves while it is read
+    live. Reads the versions at most every DATA_VERSION_POLL_SECONDS, and only
+    in one thread at a time.
+    Parameters:
+        connect: returns the connection to read the versions on, only called when they are read
+        aggregates: aggregate -> the cached tables it is read as
+    Return:
+        the tables whose version changed
+    """
+    global _synced
+    if time.monotonic() - _synced < DATA_VERSION_POLL_SECONDS or not _sync_lock.acquire(blocking=False):
+        return []
+    try:
+        if time.monotonic() - _synced < DATA_VERSION_POLL_SECONDS:
+            return []
+        _synced = time.monotonic()
+        try:
+            latest = versions(connect())
+        except Exception:
+            # The route may still be served from the cache, try again next time
+            log.warning("Could not read the data versions", exc_info=True)
+            return []
+        if not latest:
+            return []
+        followed = {
+            name: version for name, version in latest.items()
+            if not name.startswith('aggregate:') and name != AGGREGATE_INPUTS
+        }
+        for aggregate, tables in aggregates.items():
+            version = (latest.get(f'aggregate:{aggregate}'), latest.get(AGGREGATE_INPUTS))
+            followed.update(dict.fromkeys(tables, version))
+        return cache.follow(followed)
+    finally:
+        _sync_lock.release()
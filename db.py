@@ -0,0 +1,614 @@
+import itertools
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+from flask import current_app, g, has_request_context, request
+
+import metrics
+
+from config import (
+    DB_BACKEND, DB_SQLITE_PATH, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE,
+    DB_POOL_RECYCLE, DB_POOL_TIMEOUT, DB_POOL_PING, DB_REPLICA_HOSTS,
+    DB_SQLITE_REPLICA_PATHS, DB_REPLICA_STRATEGY, DB_STICKY_SECONDS,
+    DB_REPLICA_RETRY_SECONDS,
+)
+
+"""
+Pooled database connections for the Flask app.
+
+Opening a new MySQL connection costs a TCP + TLS + auth round trip, which is
+more than most of the queries the routes run. Connections are instead kept in
+a process-wide pool and checked out once per request through the Flask app
+context.
+
+Two backends are provided: MySQLBackend talks to the real server, and
+SQLiteBackend is a local stand-in so the app can be run and tested offline.
+
+Read-only queries can be spread over replicas through a Router, while writes
+always go to the primary.
+"""
+
+
+# Bytes MySQL lets GROUP_CONCAT return, up from the default 1024
+GROUP_CONCAT_MAX_LEN = 1024 * 1024
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class MySQLBackend:
+    """
+    Creates MySQLdb connections and cursors.
+    """
+    dialect = 'mysql'
+
+    def __init__(self, host: str, user: str, passwd: str, db: str, **kwargs):
+        kwargs.setdefault('init_command', f"SET SESSION group_concat_max_len = {GROUP_CONCAT_MAX_LEN}")
+        self.connect_args = dict(host=host, user=user, passwd=passwd, db=db, **kwargs)
+
+    def connect(self):
+        import MySQLdb
+        return MySQLdb.connect(**self.connect_args)
+
+    @staticmethod
+    def ping(conn):
+        conn.ping()
+
+    @staticmethod
+    def cursor(conn, dict_rows: bool = False, server_side: bool = False):
+        import MySQLdb.cursors
+        if server_side:
+            cls = MySQLdb.cursors.SSDictCursor if dict_rows else MySQLdb.cursors.SSCursor
+        else:
+            cls = MySQLdb.cursors.DictCursor if dict_rows else MySQLdb.cursors.Cursor
+        return conn.cursor(cls)
+
+    @staticmethod
+    def statement_timeout(conn, seconds: Optional[float]):
+        # MySQL aborts a SELECT running longer than max_execution_time ms (0 = never)
+        cur = conn.cursor()
+        cur.execute("SET SESSION max_execution_time = %s", (int(seconds * 1000) if seconds else 0,))
+        cur.close()
+
+
+# MySQL's GROUP_CONCAT(x SEPARATOR s) is GROUP_CONCAT(x, s) in SQLite
+_GROUP_CONCAT_SEPARATOR = re.compile(r"(GROUP_CONCAT\([^()]*?)\s+SEPARATOR\s+", re.IGNORECASE)
+
+
+def _sqlite_query(query: str) -> str:
+    return _GROUP_CONCAT_SEPARATOR.sub(r"\1, ", query.replace('%s', '?'))
+
+
+class _SQLiteCursor:
+    """
+    Wraps a sqlite3 cursor so it behaves like a MySQLdb cursor: "%s"
+    placeholders, GROUP_CONCAT's SEPARATOR, and fetchall() returning a tuple.
+    """
+    __slots__ = ('cur',)
+
+    def __init__(self, cur: sqlite3.Cursor):
+        self.cur = cur
+
+    def execute(self, query: str, args=None):
+        self.cur.execute(_sqlite_query(query), args or ())
+        return self.cur.rowcount
+
+    def executemany(self, query: str, args):
+        self.cur.executemany(_sqlite_query(query), args)
+        return self.cur.rowcount
+
+    def fetchone(self):
+        return self.cur.fetchone()
+
+    def fetchmany(self, size: int = 1):
+        return tuple(self.cur.fetchmany(size))
+
+    def fetchall(self):
+        return tuple(self.cur.fetchall())
+
+    def close(self):
+        self.cur.close()
+
+    def __iter__(self):
+        return iter(self.cur)
+
+    @property
+    def rowcount(self):
+        return self.cur.rowcount
+
+    @property
+    def lastrowid(self):
+        return self.cur.lastrowid
+
+    @property
+    def description(self):
+        return self.cur.description
+
+
+def _dict_row(cur, row):
+    return {d[0]: value for d, value in zip(cur.description, row)}
+
+
+def _sql_year(value):
+    return int(str(value)[:4]) if value is not None else None
+
+
+def _sql_month(value):
+    return int(str(value)[5:7]) if value is not None else None
+
+
+# Names the in-memory databases. id() is reused once a backend is freed,
+# which the connections of an old database may outlive.
+_memory_databases = itertools.count()
+
+
+class SQLiteBackend:
+    """
+    Local stand-in for MySQL. Registers the handful of MySQL functions the
+    routes rely on (YEAR, MONTH) so the same SQL runs against both.
+    """
+    dialect = 'sqlite'
+
+    def __init__(self, path: str = ':memory:'):
+        self.path = path
+        self._keeper = None
+        if path == ':memory:':
+            # Every connection must see the same in-memory database, which only
+            # lives as long as at least one connection to it is open.
+            self.path = f'file:muc_{next(_memory_databases)}?mode=memory&cache=shared'
+            self._keeper = self.connect()
+
+    def connect(self):
+        conn = sqlite3.connect(
+            self.path, uri=self.path.startswith('file:'), check_same_thread=False
+        )
+        conn.create_function('YEAR', 1, _sql_year, deterministic=True)
+        conn.create_function('MONTH', 1, _sql_month, deterministic=True)
+        # Let prefix LIKE filters use an index, as they do on MySQL
+        conn.execute('PRAGMA case_sensitive_like = ON')
+        return conn
+
+    @staticmethod
+    def ping(conn):
+        conn.execute('SELECT 1')
+
+    @staticmethod
+    def statement_timeout(conn, seconds: Optional[float]):
+        # SQLite has no statement timeout, so abort whatever runs past the deadline
+        if not seconds:
+            conn.set_progress_handler(None, 0)
+            return
+        deadline = time.monotonic() + seconds
+        conn.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+
+    @staticmethod
+    def cursor(conn, dict_rows: bool = False, server_side: bool = False):
+        # sqlite3 cursors are always lazy, so server_side needs no special handling
+        cur = conn.cursor()
+        if dict_rows:
+            cur.row_factory = _dict_row
+        return _SQLiteCursor(cur)
+
+
+class PooledConnection:
+    """
+    A connection checked out from a ConnectionPool. close() hands it back to
+    the pool rather than closing the underlying connection.
+    """
+    __slots__ = ('pool', 'raw', 'created', 'released', 'wrote', 'timed')
+
+    def __init__(self, pool: 'ConnectionPool', raw, created: float):
+        self.pool = pool
+        self.raw = raw
+        self.created: float = created
+        self.released: bool = False
+        self.wrote: bool = False
+        self.timed: bool = False
+
+    @property
+    def dialect(self) -> str:
+        return self.pool.backend.dialect
+
+    def cursor(self, dict_rows: bool = False, server_side: bool = False):
+        return metrics.InstrumentedCursor(
+            self.pool.backend.cursor(self.raw, dict_rows=dict_rows, server_side=server_side)
+        )
+
+    def commit(self):
+        self.raw.commit()
+        self.wrote = True
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def set_statement_timeout(self, seconds: Optional[float]):
+        """
+        To abort the queries of this checkout that run longer than `seconds`
+        (on SQLite, past `seconds` from now), until it is handed back
+        """
+        self.pool.backend.statement_timeout(self.raw, seconds)
+        self.timed = bool(seconds)
+
+    def close(self):
+        if not self.released:
+            self.released = True
+            self.pool.release(self)
+
+
+class ConnectionPool:
+    """
+    A thread-safe pool of database connections.
+
+    Connections are pinged on checkout and replaced if the ping fails, and any
+    connection older than `recycle` seconds is closed and reopened so the
+    server's wait_timeout never bites.
+    """
+    def __init__(
+            self, backend,
+            min_size: int = 1,
+            max_size: int = 10,
+            recycle: Optional[float] = 3600,
+            timeout: float = 30,
+            ping: bool = True,
+            name: str = 'primary',
+    ):
+        """
+        Args:
+            backend: MySQLBackend or SQLiteBackend used to open connections
+            min_size: Number of connections opened up front and kept idle
+            max_size: Maximum number of connections open at once
+            recycle: Reopen connections older than this many seconds (None to disable)
+            timeout: Seconds to wait for a free connection before raising PoolTimeout
+            ping: Check connections are alive before handing them out
+            name: Name of the pool in stats
+        """
+        if min_size > max_size:
+            raise ValueError("min_size cannot be larger than max_size")
+        self.backend = backend
+        self.min_size: int = min_size
+        self.max_size: int = max_size
+        self.recycle: Optional[float] = recycle
+        self.timeout: float = timeout
+        self.ping: bool = ping
+        self.name: str = name
+
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._size = 0
+        self._stats = {
+            'checkouts': 0, 'waits': 0, 'timeouts': 0,
+            'connects': 0, 'recycled': 0, 'ping_failures': 0,
+        }
+        for _ in range(min_size):
+            try:
+                self._idle.append(self._connect())
+            except Exception:
+                # The server may be down at startup; connect lazily instead
+                break
+            self._size += 1
+
+    def _connect(self):
+        started = time.perf_counter()
+        raw = self.backend.connect()
+        metrics.CONNECT_SECONDS.observe(time.perf_counter() - started, self.name)
+        with self._cond:
+            self._stats['connects'] += 1
+        return raw, time.monotonic()
+
+    @staticmethod
+    def _close_raw(raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    def _validate(self, raw, created: float):
+        """
+        Return a usable (raw, created) pair, reconnecting if the connection is
+        too old or fails its ping.
+        """
+        if self.recycle is not None and time.monotonic() - created > self.recycle:
+            self._close_raw(raw)
+            with self._cond:
+                self._stats['recycled'] += 1
+            return self._connect()
+        if self.ping:
+            try:
+                self.backend.ping(raw)
+            except Exception:
+                self._close_raw(raw)
+                with self._cond:
+                    self._stats['ping_failures'] += 1
+                return self._connect()
+        return raw, created
+
+    def acquire(self) -> PooledConnection:
+        with self._cond:
+            if not self._idle and self._size >= self.max_size:
+                self._stats['waits'] += 1
+                available = self._cond.wait_for(
+                    lambda: self._idle or self._size < self.max_size, self.timeout
+                )
+                if not available:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(
+                        f"No database connection available after {self.timeout}s"
+                    )
+            if self._idle:
+                raw, created = self._idle.popleft()
+            else:
+                raw, created = None, None
+                # Reserve the slot before connecting outside the lock
+                self._size += 1
+            self._stats['checkouts'] += 1
+
+        try:
+            if raw is None:
+                raw, created = self._connect()
+            else:
+                raw, created = self._validate(raw, created)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        return PooledConnection(self, raw, created)
+
+    def release(self, conn: PooledConnection):
+        # End any open transaction so the next request doesn't read from a
+        # stale snapshot or inherit uncommitted writes, or a statement timeout.
+        try:
+            conn.raw.rollback()
+            if conn.timed:
+                self.backend.statement_timeout(conn.raw, None)
+        except Exception:
+            self._close_raw(conn.raw)
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self._idle.append((conn.raw, conn.created))
+            self._cond.notify()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return dict(
+                self._stats,
+                name=self.name,
+                size=self._size,
+                idle=len(self._idle),
+                in_use=self._size - len(self._idle),
+                min_size=self.min_size,
+                max_size=self.max_size,
+            )
+
+    def close(self):
+        with self._cond:
+            while self._idle:
+                raw, _ = self._idle.popleft()
+                self._close_raw(raw)
+                self._size -= 1
+
+
+class Router:
+    """
+    Routes read-only work to replicas and everything else to the primary.
+
+    Replicas are picked round robin, or by the lowest moving average of their
+    checkout latency. A replica that cannot be connected to is skipped for
+    `retry_after` seconds, one whose pool is exhausted only for the read at
+    hand, and reads fall back to the primary when no replica is available. Clients that just wrote are kept on the primary for
+    `sticky_seconds` so they read their own writes despite replication lag.
+    """
+    def __init__(
+            self, primary: ConnectionPool,
+            replicas: Optional[List[ConnectionPool]] = None,
+            strategy: str = 'round_robin',
+            sticky_seconds: float = 5,
+            retry_after: float = 30,
+    ):
+        """
+        Args:
+            primary: Pool of connections to the primary, used for all writes
+            replicas: Pools of connections to read replicas
+            strategy: 'round_robin' or 'least_latency'
+            sticky_seconds: Seconds a client reads from the primary after writing
+            retry_after: Seconds a failed replica is skipped for
+        """
+        if strategy not in ('round_robin', 'least_latency'):
+            raise ValueError(f"Unknown replica strategy {strategy}")
+        self.primary: ConnectionPool = primary
+        self.replicas: List[ConnectionPool] = replicas or []
+        self.strategy: str = strategy
+        self.sticky_seconds: float = sticky_seconds
+        self.retry_after: float = retry_after
+
+        self._lock = threading.Lock()
+        self._next = 0
+        self._latency: Dict[str, float] = {pool.name: 0.0 for pool in self.replicas}
+        self._down_until: Dict[str, float] = {pool.name: 0.0 for pool in self.replicas}
+        self._stats = {'replica_reads': 0, 'primary_reads': 0, 'fallbacks': 0, 'sticky_reads': 0}
+
+    def _candidates(self) -> List[ConnectionPool]:
+        now = time.monotonic()
+        with self._lock:
+            up = [pool for pool in self.replicas if self._down_until[pool.name] <= now]
+            if self.strategy == 'least_latency':
+                up.sort(key=lambda pool: self._latency[pool.name])
+            elif up:
+                start = self._next % len(up)
+                self._next += 1
+                up = up[start:] + up[:start]
+        return up
+
+    def acquire_read(self) -> PooledConnection:
+        for pool in self._candidates():
+            started = time.monotonic()
+            try:
+                conn = pool.acquire()
+            except PoolTimeout:
+                # Busy, not down: the next read tries it again
+                with self._lock:
+                    self._stats['fallbacks'] += 1
+                continue
+            except Exception:
+                with self._lock:
+                    self._down_until[pool.name] = time.monotonic() + self.retry_after
+                    self._stats['fallbacks'] += 1
+                continue
+            elapsed = time.monotonic() - started
+            with self._lock:
+                # Exponentially weighted moving average of the checkout latency
+                self._latency[pool.name] = 0.8 * self._latency[pool.name] + 0.2 * elapsed
+                self._stats['replica_reads'] += 1
+            return conn
+        with self._lock:
+            self._stats['primary_reads'] += 1
+        return self.primary.acquire()
+
+    def record_sticky_read(self):
+        with self._lock:
+            self._stats['sticky_reads'] += 1
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            replicas = [
+                dict(pool.stats(), latency=self._latency[pool.name],
+                     down=self._down_until[pool.name] > now)
+                for pool in self.replicas
+            ]
+            return dict(self._stats, strategy=self.strategy, primary=self.primary.stats(), replicas=replicas)
+
+
+def _pool(backend, name: str) -> ConnectionPool:
+    return ConnectionPool(
+        backend,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        recycle=DB_POOL_RECYCLE,
+        timeout=DB_POOL_TIMEOUT,
+        ping=DB_POOL_PING,
+        name=name,
+    )
+
+
+def create_pool(host: str, user: str, passwd: str, db: str) -> ConnectionPool:
+    """
+    Build the primary's pool described by config.py. DB_BACKEND=sqlite swaps
+    the MySQL server for the local stand-in.
+    """
+    if DB_BACKEND == 'sqlite':
+        backend = SQLiteBackend(DB_SQLITE_PATH)
+    else:
+        backend = MySQLBackend(host=host, user=user, passwd=passwd, db=db)
+    return _pool(backend, 'primary')
+
+
+def create_router(host: str, user: str, passwd: str, db: str) -> Router:
+    """
+    Build the primary's pool and one pool per replica described by config.py
+    (DB_REPLICA_HOSTS, or DB_SQLITE_REPLICA_PATHS for the stand-in).
+    """
+    replicas = []
+    if DB_BACKEND == 'sqlite':
+        for path in DB_SQLITE_REPLICA_PATHS:
+            replicas.append(_pool(SQLiteBackend(path), path))
+    else:
+        for replica_host in DB_REPLICA_HOSTS:
+            backend = MySQLBackend(host=replica_host, user=user, passwd=passwd, db=db)
+            replicas.append(_pool(backend, replica_host))
+    return Router(
+        create_pool(host, user, passwd, db),
+        replicas,
+        strategy=DB_REPLICA_STRATEGY,
+        sticky_seconds=DB_STICKY_SECONDS,
+        retry_after=DB_REPLICA_RETRY_SECONDS,
+    )
+
+
+# Cookie holding the time until which a client that wrote reads from the primary
+STICKY_COOKIE = 'db_primary_until'
+
+
+def init_app(app, router: Router):
+    """
+    Attach the router to the Flask app, return checked out connections at the
+    end of each app context and mark clients that wrote as sticky.
+    """
+    app.extensions['db_router'] = router
+
+    @app.after_request
+    def _mark_sticky(response):
+        conn = g.get('db_conn')
+        if conn is not None and conn.wrote and router.replicas:
+            until = time.time() + router.sticky_seconds
+            response.set_cookie(STICKY_COOKIE, str(until), max_age=int(router.sticky_seconds) + 1)
+        return response
+
+    @app.teardown_appcontext
+    def _release_connection(exc):
+        for name in ('db_conn', 'db_read_conn'):
+            conn = g.pop(name, None)
+            if conn is not None:
+                conn.close()
+
+
+def get_connection() -> PooledConnection:
+    """
+    The primary connection checked out for the current app context, acquired
+    lazily on first use. Use it for writes and anything that must see them.
+    """
+    conn = g.get('db_conn')
+    if conn is None or conn.released:
+        conn = current_app.extensions['db_router'].primary.acquire()
+        g.db_conn = conn
+    return conn
+
+
+def _is_sticky() -> bool:
+    conn = g.get('db_conn')
+    if conn is not None and conn.wrote:
+        return True
+    if not has_request_context():
+        return False
+    try:
+        return float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def read_acquirer() -> Callable[[], PooledConnection]:
+    """
+    How to check out a connection for read-only queries run off the request
+    thread: from the replicas, or from the primary when this client is sticky.
+    The caller closes the connection.
+    """
+    router: Router = current_app.extensions['db_router']
+    if not router.replicas or _is_sticky():
+        return router.primary.acquire
+    return router.acquire_read
+
+
+def get_read_connection() -> PooledConnection:
+    """
+    A connection for read-only queries: a replica when one is available,
+    otherwise (or right after this client wrote) the primary.
+    """
+    router: Router = current_app.extensions['db_router']
+    if not router.replicas:
+        return get_connection()
+    if _is_sticky():
+        router.record_sticky_read()
+        return get_connection()
+    conn = g.get('db_read_conn')
+    if conn is None or conn.released:
+        conn = router.acquire_read()
+        g.db_read_conn = conn
+    return conn
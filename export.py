@@ -0,0 +1,74 @@
+import csv
+import io
+import zlib
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import queries
+import spend
+
+"""
+Streaming CSV export of the tables and reports.
+
+Rows are read from a server-side cursor in batches (queries.iter_rows) and
+written out as CSV chunks by a generator, optionally through a streaming
+gzip compressor, so an export of millions of rows runs in constant memory
+and the download starts with the header row before the query is finished.
+"""
+
+# name -> (query, columns, (query string argument, default) for each %s in the query)
+EXPORTS: Dict[str, Tuple[str, List[str], Tuple[Tuple[str, int], ...]]] = {
+    name: (query.sql(), query.columns, ()) for name, query in queries.TABLES.items()
+}
+EXPORTS.update({
+    "annual-expense": (
+        "SELECT year, total, line_count FROM expense_rollup WHERE year >= %s AND year <= %s ORDER BY year",
+        ["year", "total", "line_count"],
+        (("start", 0), ("end", 9999)),
+    ),
+    "spend-suppliers": (spend.ALL_SUPPLIERS, spend.SUPPLIER_COLUMNS, ()),
+    "spend-parts": (spend.ALL_PARTS, spend.PART_COLUMNS, ()),
+    "spend-supplier-months": (spend.ALL_SUPPLIER_MONTHS, spend.MONTH_COLUMNS, ()),
+})
+
+
+def _csv_value(value):
+    # List columns (see queries.TableQuery.decode) are written comma-separated
+    return ",".join(value) if isinstance(value, list) else value
+
+
+def csv_chunks(columns: List[str], rows: Iterable[dict],
+               batch_size: int = queries.STREAM_BATCH_SIZE) -> Iterator[bytes]:
+    """
+    The header and rows as UTF-8 CSV, one chunk per `batch_size` rows
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    # Send the header straight away so the download starts
+    yield buffer.getvalue().encode()
+    buffer.seek(0)
+    buffer.truncate()
+    count = 0
+    for row in rows:
+        writer.writerow([_csv_value(row[column]) for column in columns])
+        count += 1
+        if count == batch_size:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+            count = 0
+    if count:
+        yield buffer.getvalue().encode()
+
+
+def gzip_chunks(chunks: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+    """
+    The chunks compressed as one gzip stream. Each chunk is flushed so the
+    client keeps receiving data as rows are read.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -1,7 +1,21 @@
-from flask import Flask, render_template, request, redirect, url_for
-import MySQLdb
+from flask import Flask, request, redirect, url_for, jsonify, abort, Response, stream_with_context
 import locale
 
+import api
+import budget
+import cache
+import dashboard
+import data_version
+import db
+import export
+import metrics
+import queries
+import rollup
+import schema
+import spend
+import suppliers
+from metrics import render_template
+
 app = Flask(__name__)
 
 # Database configuration
@@ -17,44 +31,116 @@ locale.setlocale( locale.LC_ALL, 'en_CA.UTF-8' )
 PORT = 50306 #provide a unique integer value instead of XXXX, e.g., PORT = 15657
 
 
+# Connections are pooled and checked out once per request, then returned to
+# the pool when the app context is torn down. Reads may go to a replica.
+router = db.create_router(host=DB_HOST, user=DB_USER, passwd=DB_PASSWORD, db=DB_NAME)
+db.init_app(app, router)
+metrics.init_app(app)
+
+
 def get_db_connection():
-    conn = MySQLdb.connect(host=DB_HOST, user=DB_USER, passwd=DB_PASSWORD, db=DB_NAME)
-    return conn
+    return db.get_connection()
+
+
+def get_db_read_connection():
+    return db.get_read_connection()
+
+
+# Writes made outside the app, e.g. by another service or by hand, reach the
+# cache and ETags through the versions the database's triggers keep
+@app.before_request
+def sync_data_versions():
+    data_version.sync(get_db_read_connection, rollup.AGGREGATE_TABLES)
+
+
+# Tables each report is read from, for cache invalidation and ETags
+EXPENSE_TABLES = rollup.READ_TABLES
+BUDGET_TABLES = budget.BASE_TABLES + budget.YEAR_TABLES
 
 @app.route('/')
 def index():
     return render_template('index.html', name="Yusuff")
 
+def table_page(table_name, cursor, size, column=None, value=None):
+    """
+    One (optionally filtered) page of a table, served from the result cache
+    Return:
+        the rows of the page and the cursor of the next page
+    """
+    query = queries.TABLES[table_name]
+
+    def fetch():
+        predicates, params = [], []
+        if column is not None:
+            predicate, params = query.filter(column, value)
+            predicates.append(predicate)
+        cur = get_db_read_connection().cursor(dict_rows=True)
+        try:
+            return query.fetch_page(cur, cursor, size, predicates, params)
+        finally:
+            cur.close()
+    route = 'show-table' if column is None else 'filter-table'
+    return cache.results.get_or_compute(
+        route, (table_name, column, value, cursor, size), query.tables, fetch
+    )
+
+
 #show specific table
 @app.route('/show-table', methods=['GET', 'POST'])
 def tables():
-    conn = get_db_connection()
-    cur = conn.cursor(MySQLdb.cursors.DictCursor)
+    #Get the submitted table name from our form, or from the query string when paging
     if request.method == 'POST':
-        #Get the submitted table name from our form
-        data = []
-        arr =[]
         table_name = request.form['name']
-        if table_name == "suppliers":
-            cur.execute(f"""SELECT supplier._id, name, email, telephone.tel 
-            FROM supplier, telephone WHERE supplier._id = telephone.sup_id;""")
-            data = cur.fetchall()
-            arr = ["_id", "name", "email", "tel"]
-        elif table_name == "parts":
-            cur.execute(f"SELECT * FROM {table_name}")
-            data = cur.fetchall()
-            arr = ["_id","price","description"]
-        elif table_name == "orders":
-            cur.execute("""SELECT orders.order_date, orders.sup_id, part_orders.part_id, part_orders.qty
-            FROM part_orders, orders WHERE part_orders.order_id = orders._id;""")
-            data = cur.fetchall()
-            arr =["order_date","sup_id","part_id","qty"]
-        cur.close()
-        conn.close()
-        # return to frontend the data in table_name and the corresponding columns in table_name
-        return render_template('show_table.html', data=data, columns=arr)
     else:
+        table_name = request.args.get('name')
+    query = queries.TABLES.get(table_name)
+    if query is None:
         return render_template('show_table.html', data=[], columns=[])
+    size = queries.page_size(request.values.get('page_size'))
+    if request.values.get('stream'):
+        # Stream every row from an unbuffered server-side cursor so memory stays
+        # flat and the first rows go out before the query has finished
+        cur = get_db_read_connection().cursor(dict_rows=True, server_side=True)
+        cur.execute(query.sql())
+        context = dict(data=map(query.decode, queries.iter_rows(cur)), columns=query.columns,
+                       table_name=table_name)
+        app.update_template_context(context)
+        stream = app.jinja_env.get_template('show_table.html').stream(context)
+        stream.enable_buffering(queries.STREAM_BATCH_SIZE)
+        return Response(stream_with_context(stream), mimetype='text/html')
+    try:
+        data, next_cursor = table_page(table_name, request.values.get('cursor'), size)
+    except queries.InvalidCursor as e:
+        abort(400, str(e))
+    next_url = None
+    if next_cursor:
+        next_url = url_for('tables', name=table_name, cursor=next_cursor, page_size=size)
+    # return to frontend the page of table_name, the corresponding columns and the next page's link
+    return render_template('show_table.html', data=data, columns=query.columns,
+                           table_name=table_name, next_url=next_url)
+
+
+#filter a table on one of its whitelisted columns
+@app.route('/filter-table/<string:table_name>', methods=['GET', 'POST'])
+def filter_table(table_name):
+    query = queries.TABLES.get(table_name)
+    if query is None:
+        abort(404)
+    #The form sends the capitalized column name
+    column = request.values.get('filter_column', '').lower()
+    value = request.values.get('filter_value', '')
+    size = queries.page_size(request.values.get('page_size'))
+    cursor = request.values.get('cursor')
+    try:
+        data, next_cursor = table_page(table_name, cursor, size, column, value)
+    except (queries.InvalidFilter, queries.InvalidCursor) as e:
+        abort(400, str(e))
+    next_url = None
+    if next_cursor:
+        next_url = url_for('filter_table', table_name=table_name, filter_column=column,
+                           filter_value=value, cursor=next_cursor, page_size=size)
+    return render_template('show_table.html', data=data, columns=query.columns,
+                           table_name=table_name, next_url=next_url)
 
 
 #shows expenses page and redirects user to request
@@ -71,18 +157,32 @@ def get_expenses():
 # GET Annual Expenses for parts from start to end year
 @app.route("/get-annual-expense/<string:start>/<string:end>", methods=['GET'])
 def total_expense(start, end):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    #SQL query to get total expense for each YEAR
-    cur.execute(f"""SELECT YEAR(order_date) as year,  sum(price*qty) FROM 
-    part_orders, parts, orders WHERE 
-    part_orders.part_id = parts._id AND orders._id = part_orders.order_id AND 
-    YEAR(order_date)>={start} AND YEAR(order_date)<={end} GROUP BY YEAR(order_date);""")
-    data = cur.fetchall()
-    cur.close()
-    conn.close()
+    try:
+        start, end = int(start), int(end)
+    except ValueError:
+        abort(400, "Start and end must be years")
+    #Yearly totals are read from the expense rollup, one row per year
+    data = cache.results.get_or_compute(
+        'get-annual-expense', (start, end), EXPENSE_TABLES,
+        lambda: rollup.yearly_totals(get_db_read_connection(), start, end),
+    )
     return render_template('annual_expense.html', data=data, currency=locale.currency)
 
+def budget_scenarios(years, rates, base_year=None, breakdown=None):
+    """
+    The projections of every rate in `rates`, from base_year or the latest
+    complete year. The base year's spend is cached until orders change.
+    Return:
+        the base year and one scenario per rate, see budget.project
+    """
+    if base_year is None:
+        base_year = budget.latest_complete_year(get_db_read_connection)
+        if base_year is None:
+            return None, []
+    base = budget.base_year(get_db_read_connection, base_year)
+    return base_year, budget.project(base, rates, years, breakdown)
+
+
 #Budget Projection
 @app.route("/project-budget", methods=['GET', 'POST'])
 def project_budget():
@@ -92,24 +192,11 @@ def project_budget():
         #Get number of years and inflation rate
         years = int(request.form["numYears"])
         rate = float(request.form["rate"])
-        arr = []
-        conn = get_db_connection()
-        cur = conn.cursor()
-        #SQL query to get the recent expense 
-        cur.execute("""SELECT YEAR(order_date) as year, sum(price*qty) 
-        FROM part_orders, parts, orders 
-        WHERE part_orders.part_id = parts._id AND orders._id = part_orders.order_id AND YEAR(order_date)=2022
-        GROUP BY YEAR(order_date);""")
-        data = cur.fetchall()
-        recent_year = data[0][0]
-        recent_expense = data[0][1]
-        total_rate = (100+rate)/100
-        #Add tuple containg new year and projected expenses for the year
-        for i in range (1, years+1):
-            arr.append((recent_year+i, float("{:.2f}".format((recent_expense)*(total_rate)**(i)))))
-        cur.close()
-        conn.close()
-        return render_template('project_budget.html', data=arr, currency=locale.currency)
+        #Project from the chosen base year, or the latest complete year
+        base_year = int(request.form["baseYear"]) if request.form.get("baseYear") else None
+        base_year, scenarios = budget_scenarios(years, [rate], base_year)
+        arr = scenarios[0]["rows"] if scenarios else []
+        return render_template('project_budget.html', data=arr, base_year=base_year, currency=locale.currency)
 
 @app.route("/add-supplier", methods=['GET', 'POST'])
 def add_supplier():
@@ -117,33 +204,348 @@ def add_supplier():
         return render_template('add_supplier.html', data=[])
     else:
         _id = request.form["id"]
-        name = request.form["name"]
-        email = request.form["email"]
-        numbers = request.form["numbers"].split(",")
         conn = get_db_connection()
-        cur = conn.cursor()
-        #Check if supplier exists with _id
-        cur.execute(f"SELECT * FROM supplier WHERE _id = {_id}")
-        data = cur.fetchall()
-        #If supplier Doesn't exist
-        if data == ():
-            #Insert  into supplier relation
-            cur.execute(f"INSERT INTO supplier(_id, name, email) VALUES ({_id}, '{name}', '{email}')")
-            #Insert numbers into telephone relation
-            for number in numbers:
-                cur.execute(f"INSERT INTO telephone(sup_id, tel ) VALUES ({_id}, '{number}')")
-            conn.commit()
-            cur.execute(f"""SELECT supplier._id, name, email, telephone.tel 
-            FROM supplier, telephone WHERE supplier._id = telephone.sup_id AND supplier._id={_id} ;""")
-            data = cur.fetchall()
-            print(data)
-            arr = ["_id", "name", "email", "tel"]
-            cur.close()
-            conn.close()
-            return render_template('add_supplier.html', data=data, columns=arr)
-        else:
-            return render_template('add_supplier.html', data=[], error="Supplier already exists please try different _id")
+        #Insert into supplier and telephone relations through the batched path
+        inserted, errors = suppliers.import_suppliers(conn, [{
+            "id": _id,
+            "name": request.form["name"],
+            "email": request.form["email"],
+            "numbers": request.form["numbers"],
+        }])
+        if not inserted:
+            return render_template('add_supplier.html', data=[], error=errors[0][1])
+        #Read the new supplier back as one row with its phone list
+        query = queries.TABLES["suppliers"]
+        cur = conn.cursor(dict_rows=True)
+        cur.execute(query.sql(["supplier._id = %s"]), (inserted[0],))
+        data = [query.decode(row) for row in cur.fetchall()]
+        cur.close()
+        return render_template('add_supplier.html', data=data, columns=query.columns)
+
+
+#Bulk supplier import from a CSV (id,name,email,numbers) or JSON upload
+@app.route("/import-suppliers", methods=['POST'])
+def import_suppliers():
+    upload = request.files.get("file")
+    if upload is not None:
+        body = upload.read()
+        is_json = upload.filename.lower().endswith(".json")
+    else:
+        body = request.get_data()
+        is_json = request.is_json
+    try:
+        # utf-8-sig drops the byte order mark spreadsheet programs write
+        text = body.decode("utf-8-sig")
+        rows = suppliers.parse_json(text) if is_json else suppliers.parse_csv(text)
+    except UnicodeDecodeError:
+        abort(400, "The file must be UTF-8 encoded")
+    except ValueError as e:
+        abort(400, str(e))
+    chunk_size = request.args.get("chunk_size", suppliers.DEFAULT_CHUNK_SIZE, type=int)
+    inserted, errors = suppliers.import_suppliers(get_db_connection(), rows, max(1, chunk_size))
+    return jsonify(
+        inserted=len(inserted),
+        errors=[{"row": i, "error": error} for i, error in errors],
+    )
+
+
+#JSON API: a page of a table, ?cursor=, ?page_size=, ?columns=a,b
+@app.route("/api/show-table/<string:table_name>", methods=['GET'])
+def api_table(table_name):
+    query = queries.TABLES.get(table_name)
+    if query is None:
+        abort(404)
+    size = queries.page_size(request.args.get('page_size'))
+    cursor = request.args.get('cursor')
+    try:
+        columns = api.projected_columns(query.columns)
+    except ValueError as e:
+        abort(400, str(e))
+    etag = api.etag_for('api-show-table', (table_name, cursor, size), query.tables, columns)
+    cached = api.not_modified(etag)
+    if cached is not None:
+        return cached
+    try:
+        data, next_cursor = table_page(table_name, cursor, size)
+    except (ValueError, queries.InvalidCursor) as e:
+        abort(400, str(e))
+    return api.json_response(
+        {"columns": columns, "rows": api.rows_as_dicts(data, columns), "next_cursor": next_cursor},
+        etag,
+    )
+
+
+#JSON API: yearly expenses from start to end year
+@app.route("/api/annual-expense/<string:start>/<string:end>", methods=['GET'])
+def api_total_expense(start, end):
+    try:
+        start, end = int(start), int(end)
+    except ValueError:
+        abort(400, "Start and end must be years")
+    available = ["year", "total"]
+    try:
+        columns = api.projected_columns(available)
+    except ValueError as e:
+        abort(400, str(e))
+    etag = api.etag_for('api-annual-expense', (start, end), EXPENSE_TABLES, columns)
+    cached = api.not_modified(etag)
+    if cached is not None:
+        return cached
+    data = cache.results.get_or_compute(
+        'get-annual-expense', (start, end), EXPENSE_TABLES,
+        lambda: rollup.yearly_totals(get_db_read_connection(), start, end),
+    )
+    return api.json_response({"rows": api.rows_as_dicts(data, columns, available)}, etag)
+
+
+#JSON API: budget projection, ?numYears= and one or more ?rate=, optionally
+#?baseYear= and ?breakdown=part|supplier. Every scenario shares one base query.
+@app.route("/api/project-budget", methods=['GET'])
+def api_project_budget():
+    try:
+        years = int(request.args["numYears"])
+        rates = [float(rate) for arg in request.args.getlist("rate") for rate in arg.split(",")]
+        base_year = int(request.args["baseYear"]) if request.args.get("baseYear") else None
+    except (KeyError, ValueError):
+        abort(400, "numYears and rate are required numbers")
+    if not rates:
+        abort(400, "numYears and rate are required numbers")
+    breakdown = request.args.get("breakdown") or None
+    if breakdown is not None and breakdown not in budget.BREAKDOWNS:
+        abort(400, f"breakdown must be one of {', '.join(budget.BREAKDOWNS)}")
+    available = ["year", "projected"]
+    try:
+        columns = api.projected_columns(available)
+    except ValueError as e:
+        abort(400, str(e))
+    etag = api.etag_for('api-project-budget', (years, tuple(rates), base_year, breakdown), BUDGET_TABLES, columns)
+    cached = api.not_modified(etag)
+    if cached is not None:
+        return cached
+    base_year, scenarios = budget_scenarios(years, rates, base_year, breakdown)
+    for scenario in scenarios:
+        scenario["rows"] = api.rows_as_dicts(scenario["rows"], columns, available)
+    payload = {"base_year": base_year, "scenarios": scenarios}
+    #The first scenario's rows stay at the top level for single-rate clients
+    payload["rows"] = scenarios[0]["rows"] if scenarios else []
+    return api.json_response(payload, etag)
+
+
+def top_n():
+    try:
+        n = int(request.args.get("top", 10))
+    except ValueError:
+        abort(400, "top must be a number")
+    return max(1, min(n, queries.MAX_PAGE_SIZE))
+
+
+def spend_rows(route, params, tables, compute, available):
+    """
+    A JSON API response of rows read from the spend aggregates, with an ETag
+    and served from the result cache
+    """
+    try:
+        columns = api.projected_columns(available)
+    except ValueError as e:
+        abort(400, str(e))
+    etag = api.etag_for(route, params, tables, columns)
+    cached = api.not_modified(etag)
+    if cached is not None:
+        return cached
+    data = cache.results.get_or_compute(route, params, tables, compute)
+    return api.json_response({"rows": api.rows_as_dicts(data, columns, available)}, etag)
+
+
+#JSON API: the ?top=N suppliers by spend
+@app.route("/api/spend/suppliers", methods=['GET'])
+def api_top_suppliers():
+    n = top_n()
+    return spend_rows(
+        'api-spend-suppliers', (n,), spend.READ_TABLES + ('supplier',),
+        lambda: spend.top_suppliers(get_db_read_connection(), n), spend.SUPPLIER_COLUMNS,
+    )
+
+
+#JSON API: the ?top=N parts by spend
+@app.route("/api/spend/parts", methods=['GET'])
+def api_top_parts():
+    n = top_n()
+    return spend_rows(
+        'api-spend-parts', (n,), spend.READ_TABLES + ('parts',),
+        lambda: spend.top_parts(get_db_read_connection(), n), spend.PART_COLUMNS,
+    )
+
+
+#JSON API: the ?top=N suppliers by spend in a month
+@app.route("/api/spend/months/<int:year>/<int:month>", methods=['GET'])
+def api_top_suppliers_in_month(year, month):
+    if not 1 <= month <= 12:
+        abort(400, "month must be 1 to 12")
+    n = top_n()
+    return spend_rows(
+        'api-spend-month', (year, month, n), spend.READ_TABLES,
+        lambda: spend.top_suppliers_in_month(get_db_read_connection(), year, month, n), spend.MONTH_COLUMNS,
+    )
+
+
+#JSON API: a supplier's total spend and its spend per month, optionally ?start= and ?end= years
+@app.route("/api/spend/suppliers/<int:sup_id>", methods=['GET'])
+def api_supplier_spend(sup_id):
+    try:
+        start = int(request.args.get("start", 0))
+        end = int(request.args.get("end", 9999))
+    except ValueError:
+        abort(400, "Start and end must be years")
+    tables = spend.READ_TABLES + ('supplier',)
+    etag = api.etag_for('api-spend-supplier', (sup_id, start, end), tables)
+    cached = api.not_modified(etag)
+    if cached is not None:
+        return cached
+
+    def fetch():
+        conn = get_db_read_connection()
+        return spend.supplier_spend(conn, sup_id), spend.supplier_months(conn, sup_id, start, end)
+    total, months = cache.results.get_or_compute('api-spend-supplier', (sup_id, start, end), tables, fetch)
+    if total is None:
+        abort(404)
+    return api.json_response({
+        "supplier": api.rows_as_dicts([total], spend.SUPPLIER_COLUMNS, spend.SUPPLIER_COLUMNS)[0],
+        "months": api.rows_as_dicts(months, spend.MONTH_COLUMNS, spend.MONTH_COLUMNS),
+    }, etag)
+
+
+#JSON API: a part's total spend
+@app.route("/api/spend/parts/<int:part_id>", methods=['GET'])
+def api_part_spend(part_id):
+    tables = spend.READ_TABLES + ('parts',)
+    etag = api.etag_for('api-spend-part', (part_id,), tables)
+    cached = api.not_modified(etag)
+    if cached is not None:
+        return cached
+    row = cache.results.get_or_compute(
+        'api-spend-part', (part_id,), tables,
+        lambda: spend.part_spend(get_db_read_connection(), part_id),
+    )
+    if row is None:
+        abort(404)
+    return api.json_response(api.rows_as_dicts([row], spend.PART_COLUMNS, spend.PART_COLUMNS)[0], etag)
+
+
+#Stream a table or report as CSV, e.g. /export/orders.csv or
+#/export/annual-expense.csv?start=2016&end=2023. ?gzip=1 compresses it.
+@app.route("/export/<string:name>.csv", methods=['GET'])
+def export_csv(name):
+    if name not in export.EXPORTS:
+        abort(404)
+    sql, columns, args = export.EXPORTS[name]
+    try:
+        params = [int(request.args.get(arg, default)) for arg, default in args]
+    except ValueError:
+        abort(400, f"{', '.join(arg for arg, _ in args)} must be numbers")
+    #Rows come off an unbuffered server-side cursor a batch at a time
+    conn = get_db_read_connection()
+    cur = conn.cursor(dict_rows=True, server_side=True)
+    cur.execute(rollup.readable(conn, sql), params)
+    rows = queries.iter_rows(cur)
+    if name in queries.TABLES:
+        rows = map(queries.TABLES[name].decode, rows)
+    chunks = export.csv_chunks(columns, rows)
+    filename = f"{name}.csv"
+    mimetype = 'text/csv'
+    if request.args.get('gzip'):
+        chunks = export.gzip_chunks(chunks)
+        filename += ".gz"
+        mimetype = 'application/gzip'
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+#Every report on one page, each section read concurrently
+@app.route("/dashboard", methods=['GET'])
+def show_dashboard():
+    sections = dashboard.collect(db.read_acquirer())
+    return render_template('dashboard.html', sections=sections, currency=locale.currency)
+
+
+#JSON API: the dashboard sections
+@app.route("/api/dashboard", methods=['GET'])
+def api_dashboard():
+    return api.json_response(dashboard.collect(db.read_acquirer()))
+
+
+#Connection pool statistics
+@app.route("/db-pool-stats", methods=['GET'])
+def pool_stats():
+    return jsonify(router.stats())
+
+
+#Result cache statistics
+@app.route("/cache-stats", methods=['GET'])
+def cache_stats():
+    return jsonify(cache.results.stats())
+
+
+#Prometheus metrics
+@app.route("/metrics", methods=['GET'])
+def prometheus_metrics():
+    return Response(
+        metrics.expose(router, cache.results), mimetype='text/plain; version=0.0.4'
+    )
+
+
+#Recompute the expense rollup: flask --app main rebuild-expense-rollup
+@app.cli.command('rebuild-expense-rollup')
+def rebuild_expense_rollup():
+    years = rollup.rebuild(get_db_connection())
+    print(f"Rebuilt expense rollup for {years} years")
+
+
+#Compare the expense rollup with the live aggregate: flask --app main check-expense-rollup
+@app.cli.command('check-expense-rollup')
+def check_expense_rollup():
+    mismatches = rollup.check(get_db_connection())
+    for year, rolled, live in mismatches:
+        print(f"{year}: rollup {rolled} != live {live}")
+    if mismatches:
+        raise SystemExit(1)
+    print("Expense rollup is consistent")
+
+
+#Recompute the spend aggregates: flask --app main rebuild-spend-aggregates
+@app.cli.command('rebuild-spend-aggregates')
+def rebuild_spend_aggregates():
+    for table, rows in spend.rebuild(get_db_connection()).items():
+        print(f"Rebuilt {table} with {rows} rows")
+
+
+#Compare the spend aggregates with the live aggregates: flask --app main check-spend-aggregates
+@app.cli.command('check-spend-aggregates')
+def check_spend_aggregates():
+    mismatches = spend.check(get_db_connection())
+    for table, key, stored, live in mismatches:
+        print(f"{table} {key}: stored {stored} != live {live}")
+    if mismatches:
+        raise SystemExit(1)
+    print("Spend aggregates are consistent")
+
+
+#Create missing tables and indexes: flask --app main migrate-db
+@app.cli.command('migrate-db')
+def migrate_db():
+    for name in schema.migrate(get_db_connection()):
+        print(f"Created index {name}")
+
 
+#Fail if any route query falls back to a full table scan: flask --app main check-query-plans
+@app.cli.command('check-query-plans')
+def check_query_plans():
+    failures = schema.check_plans(get_db_connection())
+    for route, table in failures:
+        print(f"{route}: full scan of {table}")
+    if failures:
+        raise SystemExit(1)
+    print("No route query falls back to a full scan")
 
 
 if __name__ == '__main__':
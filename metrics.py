@@ -0,0 +1,248 @@
+import bisect
+import logging
+import re
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from flask import g, has_request_context, request
+from flask import render_template as flask_render_template
+
+from config import METRICS_SLOW_QUERY_SECONDS
+
+"""
+Latency instrumentation, exposed in the Prometheus text format at /metrics.
+
+Every request records its duration and response size by route, every query
+its execution time and rows fetched by route and query, every new database
+connection its connect time, and every template its render time. Queries
+slower than METRICS_SLOW_QUERY_SECONDS are also logged.
+"""
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROW_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+slow_query_log = logging.getLogger('muc.slow_query')
+
+
+class Histogram:
+    """
+    A Prometheus histogram with one series per combination of label values.
+    """
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...], buckets: tuple):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # label values -> [bucket counts..., sum, count]
+        self._series: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *label_values: str):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def expose(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, list(series)) for key, series in self._series.items())
+        for label_values, series in items:
+            labels = [f'{k}="{_escape(v)}"' for k, v in zip(self.labels, label_values)]
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                bucket = labels + ['le="%s"' % bound]
+                lines.append(f"{self.name}_bucket{_labels(bucket)} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(labels + [INF])} {series[-1]}")
+            lines.append(f"{self.name}_sum{_labels(labels)} {series[-2]}")
+            lines.append(f"{self.name}_count{_labels(labels)} {series[-1]}")
+        return "\n".join(lines)
+
+
+INF = 'le="+Inf"'
+
+
+def _labels(labels: list) -> str:
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REQUEST_SECONDS = Histogram(
+    'muc_request_duration_seconds', 'Time to handle a request', ('route', 'method'), LATENCY_BUCKETS)
+RESPONSE_BYTES = Histogram(
+    'muc_response_size_bytes', 'Size of response bodies', ('route',), SIZE_BUCKETS)
+CONNECT_SECONDS = Histogram(
+    'muc_db_connect_seconds', 'Time to open a database connection', ('pool',), LATENCY_BUCKETS)
+QUERY_SECONDS = Histogram(
+    'muc_db_query_seconds', 'Time to execute a query', ('route', 'query'), LATENCY_BUCKETS)
+FETCH_SECONDS = Histogram(
+    'muc_db_fetch_seconds', 'Time spent fetching query results', ('route', 'query'), LATENCY_BUCKETS)
+ROWS_FETCHED = Histogram(
+    'muc_db_rows_fetched', 'Rows fetched per query', ('route', 'query'), ROW_BUCKETS)
+RENDER_SECONDS = Histogram(
+    'muc_template_render_seconds', 'Time to render a template', ('route', 'template'), LATENCY_BUCKETS)
+
+HISTOGRAMS = [
+    REQUEST_SECONDS, RESPONSE_BYTES, CONNECT_SECONDS, QUERY_SECONDS,
+    FETCH_SECONDS, ROWS_FETCHED, RENDER_SECONDS,
+]
+
+
+def current_route() -> str:
+    if has_request_context() and request.url_rule is not None:
+        return request.url_rule.rule
+    return 'none'
+
+
+_PLACEHOLDER_LIST = re.compile(r"\(\s*%s(\s*,\s*%s)*\s*\)")
+_NUMBER = re.compile(r"\b\d+\b")
+_SPACE = re.compile(r"\s+")
+
+
+def query_label(sql: str) -> str:
+    """
+    A low-cardinality label for a query: whitespace collapsed, numbers and
+    IN (...) placeholder lists folded, truncated.
+    """
+    sql = _SPACE.sub(" ", sql).strip()
+    sql = _PLACEHOLDER_LIST.sub("(...)", sql)
+    sql = _NUMBER.sub("?", sql)
+    return sql[:120]
+
+
+class InstrumentedCursor:
+    """
+    Wraps a cursor to time its queries and fetches and count the rows read.
+    """
+    __slots__ = ('cur', 'label', 'route', 'rows', 'fetch_seconds')
+
+    def __init__(self, cur):
+        self.cur = cur
+        self.label: Optional[str] = None
+        self.route: str = current_route()
+        # None until the current query's results are fetched
+        self.rows: Optional[int] = None
+        self.fetch_seconds: float = 0.0
+
+    def _flush(self):
+        if self.label is not None and self.rows is not None:
+            ROWS_FETCHED.observe(self.rows, self.route, self.label)
+            FETCH_SECONDS.observe(self.fetch_seconds, self.route, self.label)
+        self.label = None
+        self.rows = None
+        self.fetch_seconds = 0.0
+
+    def _timed(self, method, query, args):
+        self._flush()
+        label = query_label(query)
+        started = time.perf_counter()
+        try:
+            return method(query, args)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.label = label
+            QUERY_SECONDS.observe(elapsed, self.route, label)
+            if METRICS_SLOW_QUERY_SECONDS is not None and elapsed >= METRICS_SLOW_QUERY_SECONDS:
+                slow_query_log.warning("%.3fs %s %s", elapsed, self.route, _SPACE.sub(" ", query))
+
+    def execute(self, query: str, args=None):
+        return self._timed(self.cur.execute, query, args)
+
+    def executemany(self, query: str, args):
+        return self._timed(self.cur.executemany, query, args)
+
+    def _fetched(self, started: float, rows: int):
+        self.fetch_seconds += time.perf_counter() - started
+        self.rows = (self.rows or 0) + rows
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = self.cur.fetchone()
+        self._fetched(started, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size: int = 1):
+        started = time.perf_counter()
+        rows = self.cur.fetchmany(size)
+        self._fetched(started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = self.cur.fetchall()
+        self._fetched(started, len(rows))
+        return rows
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def close(self):
+        self._flush()
+        self.cur.close()
+
+    def __getattr__(self, name):
+        return getattr(self.cur, name)
+
+
+def render_template(template_name: str, **context) -> str:
+    """
+    flask.render_template, timed
+    """
+    started = time.perf_counter()
+    try:
+        return flask_render_template(template_name, **context)
+    finally:
+        RENDER_SECONDS.observe(time.perf_counter() - started, current_route(), template_name)
+
+
+def init_app(app):
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            route = current_route()
+            REQUEST_SECONDS.observe(time.perf_counter() - started, route, request.method)
+            if response.content_length is not None:
+                RESPONSE_BYTES.observe(response.content_length, route)
+        return response
+
+
+def _gauges(prefix: str, stats: dict, labels: Optional[list] = None) -> list:
+    return [
+        f"{prefix}_{key}{_labels(labels or [])} {value}"
+        for key, value in sorted(stats.items())
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+    ]
+
+
+def expose(router=None, result_cache=None) -> str:
+    """
+    Every histogram, plus the pool and cache counters, in the Prometheus text format
+    """
+    out = [histogram.expose() for histogram in HISTOGRAMS]
+    if router is not None:
+        stats = router.stats()
+        for pool in [stats['primary']] + stats['replicas']:
+            out += _gauges('muc_db_pool', pool, [f'pool="{_escape(pool["name"])}"'])
+    if result_cache is not None:
+        out += _gauges('muc_result_cache', result_cache.stats())
+    return "\n".join(out) + "\n"
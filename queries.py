@@ -0,0 +1,257 @@
+import base64
+import datetime
+import decimal
+import json
+from typing import Optional, Dict, List, Tuple
+
+"""
+Read queries for the tables shown by /show-table and the reports.
+
+Tables are paged with keyset (seek) pagination: each page continues strictly
+after the sort key of the last row of the previous page, so fetching page N
+costs the same as fetching page 1 instead of scanning and discarding N pages
+of rows the way OFFSET does.
+"""
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+# Joins the values of a list column. A control character, so it cannot occur
+# in a value the way a comma in a phone number can.
+LIST_SEPARATOR = '\x1f'
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class InvalidFilter(ValueError):
+    pass
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("!", "!!").replace("%", "!%").replace("_", "!_")
+
+
+class TableQuery:
+    """
+    A table as shown in the app: the SELECT producing its rows, the columns
+    displayed, the (expression, column) pairs forming its unique sort key, the
+    whitelist of columns it can be filtered on and the tables it reads.
+    """
+    __slots__ = ('select', 'where', 'columns', 'keys', 'filters', 'tables', 'lists')
+
+    def __init__(
+            self, select: str,
+            columns: List[str],
+            keys: List[Tuple[str, str]],
+            tables: Tuple[str, ...],
+            where: Optional[str] = None,
+            filters: Optional[Dict[str, Tuple[str, str]]] = None,
+            lists: Tuple[str, ...] = (),
+    ):
+        self.select: str = select
+        self.tables: Tuple[str, ...] = tables
+        self.where: Optional[str] = where
+        self.columns: List[str] = columns
+        self.keys: List[Tuple[str, str]] = keys
+        # column -> (expression, 'eq' | 'int' | 'prefix'), each backed by an index.
+        # An expression with a {} is a predicate the comparison is placed into.
+        self.filters: Dict[str, Tuple[str, str]] = filters or {}
+        # Columns aggregated into a LIST_SEPARATOR-separated string, returned as lists
+        self.lists: Tuple[str, ...] = lists
+
+    def filter(self, column: str, value: str) -> Tuple[str, list]:
+        """
+        The predicate and parameters matching rows whose `column` equals
+        `value` ('eq' and 'int' filters) or starts with it ('prefix' filters).
+        """
+        if column not in self.filters:
+            raise InvalidFilter(f"Cannot filter by {column}")
+        expr, mode = self.filters[column]
+        if '{}' not in expr:
+            expr += " {}"
+        value = value.strip()
+        if mode == 'prefix':
+            return expr.format("LIKE %s ESCAPE '!'"), [_escape_like(value) + "%"]
+        if mode == 'int':
+            try:
+                return expr.format("= %s"), [int(value)]
+            except ValueError:
+                raise InvalidFilter(f"{column} must be an integer")
+        return expr.format("= %s"), [value]
+
+    def sql(self, predicates: Optional[List[str]] = None, limit: Optional[int] = None) -> str:
+        where = [self.where] if self.where else []
+        where += predicates or []
+        out = self.select
+        if where:
+            out += " WHERE " + " AND ".join(where)
+        out += " ORDER BY " + ", ".join(expr for expr, _ in self.keys)
+        if limit is not None:
+            out += f" LIMIT {int(limit)}"
+        return out
+
+    def after(self, values: list) -> Tuple[str, list]:
+        """
+        The predicate selecting rows sorting strictly after `values`, expanded
+        as (a > x) OR (a = x AND b > y) ... so each branch can seek an index.
+        """
+        if len(values) != len(self.keys):
+            raise InvalidCursor("Cursor does not match the table's sort key")
+        branches = []
+        params = []
+        for i, (expr, _) in enumerate(self.keys):
+            terms = [f"{e} = %s" for e, _ in self.keys[:i]] + [f"{expr} > %s"]
+            branches.append("(" + " AND ".join(terms) + ")")
+            params += values[:i + 1]
+        return "(" + " OR ".join(branches) + ")", params
+
+    def key_of(self, row: dict) -> list:
+        return [row[column] for _, column in self.keys]
+
+    def decode(self, row: dict) -> dict:
+        """
+        The row with its list columns split into lists
+        """
+        for column in self.lists:
+            row[column] = row[column].split(LIST_SEPARATOR) if row[column] else []
+        return row
+
+    def fetch_page(
+            self, cur, cursor: Optional[str], page_size: int,
+            predicates: Optional[List[str]] = None, params: Optional[list] = None,
+    ):
+        """
+        Fetch one page of rows after `cursor` using a dict cursor.
+        Return:
+            the rows of the page and the cursor of the next page (None on the last page)
+        """
+        predicates = list(predicates or [])
+        params = list(params or [])
+        if cursor:
+            predicate, after_params = self.after(decode_cursor(cursor))
+            predicates.append(predicate)
+            params += after_params
+        # Read one extra row to find out whether there is a next page
+        cur.execute(self.sql(predicates, page_size + 1), params)
+        rows = [self.decode(row) for row in cur.fetchall()]
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            return rows, encode_cursor(self.key_of(rows[-1]))
+        return rows, None
+
+
+# One row per supplier with its phone numbers grouped into one column. The
+# correlated subquery seeks idx_telephone_sup once per supplier on the page
+# and, unlike joining telephone, keeps the suppliers without a phone. MySQL
+# cuts the list at group_concat_max_len, which db.MySQLBackend raises.
+SUPPLIERS_GROUPED = f"""SELECT supplier._id, name, email,
+(SELECT GROUP_CONCAT(tel SEPARATOR '{LIST_SEPARATOR}') FROM telephone WHERE telephone.sup_id = supplier._id) AS phones
+FROM supplier"""
+
+# Suppliers with a phone number matching the comparison, through idx_telephone_tel
+_HAS_PHONE = "supplier._id IN (SELECT sup_id FROM telephone WHERE tel {})"
+
+TABLES = {
+    "suppliers": TableQuery(
+        select=SUPPLIERS_GROUPED,
+        columns=["_id", "name", "email", "phones"],
+        tables=("supplier", "telephone"),
+        keys=[("supplier._id", "_id")],
+        filters={
+            "_id": ("supplier._id", "int"),
+            "name": ("name", "prefix"),
+            "email": ("email", "prefix"),
+            "phones": (_HAS_PHONE, "prefix"),
+            "tel": (_HAS_PHONE, "prefix"),
+        },
+        lists=("phones",),
+    ),
+    "parts": TableQuery(
+        select="SELECT _id, price, description FROM parts",
+        columns=["_id", "price", "description"],
+        tables=("parts",),
+        keys=[("_id", "_id")],
+        filters={
+            "_id": ("_id", "int"),
+            "price": ("price", "eq"),
+            "description": ("description", "prefix"),
+        },
+    ),
+    "orders": TableQuery(
+        select="""SELECT orders.order_date, orders.sup_id, part_orders.part_id, part_orders.qty,
+        orders._id AS order_id FROM part_orders, orders""",
+        where="part_orders.order_id = orders._id",
+        columns=["order_date", "sup_id", "part_id", "qty"],
+        tables=("orders", "part_orders"),
+        keys=[("orders.order_date", "order_date"), ("orders._id", "order_id"),
+              ("part_orders.part_id", "part_id")],
+        filters={
+            "order_date": ("orders.order_date", "eq"),
+            "sup_id": ("orders.sup_id", "int"),
+            "part_id": ("part_orders.part_id", "int"),
+        },
+    ),
+}
+
+# Expense of the orders placed in a half-open date range per supplier and
+# part, see schema.year_range. The budget projection's only query.
+EXPENSE_BY_SUPPLIER_PART = """SELECT orders.sup_id, part_orders.part_id, SUM(price*qty)
+FROM orders, part_orders, parts
+WHERE orders._id = part_orders.order_id AND part_orders.part_id = parts._id
+AND order_date >= %s AND order_date < %s
+GROUP BY orders.sup_id, part_orders.part_id"""
+
+
+def json_default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    raise TypeError(f"Cannot encode {type(value)} as JSON")
+
+
+def encode_cursor(values: list) -> str:
+    raw = json.dumps(values, default=json_default, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except ValueError:
+        raise InvalidCursor("Malformed page cursor")
+    if not isinstance(values, list):
+        raise InvalidCursor("Malformed page cursor")
+    return values
+
+
+def page_size(value: Optional[str]) -> int:
+    """
+    Parse a requested page size, falling back to the default and clamping it
+    to MAX_PAGE_SIZE.
+    """
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def iter_rows(cur, batch_size: int = STREAM_BATCH_SIZE):
+    """
+    Yield the rows of an executed (ideally server-side) cursor in batches so
+    only `batch_size` rows are held in memory at a time. Closes the cursor
+    once exhausted, which an unbuffered cursor needs before the connection
+    can be reused.
+    """
+    try:
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        cur.close()
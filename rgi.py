@@ -1,12 +1,14 @@
+import asyncio
 import os
 import csv
 import re
-import subprocess
-from functools import lru_cache
 from pathlib import Path
 from typing import Optional, List
 
-from config import CONDA_EXE_NAME, CONDA_RGI_NAME
+import tool_resolver
+import tool_runner
+from tool_resolver import PROGRAM_VERSION_NA
+from config import CONDA_RGI_NAME, RGI_TIMEOUT, TOOL_VERSION_TIMEOUT
 
 class RgiParams:
     __slots__ = (
@@ -49,6 +51,22 @@ class RgiParams:
         self.orf_finder: Optional[str] = orf_finder
         self.split_prodigal_jobs: Optional[bool] = split_prodigal_jobs
 
+    def path_log(self, stream: str) -> Path:
+        """
+        The file RGI's stdout or stderr is written to
+        """
+        return Path(f"{self.output_file.absolute()}.{stream}.log")
+
+    # Options that only say where the inputs and outputs are or how fast to
+    # run, and so do not change the annotation
+    RUN_OPTIONS = ('input_sequence', 'output_file', 'threads', 'clean', 'keep', 'debug', 'split_prodigal_jobs')
+
+    def options(self) -> dict:
+        """
+        The options that determine the annotation, e.g. for cache keys
+        """
+        return {name: getattr(self, name) for name in self.__slots__ if name not in self.RUN_OPTIONS}
+
     def as_cmd(self) -> List[str]:
 
         # The version needs to be checked prior to running this, as RGI
@@ -121,56 +139,83 @@ class RgiResult:
 
 class Rgi:
     __slots__ = ('params', 'result')
+    # The version of the RGI binary, once checked
+    _version: Optional[str] = None
+
     def __init__(self, params: RgiParams, result: RgiResult):
         self.params: RgiParams = params
         self.result: RgiResult = result
 
     @classmethod
-    def run(cls, params: RgiParams) -> 'Rgi':
-        cmd = params.as_cmd()
+    def run(cls, params: RgiParams, timeout: Optional[float] = RGI_TIMEOUT) -> 'Rgi':
+        return asyncio.run(cls.run_async(params, timeout))
 
-        # If this is being run in the Docker container, then activate the env first
-        if CONDA_RGI_NAME:
-            cmd = [CONDA_EXE_NAME, 'run', '-n', CONDA_RGI_NAME] + cmd
+    @classmethod
+    async def run_async(cls, params: RgiParams, timeout: Optional[float] = RGI_TIMEOUT) -> 'Rgi':
+        """
+        To run RGI from an event loop. Its output is written to
+        params.path_log(), which is removed once RGI succeeds.
+        """
+        # as_cmd() depends on the version
+        await cls.version_async()
+        # If this is being run in the Docker container, then run the binary
+        # of the env with the env's activation applied
+        cmd, env = await tool_resolver.command('rgi', CONDA_RGI_NAME, params.as_cmd()[1:])
 
         #LOG.debug(' '.join(map(str, cmd)))
-        proc = subprocess.Popen(cmd, encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = proc.communicate()
+        stdout, stderr = params.path_log('stdout'), params.path_log('stderr')
+        returncode = await tool_runner.run(cmd, stdout, stderr, timeout, env)
 
         # RGI always returns exit code 0...
-        if proc.returncode != 0 or len(stderr) > 0:
+        if returncode != 0 or os.path.getsize(stderr) > 0:
             #LOG.error(stdout)
             #LOG.error(stderr)
-            raise Exception("ERROR: RGI didn't run successfully!")
+            raise Exception(f"ERROR: RGI didn't run successfully! ({stderr}): {tool_runner.tail(stderr)}")
 
-        result = RgiResult(Path(f'{params.output_file.absolute()}.txt'))
+        result = await asyncio.to_thread(RgiResult, Path(f'{params.output_file.absolute()}.txt'))
+        tool_runner.remove_logs(stdout, stderr)
         return cls(params=params, result=result)
 
-    @classmethod
-    def run_for_sarand(cls, input_sequence: Path, output_file: Path, include_loose: bool):
-        params = RgiParams(
+    @staticmethod
+    def params_for_sarand(
+            input_sequence: Path, output_file: Path, include_loose: bool, threads: Optional[int] = None
+    ) -> RgiParams:
+        return RgiParams(
             input_sequence=input_sequence,
             output_file=output_file,
             input_type='protein',
             clean=True,
             include_nudge=False,
             include_loose=include_loose,
+            threads=threads,
         )
-        return cls.run(params=params)
 
-    @staticmethod
-    @lru_cache(maxsize=1)
-    def version() -> str:
-        cmd = ['rgi', '-h']
-        if CONDA_RGI_NAME:
-            cmd = [CONDA_EXE_NAME, 'run', '-n', CONDA_RGI_NAME] + cmd
-        proc = subprocess.Popen(cmd, encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = proc.communicate()
-        if proc.returncode != 0:
+    @classmethod
+    def run_for_sarand(
+            cls, input_sequence: Path, output_file: Path, include_loose: bool, threads: Optional[int] = None
+    ):
+        return cls.run(params=cls.params_for_sarand(input_sequence, output_file, include_loose, threads))
+
+    @classmethod
+    def version(cls) -> str:
+        if cls._version is None:
+            return asyncio.run(cls.version_async())
+        return cls._version
+
+    @classmethod
+    async def version_async(cls) -> str:
+        if cls._version is not None:
+            return cls._version
+        cmd, env = await tool_resolver.command('rgi', CONDA_RGI_NAME, ['-h'])
+        cls._version = tool_resolver.cached_version('rgi', CONDA_RGI_NAME)
+        if cls._version is not None:
+            return cls._version
+        returncode, stdout, stderr = await tool_runner.capture(cmd, TOOL_VERSION_TIMEOUT, env)
+        if returncode != 0:
             #LOG.error(stdout)
             #LOG.error(stderr)
             raise Exception("rgi binary not found")
         hits = re.findall(r'(\d\.\d\.\d)', stdout)
-        if len(hits) == 1:
-            return hits[0]
-        return PROGRAM_VERSION_NA
+        cls._version = hits[0] if len(hits) == 1 else PROGRAM_VERSION_NA
+        tool_resolver.store_version('rgi', CONDA_RGI_NAME, cls._version)
+        return cls._version
@@ -0,0 +1,149 @@
+import datetime
+from typing import List, Tuple
+
+import cache
+import data_version
+import spend
+
+"""
+Incrementally maintained rollup of the annual parts expense.
+
+expense_rollup holds one row per year with SUM(price*qty) over that year's
+order lines, so /get-annual-expense reads one row per year instead of
+joining and aggregating every order line. Triggers created with the
+data_version tables fold every write to the order lines, orders and parts
+into it, and into the spend aggregates, in the writer's transaction,
+whichever client makes it, so the aggregates stay current without the app
+having to make the write: add_order() is only a convenience. rebuild() recomputes it from scratch, and check()
+compares it against the live aggregate. A rollup that was never built is
+read as the live aggregate until rebuild() runs.
+"""
+
+CREATE_ROLLUP_TABLE = """CREATE TABLE IF NOT EXISTS expense_rollup (
+    year INT NOT NULL PRIMARY KEY,
+    total DECIMAL(15, 2) NOT NULL,
+    line_count BIGINT NOT NULL
+)"""
+
+LIVE_AGGREGATE = """SELECT YEAR(order_date) AS year, SUM(price*qty) AS total, COUNT(*) AS line_count
+FROM part_orders, parts, orders
+WHERE part_orders.part_id = parts._id AND orders._id = part_orders.order_id
+GROUP BY YEAR(order_date)"""
+
+# Read by yearly_totals(), with the order lines its live fallback reads
+READ_TABLES = ('expense_rollup', 'orders', 'part_orders', 'parts')
+
+# aggregate -> the tables it is cached as, for data_version.sync()
+AGGREGATE_TABLES = {'expense_rollup': ('expense_rollup',), 'spend': spend.TABLES}
+
+# table -> (aggregate, live aggregate) of every precomputed table, for readable()
+LIVE_TABLES = dict(spend.LIVE_TABLES, expense_rollup=('expense_rollup', LIVE_AGGREGATE))
+
+# aggregate -> its tables, as folded into by the triggers of data_version.migrate()
+FOLDED = dict(spend.FOLDED, expense_rollup=[(
+    'expense_rollup',
+    (('year', 'YEAR(orders.order_date)'),),
+    (('total', 'parts.price * part_orders.qty'), ('line_count', '1')),
+)])
+
+
+def readable(conn, sql: str) -> str:
+    """
+    A query of expense_rollup or the spend tables, reading the live
+    aggregate in place of any that is not current
+    """
+    return data_version.readable(conn, sql, LIVE_TABLES)
+
+
+def yearly_totals(conn, start: int, end: int) -> Tuple[tuple, ...]:
+    """
+    The total expense of each year from start to end (inclusive)
+    Return:
+        (year, total) tuples ordered by year
+    """
+    cur = conn.cursor()
+    cur.execute(
+        readable(conn, "SELECT year, total FROM expense_rollup WHERE year >= %s AND year <= %s ORDER BY year"),
+        (start, end),
+    )
+    data = cur.fetchall()
+    cur.close()
+    return data
+
+
+def add_order(conn, order_id: int, order_date: datetime.date, sup_id: int,
+              lines: List[Tuple[int, int]]):
+    """
+    To insert an order with its part lines in a single transaction. The
+    triggers fold it into expense_rollup and the spend aggregates.
+    Parameters:
+        conn: the database connection to write with
+        order_id: the _id of the new order
+        order_date: the date the order was placed
+        sup_id: the supplier the order was placed with
+        lines: (part_id, qty) pairs of the order
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            "INSERT INTO orders (_id, order_date, sup_id) VALUES (%s, %s, %s)",
+            (order_id, order_date, sup_id),
+        )
+        cur.executemany(
+            "INSERT INTO part_orders (order_id, part_id, qty) VALUES (%s, %s, %s)",
+            [(order_id, part_id, qty) for part_id, qty in lines],
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    cache.bump("orders", "part_orders", "expense_rollup", *spend.TABLES)
+
+
+def rebuild(conn) -> int:
+    """
+    Recompute expense_rollup from the order lines
+    Return:
+        the number of years in the rollup
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute(CREATE_ROLLUP_TABLE)
+        data_version.migrate(cur, conn.dialect, FOLDED)
+        data_version.lock_current(cur, conn.dialect)
+        cur.execute("DELETE FROM expense_rollup")
+        cur.execute("INSERT INTO expense_rollup (year, total, line_count) " + LIVE_AGGREGATE)
+        years = cur.rowcount
+        data_version.mark_current(cur, ['expense_rollup'])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    cache.bump("expense_rollup")
+    return years
+
+
+def check(conn) -> List[tuple]:
+    """
+    Compare expense_rollup against the live aggregate
+    Return:
+        (year, rollup_total, live_total) for every year that differs
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT year, total, line_count FROM expense_rollup")
+    rolled = {row[0]: row[1:] for row in cur.fetchall()}
+    cur.execute(LIVE_AGGREGATE)
+    live = {row[0]: row[1:] for row in cur.fetchall()}
+    cur.close()
+
+    mismatches = []
+    for year in sorted(set(rolled) | set(live)):
+        rolled_total, rolled_count = rolled.get(year, (0, 0))
+        live_total, live_count = live.get(year, (0, 0))
+        if rolled_count != live_count or round(float(rolled_total) - float(live_total), 2) != 0:
+            mismatches.append((year, rolled_total, live_total))
+    return mismatches
@@ -0,0 +1,238 @@
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+from config import ANNOTATION_CPU_BUDGET, ANNOTATION_JOB_MEMORY_MB, ANNOTATION_MAX_JOBS
+
+"""
+Splitting a CPU budget between concurrent annotation jobs and their threads.
+
+Every Bakta and RGI run is given an explicit --threads, granted from the
+budget before the job is started and returned once it finishes, so the runs
+in flight never ask for more CPUs than the budget holds. A job is granted
+the threads its sequences can use: each stage's wall time is modelled as
+overhead + per_base * bases / threads, fitted to the timings measured so
+far, and threads are added while each one still cuts the predicted time by
+min_gain. While other jobs are waiting for CPUs the grant is also bounded by
+the job's fair share, the free CPUs spread over it and the jobs waiting
+that a slot is open for, and otherwise a job takes every free CPU it can
+use. Short sequences, dominated by start-up and database loading, are run
+as many single-threaded jobs, and a long one gets the CPUs the others leave
+idle as the measurements show it scales. The number of jobs run at once is
+bounded by memory, as each Bakta run loads its database. The utilisation
+reported counts the threads the model finds useful over each stage's
+measured time.
+"""
+
+STAGES = ('bakta', 'rgi')
+
+
+def default_max_jobs(budget: int) -> int:
+    """
+    ANNOTATION_MAX_JOBS, or the number of jobs whose Bakta runs fit in the
+    machine's memory at ANNOTATION_JOB_MEMORY_MB each, at most budget
+    """
+    if ANNOTATION_MAX_JOBS:
+        return ANNOTATION_MAX_JOBS
+    try:
+        memory = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return budget
+    return max(1, min(budget, memory // (ANNOTATION_JOB_MEMORY_MB * 1024 * 1024)))
+
+
+class CpuScheduler:
+    """
+    Grants threads to annotation jobs from a budget of CPUs.
+    """
+    __slots__ = (
+        'budget', 'max_jobs', 'min_gain', '_lock', '_observations', '_reserved',
+        '_running', '_waiting', '_closed', '_started', '_last', '_cpu_seconds', '_useful_seconds', '_jobs',
+        '_peak_reserved', '_stage_runs', '_stage_seconds', '_stage_thread_seconds',
+    )
+
+    def __init__(
+            self,
+            budget: int = ANNOTATION_CPU_BUDGET,
+            max_jobs: Optional[int] = None,
+            min_gain: float = 0.05,
+            history: int = 256,
+    ):
+        """
+        Args:
+            budget: The number of CPUs the jobs in flight may use between them
+            max_jobs: The number of jobs run at once (default = default_max_jobs(budget))
+            min_gain: The fraction of a job's predicted time an extra thread has to save
+            history: The number of timings of each stage the model is fitted to
+        """
+        self.budget: int = max(1, budget)
+        self.max_jobs: int = max(1, min(max_jobs or default_max_jobs(self.budget), self.budget))
+        self.min_gain: float = min_gain
+        self._lock = threading.Condition()
+        self._observations: Dict[str, deque] = {stage: deque(maxlen=history) for stage in STAGES}
+        self._reserved: int = 0
+        self._running: int = 0
+        self._waiting: int = 0
+        self._closed: bool = False
+        self._started: Optional[float] = None
+        self._last: Optional[float] = None
+        self._cpu_seconds: float = 0.0
+        self._useful_seconds: float = 0.0
+        self._jobs: int = 0
+        self._peak_reserved: int = 0
+        self._stage_runs: Dict[str, int] = dict.fromkeys(STAGES, 0)
+        self._stage_seconds: Dict[str, float] = dict.fromkeys(STAGES, 0.0)
+        self._stage_thread_seconds: Dict[str, float] = dict.fromkeys(STAGES, 0.0)
+
+    def _tick(self):
+        # Integrate the reserved CPUs over time, for the utilisation
+        now = time.monotonic()
+        if self._started is None:
+            self._started = now
+        elif self._last is not None:
+            self._cpu_seconds += self._reserved * (now - self._last)
+        self._last = now
+
+    def model(self, stage: str) -> Optional[Tuple[float, float]]:
+        """
+        The (overhead, per_base) seconds of a stage fitted to its timings by
+        least squares, or None before two timings with different bases per
+        thread have been measured
+        """
+        with self._lock:
+            observations = list(self._observations[stage])
+        if len(observations) < 2:
+            return None
+        n = len(observations)
+        mean_x = sum(x for x, _ in observations) / n
+        mean_y = sum(y for _, y in observations) / n
+        var_x = sum((x - mean_x) ** 2 for x, _ in observations)
+        if var_x == 0:
+            return None
+        per_base = max(0.0, sum((x - mean_x) * (y - mean_y) for x, y in observations) / var_x)
+        overhead = max(mean_y - per_base * mean_x, 1e-3)
+        return overhead, per_base
+
+    def useful_threads(self, bases: int, limit: int) -> int:
+        """
+        The number of threads, up to limit, worth giving a job over `bases` bases
+        """
+        models = [m for m in (self.model(stage) for stage in STAGES) if m is not None]
+        if not models:
+            return 1
+        # The stages run one after the other with the same threads
+        overhead = sum(m[0] for m in models)
+        parallel = sum(m[1] for m in models) * bases
+        threads = 1
+        while threads < limit:
+            saved = parallel / threads - parallel / (threads + 1)
+            if saved < self.min_gain * (overhead + parallel / threads):
+                break
+            threads += 1
+        return threads
+
+    def acquire(self, bases: int, pending: int = 0) -> int:
+        """
+        To wait for a job slot and free CPUs, and reserve them for a job
+        Parameters:
+            bases: the number of bases the job annotates
+            pending: the number of jobs the caller will ask for next, which
+                wait for CPUs as the jobs blocked in acquire() do
+        Return:
+            the number of threads granted, or 0 once the scheduler is closed
+        """
+        with self._lock:
+            self._waiting += 1
+            try:
+                while not self._closed and (
+                        self._running >= self.max_jobs or self._reserved >= self.budget
+                ):
+                    self._lock.wait()
+            finally:
+                self._waiting -= 1
+            if self._closed:
+                return 0
+            free = self.budget - self._reserved
+            waiting = self._waiting + pending
+            if waiting:
+                # Leave the others their share of the free CPUs. The share
+                # only bounds the grant, so a job never takes threads it
+                # cannot use from the jobs after it.
+                share = max(1, free // min(self.max_jobs - self._running, 1 + waiting))
+            else:
+                share = free
+            threads = max(1, min(free, self.useful_threads(bases, share)))
+            self._tick()
+            self._reserved += threads
+            self._running += 1
+            self._jobs += 1
+            self._peak_reserved = max(self._peak_reserved, self._reserved)
+            return threads
+
+    def release(self, threads: int):
+        """
+        To return the CPUs of a finished job
+        """
+        with self._lock:
+            self._tick()
+            self._reserved -= threads
+            self._running -= 1
+            self._lock.notify_all()
+
+    def record(self, stage: str, bases: int, threads: int, seconds: float):
+        """
+        To add the timing of a stage of a job to the stage's model
+        """
+        with self._lock:
+            self._observations[stage].append((bases / max(1, threads), seconds))
+            # The lock is reentrant, so the model can be refitted here
+            self._useful_seconds += seconds * self.useful_threads(bases, threads)
+            self._stage_runs[stage] += 1
+            self._stage_seconds[stage] += seconds
+            self._stage_thread_seconds[stage] += seconds * threads
+
+    def close(self):
+        """
+        To wake up and refuse every job still waiting for CPUs
+        """
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+
+    def stats(self) -> dict:
+        """
+        The jobs run so far and how much of the budget they kept busy
+        """
+        with self._lock:
+            self._tick()
+            elapsed = self._last - self._started
+            out = {
+                "budget": self.budget,
+                "max_jobs": self.max_jobs,
+                "jobs": self._jobs,
+                "running": self._running,
+                "reserved": self._reserved,
+                "peak_reserved": self._peak_reserved,
+                "elapsed": elapsed,
+                # Of the CPU time in the budget, the share spent on threads the model finds useful
+                "utilisation": self._useful_seconds / (self.budget * elapsed) if elapsed > 0 else 0.0,
+                # and the share granted to jobs
+                "reserved_utilisation": self._cpu_seconds / (self.budget * elapsed) if elapsed > 0 else 0.0,
+                "stages": {},
+            }
+            stage_stats = {
+                stage: (self._stage_runs[stage], self._stage_seconds[stage], self._stage_thread_seconds[stage])
+                for stage in STAGES
+            }
+        for stage, (runs, seconds, thread_seconds) in stage_stats.items():
+            model = self.model(stage)
+            out["stages"][stage] = {
+                "runs": runs,
+                "seconds": seconds,
+                "mean_threads": thread_seconds / seconds if seconds else None,
+                "overhead": model[0] if model else None,
+                "seconds_per_kb": model[1] * 1000 if model else None,
+            }
+        return out
@@ -0,0 +1,175 @@
+import datetime
+from typing import List, Tuple
+
+import data_version
+import queries
+import rollup
+import spend
+
+"""
+Schema and index migrations for the app's database, and a query plan checker.
+
+migrate() is idempotent: it creates any missing table or index and leaves
+existing ones alone, so it is safe to run against the live database as well
+as an empty stand-in. check_plans() runs EXPLAIN over the queries the routes
+issue and reports every table read with a full scan.
+"""
+
+TABLES = [
+    """CREATE TABLE IF NOT EXISTS supplier (
+        _id INT NOT NULL PRIMARY KEY,
+        name VARCHAR(255) NOT NULL,
+        email VARCHAR(255)
+    )""",
+    """CREATE TABLE IF NOT EXISTS telephone (
+        sup_id INT NOT NULL,
+        tel VARCHAR(32) NOT NULL,
+        PRIMARY KEY (sup_id, tel)
+    )""",
+    """CREATE TABLE IF NOT EXISTS parts (
+        _id INT NOT NULL PRIMARY KEY,
+        price DECIMAL(10, 2) NOT NULL,
+        description VARCHAR(255)
+    )""",
+    """CREATE TABLE IF NOT EXISTS orders (
+        _id INT NOT NULL PRIMARY KEY,
+        order_date DATE NOT NULL,
+        sup_id INT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS part_orders (
+        order_id INT NOT NULL,
+        part_id INT NOT NULL,
+        qty INT NOT NULL,
+        PRIMARY KEY (order_id, part_id)
+    )""",
+    rollup.CREATE_ROLLUP_TABLE,
+] + spend.CREATE_TABLES
+
+# (index name, table, columns). Each index covers the columns its queries read
+# so the joins never have to go back to the base table.
+INDEXES: List[Tuple[str, str, Tuple[str, ...]]] = [
+    # Date range filters on orders, the orders keyset and the join to part_orders
+    ("idx_orders_date", "orders", ("order_date", "_id", "sup_id")),
+    # part_orders joined from orders
+    ("idx_part_orders_order", "part_orders", ("order_id", "part_id", "qty")),
+    # part_orders joined from parts
+    ("idx_part_orders_part", "part_orders", ("part_id", "order_id", "qty")),
+    # telephone joined from supplier
+    ("idx_telephone_sup", "telephone", ("sup_id", "tel")),
+    # /filter-table equality and prefix filters
+    ("idx_supplier_name", "supplier", ("name",)),
+    ("idx_supplier_email", "supplier", ("email",)),
+    ("idx_telephone_tel", "telephone", ("tel", "sup_id")),
+    ("idx_parts_price", "parts", ("price",)),
+    ("idx_parts_description", "parts", ("description",)),
+    ("idx_orders_sup", "orders", ("sup_id", "order_date", "_id")),
+] + spend.INDEXES
+
+INDEX_EXISTS = {
+    'mysql': """SELECT 1 FROM information_schema.statistics
+    WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s LIMIT 1""",
+    'sqlite': "SELECT 1 FROM sqlite_master WHERE type = 'index' AND tbl_name = %s AND name = %s",
+}
+
+EXPLAIN = {
+    'mysql': "EXPLAIN ",
+    'sqlite': "EXPLAIN QUERY PLAN ",
+}
+
+
+def year_range(start: int, end: int) -> Tuple[datetime.date, datetime.date]:
+    """
+    The half-open date range [Jan 1 of start, Jan 1 of end + 1) covering the
+    years start to end. Comparing order_date against these bounds can seek an
+    index, where YEAR(order_date) has to be evaluated on every row.
+    """
+    return datetime.date(start, 1, 1), datetime.date(end + 1, 1, 1)
+
+
+def migrate(conn) -> List[str]:
+    """
+    Create any missing tables, indexes and version triggers
+    Return:
+        the names of the indexes that were created
+    """
+    cur = conn.cursor()
+    created = []
+    try:
+        for statement in TABLES:
+            cur.execute(statement)
+        for name, table, columns in INDEXES:
+            cur.execute(INDEX_EXISTS[conn.dialect], (table, name))
+            if cur.fetchone():
+                continue
+            cur.execute(f"CREATE INDEX {name} ON {table} ({', '.join(columns)})")
+            created.append(name)
+        data_version.migrate(cur, conn.dialect, rollup.FOLDED)
+        conn.commit()
+    finally:
+        cur.close()
+    return created
+
+
+def route_queries() -> List[Tuple[str, str, list]]:
+    """
+    Representative (route, query, params) of every query a route runs.
+    Paged queries are checked with a cursor, as every page after the first
+    seeks from one.
+    """
+    out = []
+    for name, query in queries.TABLES.items():
+        predicate, params = query.after([1] * len(query.keys))
+        out.append((f"/show-table {name}", query.sql([predicate], queries.DEFAULT_PAGE_SIZE), params))
+        for column in query.filters:
+            predicate, params = query.filter(column, "1")
+            out.append((f"/filter-table {name} {column}", query.sql([predicate], queries.DEFAULT_PAGE_SIZE), params))
+    start, end = year_range(2022, 2022)
+    out += [
+        ("/get-annual-expense", "SELECT year, total FROM expense_rollup WHERE year >= %s AND year <= %s",
+         [2016, 2023]),
+        ("/project-budget", queries.EXPENSE_BY_SUPPLIER_PART, [start, end]),
+        ("/api/spend/suppliers", spend.TOP_SUPPLIERS, [10]),
+        ("/api/spend/suppliers/<sup_id>", spend.SUPPLIER_SPEND, [1]),
+        ("/api/spend/suppliers/<sup_id>", spend.SUPPLIER_MONTHS, [1, 2016, 2023]),
+        ("/api/spend/parts", spend.TOP_PARTS, [10]),
+        ("/api/spend/parts/<part_id>", spend.PART_SPEND, [1]),
+        ("/api/spend/months/<year>/<month>", spend.TOP_SUPPLIERS_IN_MONTH, [2022, 1, 10]),
+        ("/add-supplier", "SELECT * FROM supplier WHERE _id = %s", [1]),
+        ("/add-supplier", queries.TABLES["suppliers"].sql(["supplier._id = %s"]), [1]),
+    ]
+    return out
+
+
+def _full_scans(dialect: str, plan) -> List[str]:
+    """
+    The tables in an EXPLAIN output that are read with a full table scan
+    """
+    scans = []
+    for row in plan:
+        if dialect == 'mysql':
+            # EXPLAIN columns: id, select_type, table, partitions, type, ...
+            if row[4] == 'ALL':
+                scans.append(row[2])
+        else:
+            # EXPLAIN QUERY PLAN columns: id, parent, notused, detail
+            detail = row[3].split()
+            if detail[0] == 'SCAN' and 'USING' not in detail:
+                scans.append(detail[1])
+    return scans
+
+
+def check_plans(conn) -> List[Tuple[str, str]]:
+    """
+    EXPLAIN every route query
+    Return:
+        (route, table) for every table a route query reads with a full scan
+    """
+    cur = conn.cursor()
+    failures = []
+    try:
+        for route, sql, params in route_queries():
+            cur.execute(EXPLAIN[conn.dialect] + sql, params)
+            failures += [(route, table) for table in _full_scans(conn.dialect, cur.fetchall())]
+    finally:
+        cur.close()
+    return failures
@@ -0,0 +1,223 @@
+from typing import List, Optional, Tuple
+
+import cache
+import data_version
+
+"""
+Incrementally maintained spend aggregates per supplier, per part and per
+supplier and month.
+
+Like expense_rollup, each table holds SUM(price*qty) and the line count of
+its group and is kept current by the fold triggers of data_version, which
+fold every write to the order lines, orders and parts into it in the
+writer's transaction, so the spend routes read a handful of rows by primary
+key or from the head of a total index instead of aggregating the order
+lines, whoever wrote them. rebuild() recomputes the tables from scratch, and
+check() compares them against the live aggregates. Until the tables are
+first built the spend routes read the live aggregates instead.
+"""
+
+# Written by the fold triggers and rebuild(), for cache invalidation and ETags
+TABLES = ('supplier_spend', 'part_spend', 'supplier_month_spend')
+# Read by the spend routes, with the order lines their live fallback reads
+READ_TABLES = TABLES + ('orders', 'part_orders', 'parts')
+
+CREATE_TABLES = [
+    """CREATE TABLE IF NOT EXISTS supplier_spend (
+        sup_id INT NOT NULL PRIMARY KEY,
+        total DECIMAL(15, 2) NOT NULL,
+        line_count BIGINT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS part_spend (
+        part_id INT NOT NULL PRIMARY KEY,
+        total DECIMAL(15, 2) NOT NULL,
+        qty BIGINT NOT NULL,
+        line_count BIGINT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS supplier_month_spend (
+        sup_id INT NOT NULL,
+        year INT NOT NULL,
+        month INT NOT NULL,
+        total DECIMAL(15, 2) NOT NULL,
+        line_count BIGINT NOT NULL,
+        PRIMARY KEY (sup_id, year, month)
+    )""",
+]
+
+# (index name, table, columns) for the top-N reads, created by schema.migrate()
+INDEXES: List[Tuple[str, str, Tuple[str, ...]]] = [
+    ("idx_supplier_spend_total", "supplier_spend", ("total", "sup_id")),
+    ("idx_part_spend_total", "part_spend", ("total", "part_id")),
+    ("idx_supplier_month_spend_month", "supplier_month_spend", ("year", "month", "total", "sup_id")),
+]
+
+_LINES = """FROM part_orders, parts, orders
+WHERE part_orders.part_id = parts._id AND orders._id = part_orders.order_id"""
+
+# table -> (key columns, value columns, live aggregate in that column order)
+AGGREGATES = {
+    'supplier_spend': (
+        ('sup_id',), ('total', 'line_count'),
+        f"""SELECT orders.sup_id AS sup_id, SUM(price*qty) AS total, COUNT(*) AS line_count {_LINES}
+        GROUP BY orders.sup_id""",
+    ),
+    'part_spend': (
+        ('part_id',), ('total', 'qty', 'line_count'),
+        f"""SELECT part_orders.part_id AS part_id, SUM(price*qty) AS total, SUM(qty) AS qty,
+        COUNT(*) AS line_count {_LINES}
+        GROUP BY part_orders.part_id""",
+    ),
+    'supplier_month_spend': (
+        ('sup_id', 'year', 'month'), ('total', 'line_count'),
+        f"""SELECT orders.sup_id AS sup_id, YEAR(order_date) AS year, MONTH(order_date) AS month,
+        SUM(price*qty) AS total, COUNT(*) AS line_count {_LINES}
+        GROUP BY orders.sup_id, YEAR(order_date), MONTH(order_date)""",
+    ),
+}
+
+# table -> (aggregate, live aggregate), for data_version.readable()
+LIVE_TABLES = {table: ('spend', live) for table, (_, _, live) in AGGREGATES.items()}
+
+_LINE_TOTAL = ('total', 'parts.price * part_orders.qty')
+_LINE_COUNT = ('line_count', '1')
+
+# aggregate -> its tables, as folded into by the triggers of data_version.migrate()
+FOLDED = {
+    'spend': [
+        ('supplier_spend', (('sup_id', 'orders.sup_id'),), (_LINE_TOTAL, _LINE_COUNT)),
+        ('part_spend', (('part_id', 'part_orders.part_id'),),
+         (_LINE_TOTAL, ('qty', 'part_orders.qty'), _LINE_COUNT)),
+        ('supplier_month_spend',
+         (('sup_id', 'orders.sup_id'), ('year', 'YEAR(orders.order_date)'),
+          ('month', 'MONTH(orders.order_date)')),
+         (_LINE_TOTAL, _LINE_COUNT)),
+    ],
+}
+
+
+def rebuild(conn) -> dict:
+    """
+    Recompute the spend aggregates from the order lines
+    Return:
+        the number of rows in each table
+    """
+    cur = conn.cursor()
+    counts = {}
+    try:
+        for statement in CREATE_TABLES:
+            cur.execute(statement)
+        data_version.migrate(cur, conn.dialect, FOLDED)
+        data_version.lock_current(cur, conn.dialect)
+        for table, (keys, values, live) in AGGREGATES.items():
+            cur.execute(f"DELETE FROM {table}")
+            cur.execute(f"INSERT INTO {table} ({', '.join(keys + values)}) " + live)
+            counts[table] = cur.rowcount
+        data_version.mark_current(cur, ['spend'])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    cache.bump(*TABLES)
+    return counts
+
+
+def check(conn) -> List[tuple]:
+    """
+    Compare the spend aggregates against the live aggregates
+    Return:
+        (table, key, stored, live) for every group that differs
+    """
+    cur = conn.cursor()
+    mismatches = []
+    try:
+        for table, (keys, values, live) in AGGREGATES.items():
+            cur.execute(f"SELECT {', '.join(keys + values)} FROM {table}")
+            stored = {row[:len(keys)]: row[len(keys):] for row in cur.fetchall()}
+            cur.execute(live)
+            current = {row[:len(keys)]: row[len(keys):] for row in cur.fetchall()}
+            empty = (0,) * len(values)
+            for key in sorted(set(stored) | set(current)):
+                a, b = stored.get(key, empty), current.get(key, empty)
+                if any(round(float(x) - float(y), 2) != 0 for x, y in zip(a, b)):
+                    mismatches.append((table, key, a, b))
+    finally:
+        cur.close()
+    return mismatches
+
+
+def _fetch(conn, sql: str, params: tuple) -> Tuple[tuple, ...]:
+    cur = conn.cursor()
+    cur.execute(data_version.readable(conn, sql, LIVE_TABLES), params)
+    data = cur.fetchall()
+    cur.close()
+    return data
+
+
+SUPPLIER_COLUMNS = ["sup_id", "name", "total", "line_count"]
+PART_COLUMNS = ["part_id", "description", "total", "qty", "line_count"]
+MONTH_COLUMNS = ["sup_id", "year", "month", "total", "line_count"]
+
+_SUPPLIER = """SELECT supplier_spend.sup_id, supplier.name, total, line_count
+FROM supplier_spend LEFT JOIN supplier ON supplier._id = supplier_spend.sup_id"""
+_PART = """SELECT part_spend.part_id, parts.description, total, qty, line_count
+FROM part_spend LEFT JOIN parts ON parts._id = part_spend.part_id"""
+_MONTH = "SELECT sup_id, year, month, total, line_count FROM supplier_month_spend"
+
+# Ties in total are broken by id, highest first, so a top N is the same on
+# every read and the (total, id) indexes still give the order
+TOP_SUPPLIERS = _SUPPLIER + " ORDER BY total DESC, supplier_spend.sup_id DESC LIMIT %s"
+TOP_PARTS = _PART + " ORDER BY total DESC, part_spend.part_id DESC LIMIT %s"
+SUPPLIER_SPEND = _SUPPLIER + " WHERE supplier_spend.sup_id = %s"
+PART_SPEND = _PART + " WHERE part_spend.part_id = %s"
+SUPPLIER_MONTHS = _MONTH + " WHERE sup_id = %s AND year >= %s AND year <= %s ORDER BY year, month"
+TOP_SUPPLIERS_IN_MONTH = _MONTH + " WHERE year = %s AND month = %s ORDER BY total DESC, sup_id DESC LIMIT %s"
+# Whole tables in primary key order, for the CSV export
+ALL_SUPPLIERS = _SUPPLIER + " ORDER BY supplier_spend.sup_id"
+ALL_PARTS = _PART + " ORDER BY part_spend.part_id"
+ALL_SUPPLIER_MONTHS = _MONTH + " ORDER BY sup_id, year, month"
+
+
+def top_suppliers(conn, n: int) -> Tuple[tuple, ...]:
+    """
+    The n suppliers with the highest spend, as SUPPLIER_COLUMNS
+    """
+    return _fetch(conn, TOP_SUPPLIERS, (n,))
+
+
+def top_parts(conn, n: int) -> Tuple[tuple, ...]:
+    """
+    The n parts with the highest spend, as PART_COLUMNS
+    """
+    return _fetch(conn, TOP_PARTS, (n,))
+
+
+def supplier_spend(conn, sup_id: int) -> Optional[tuple]:
+    """
+    A supplier's spend as SUPPLIER_COLUMNS, or None if nothing was ordered from it
+    """
+    rows = _fetch(conn, SUPPLIER_SPEND, (sup_id,))
+    return rows[0] if rows else None
+
+
+def part_spend(conn, part_id: int) -> Optional[tuple]:
+    """
+    A part's spend as PART_COLUMNS, or None if it was never ordered
+    """
+    rows = _fetch(conn, PART_SPEND, (part_id,))
+    return rows[0] if rows else None
+
+
+def supplier_months(conn, sup_id: int, start: int, end: int) -> Tuple[tuple, ...]:
+    """
+    A supplier's spend in every month of the years start to end (inclusive), as MONTH_COLUMNS
+    """
+    return _fetch(conn, SUPPLIER_MONTHS, (sup_id, start, end))
+
+
+def top_suppliers_in_month(conn, year: int, month: int, n: int) -> Tuple[tuple, ...]:
+    """
+    The n suppliers with the highest spend in a month, as MONTH_COLUMNS
+    """
+    return _fetch(conn, TOP_SUPPLIERS_IN_MONTH, (year, month, n))
@@ -0,0 +1,155 @@
+import csv
+import io
+import json
+from typing import List, Tuple
+
+import cache
+
+"""
+Batched supplier writes.
+
+Suppliers are inserted with executemany in chunked transactions: one
+existence query for the whole batch, then one INSERT for the suppliers and
+one for their telephone numbers per chunk. A chunk that fails is rolled back
+and retried row by row so one bad row is reported without losing the rest.
+"""
+
+DEFAULT_CHUNK_SIZE = 500
+
+INSERT_SUPPLIER = "INSERT INTO supplier (_id, name, email) VALUES (%s, %s, %s)"
+INSERT_TELEPHONE = "INSERT INTO telephone (sup_id, tel) VALUES (%s, %s)"
+# The add-supplier form's message for an _id that is taken
+SUPPLIER_EXISTS = "Supplier already exists please try different _id"
+
+
+def split_numbers(numbers) -> List[str]:
+    """
+    Telephone numbers given either as a list or as a "," or ";" separated string
+    """
+    if isinstance(numbers, str):
+        numbers = numbers.replace(";", ",").split(",")
+    elif numbers is not None and not isinstance(numbers, list):
+        raise ValueError("numbers must be a string or a list")
+    out = []
+    for number in numbers or []:
+        number = str(number).strip()
+        if number and number not in out:
+            out.append(number)
+    return out
+
+
+def parse_csv(text: str) -> List[dict]:
+    """
+    Rows of a CSV file with an id, name, email, numbers header
+    """
+    return list(csv.DictReader(io.StringIO(text)))
+
+
+def parse_json(text: str) -> List[dict]:
+    """
+    Rows of a JSON list of {"id", "name", "email", "numbers"} objects
+    """
+    data = json.loads(text)
+    if not isinstance(data, list):
+        raise ValueError("Expected a JSON list of suppliers")
+    return data
+
+
+def _text(row: dict, field: str) -> str:
+    value = row.get(field)
+    if value is None:
+        return ""
+    if not isinstance(value, str):
+        raise ValueError(f"{field} must be a string")
+    return value.strip()
+
+
+def _validate(row) -> Tuple[int, str, str, List[str]]:
+    if not isinstance(row, dict):
+        raise ValueError("Supplier must be an object")
+    try:
+        _id = int(row.get("id"))
+    except (TypeError, ValueError):
+        raise ValueError("id must be an integer")
+    name = _text(row, "name")
+    if not name:
+        raise ValueError("name is required")
+    email = _text(row, "email")
+    return _id, name, email, split_numbers(row.get("numbers"))
+
+
+def _write(cur, suppliers):
+    cur.executemany(INSERT_SUPPLIER, [(_id, name, email) for _, (_id, name, email, _) in suppliers])
+    cur.executemany(INSERT_TELEPHONE, [
+        (_id, number) for _, (_id, _, _, numbers) in suppliers for number in numbers
+    ])
+
+
+def import_suppliers(conn, rows: List[dict], chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """
+    To insert a batch of suppliers and their telephone numbers
+    Parameters:
+        conn: the database connection to write with
+        rows: supplier dicts with id, name, email and numbers
+        chunk_size: the number of suppliers committed per transaction
+    Return:
+        the ids of the inserted suppliers and a list of (row index, error) for
+        the rows that were skipped
+    """
+    errors = []
+    valid = []
+    seen = set()
+    for i, row in enumerate(rows):
+        try:
+            supplier = _validate(row)
+        except ValueError as e:
+            errors.append((i, str(e)))
+            continue
+        if supplier[0] in seen:
+            errors.append((i, f"Duplicate supplier {supplier[0]} in batch"))
+            continue
+        seen.add(supplier[0])
+        valid.append((i, supplier))
+
+    cur = conn.cursor()
+    inserted = []
+    try:
+        # Check existence for the whole batch in one query
+        existing = set()
+        if seen:
+            cur.execute(
+                "SELECT _id FROM supplier WHERE _id IN (" + ", ".join(["%s"] * len(seen)) + ")",
+                sorted(seen),
+            )
+            existing = {row[0] for row in cur.fetchall()}
+        pending = []
+        for i, supplier in valid:
+            if supplier[0] in existing:
+                errors.append((i, SUPPLIER_EXISTS))
+            else:
+                pending.append((i, supplier))
+
+        for start in range(0, len(pending), chunk_size):
+            chunk = pending[start:start + chunk_size]
+            try:
+                _write(cur, chunk)
+                conn.commit()
+                inserted += [supplier[0] for _, supplier in chunk]
+                continue
+            except Exception:
+                conn.rollback()
+            # Retry the failed chunk one supplier at a time to find the bad rows
+            for i, supplier in chunk:
+                try:
+                    _write(cur, [(i, supplier)])
+                    conn.commit()
+                    inserted.append(supplier[0])
+                except Exception as e:
+                    conn.rollback()
+                    errors.append((i, str(e)))
+    finally:
+        cur.close()
+        if inserted:
+            cache.bump("supplier", "telephone")
+    errors.sort()
+    return inserted, errors
@@ -0,0 +1,105 @@
+import datetime
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import data_version
+import db
+import rollup
+import schema
+import spend
+
+
+@pytest.fixture
+def conn(tmp_path):
+    """
+    A migrated SQLite stand-in with a few orders, and the aggregates built
+    """
+    pool = db.ConnectionPool(db.SQLiteBackend(str(tmp_path / "muc.db")))
+    conn = pool.acquire()
+    schema.migrate(conn)
+    cur = conn.cursor()
+    cur.executemany("INSERT INTO supplier (_id, name, email) VALUES (%s, %s, %s)",
+                    [(1, "Acme", "a@x"), (2, "Bolt", "b@x")])
+    cur.executemany("INSERT INTO parts (_id, price, description) VALUES (%s, %s, %s)",
+                    [(1, 10.0, "nut"), (2, 2.5, "bolt")])
+    cur.executemany("INSERT INTO orders (_id, order_date, sup_id) VALUES (%s, %s, %s)",
+                    [(1, "2022-03-01", 1), (2, "2023-05-02", 2)])
+    cur.executemany("INSERT INTO part_orders (order_id, part_id, qty) VALUES (%s, %s, %s)",
+                    [(1, 1, 3), (1, 2, 4), (2, 1, 1)])
+    conn.commit()
+    cur.close()
+    rollup.rebuild(conn)
+    spend.rebuild(conn)
+    yield conn
+    conn.close()
+    pool.close()
+
+
+def execute(conn, sql, params=()):
+    cur = conn.cursor()
+    cur.execute(sql, params)
+    conn.commit()
+    cur.close()
+
+
+def test_add_order_keeps_the_aggregates_current(conn):
+    rollup.add_order(conn, 3, datetime.date(2023, 6, 1), 1, [(2, 2)])
+    assert sorted(data_version.current(conn, ["expense_rollup", "spend"])) == ["expense_rollup", "spend"]
+    assert rollup.check(conn) == []
+    assert spend.check(conn) == []
+    assert [tuple(row) for row in spend.supplier_months(conn, 1, 2023, 2023)] == [(1, 2023, 6, 5, 1)]
+    assert [tuple(row) for row in rollup.yearly_totals(conn, 2022, 2023)] == [(2022, 40), (2023, 15)]
+
+
+def live_totals(conn):
+    cur = conn.cursor()
+    cur.execute(rollup.LIVE_AGGREGATE)
+    totals = {row[0]: row[1] for row in cur.fetchall()}
+    cur.close()
+    return totals
+
+
+@pytest.mark.parametrize("write", [
+    "INSERT INTO parts (_id, price, description) VALUES (3, 7.0, 'pin')",
+    "INSERT INTO orders (_id, order_date, sup_id) VALUES (4, '2024-02-01', 2)",
+    "UPDATE parts SET price = 20.0 WHERE _id = 1",
+    "UPDATE parts SET description = 'hex nut' WHERE _id = 1",
+    "UPDATE orders SET order_date = '2021-12-31' WHERE _id = 2",
+    "UPDATE part_orders SET qty = 9 WHERE order_id = 1 AND part_id = 2",
+    "DELETE FROM part_orders WHERE order_id = 2",
+    "DELETE FROM orders WHERE _id = 1",
+])
+def test_writes_outside_the_app_keep_the_aggregates_current(conn, write):
+    # An order of a part that does not exist yet, which the first write adds
+    rollup.add_order(conn, 3, datetime.date(2023, 6, 1), 1, [(3, 5)])
+    # An order line whose order does not exist yet, which the second write adds
+    execute(conn, "INSERT INTO part_orders (order_id, part_id, qty) VALUES (4, 2, 2)")
+    execute(conn, write)
+    assert sorted(data_version.current(conn, ["expense_rollup", "spend"])) == ["expense_rollup", "spend"]
+    assert rollup.check(conn) == []
+    assert spend.check(conn) == []
+    # Years left without an order line are dropped, as from the live aggregate
+    assert dict(rollup.yearly_totals(conn, 2000, 2100)) == live_totals(conn)
+
+
+def test_rollup_is_read_live_until_built(conn):
+    execute(conn, "DELETE FROM expense_rollup")
+    execute(conn, "UPDATE aggregate_state SET version = -1")
+    assert data_version.current(conn, ["expense_rollup"]) == []
+    assert dict(rollup.yearly_totals(conn, 2000, 2100)) == live_totals(conn)
+
+
+def test_spend_ties_come_back_in_one_order(conn):
+    # Bolt draws level with Acme in March 2022, and both spend 50 in all
+    rollup.add_order(conn, 3, datetime.date(2022, 3, 5), 2, [(1, 4)])
+    rollup.add_order(conn, 4, datetime.date(2023, 1, 9), 1, [(2, 4)])
+    assert [row[:3] for row in spend.top_suppliers(conn, 2)] == [(2, "Bolt", 50), (1, "Acme", 50)]
+    assert [row[:4] for row in spend.top_suppliers_in_month(conn, 2022, 3, 2)] == [(2, 2022, 3, 40), (1, 2022, 3, 40)]
+    # and in the same order when read live
+    execute(conn, "UPDATE aggregate_state SET version = -1")
+    assert [row[:3] for row in spend.top_suppliers(conn, 2)] == [(2, "Bolt", 50), (1, "Acme", 50)]
+    assert schema.check_plans(conn) == []
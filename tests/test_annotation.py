@@ -0,0 +1,94 @@
+import os
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import annotation
+import annotation_cache
+import tool_resolver
+from annotation_cache import AnnotationCache
+from bakta import Bakta
+from rgi import Rgi
+
+FAKE_TOOLS = Path(__file__).resolve().parent / "fake_tools"
+
+
+@pytest.fixture
+def fake_tools(tmp_path, monkeypatch):
+    """
+    bakta and rgi on PATH are the stand-ins in fake_tools, logging their runs
+    """
+    log = tmp_path / "tools.log"
+    monkeypatch.setenv("PATH", str(FAKE_TOOLS) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("FAKE_TOOLS_LOG", str(log))
+    monkeypatch.setattr(tool_resolver, "TOOL_CACHE_FILE", str(tmp_path / "tools.json"))
+    monkeypatch.setattr(tool_resolver, "_resolved", {})
+    # Only the caches a test passes in are used
+    monkeypatch.setattr(annotation_cache, "ANNOTATION_CACHE_DIR", None)
+    return log
+
+
+def sequences():
+    rng = random.Random(0)
+    seqs = [
+        "".join(rng.choice("ACGT") for _ in range(length)) + "\n"
+        for length in (500, 1200, 20, 800)
+    ]
+    # The third is too short for any feature
+    return list(enumerate(seqs, 1))
+
+
+def annotate_one_by_one(seq_pairs, output_dir, **options):
+    return [
+        annotation.annotate_sequence(seq, "extracted" + str(counter), str(output_dir), **options)
+        for counter, seq in seq_pairs
+    ]
+
+
+@pytest.mark.parametrize("no_RGI", [False, True])
+def test_batch_matches_single(fake_tools, tmp_path, no_RGI):
+    seq_pairs = sequences()
+    single = annotate_one_by_one(seq_pairs, tmp_path / "single", no_RGI=no_RGI)
+    batch = annotation.annotate_sequences(seq_pairs, str(tmp_path / "batch"), no_RGI=no_RGI)
+
+    assert batch == single
+    assert any(gene_info["family"] for seq_info in single for gene_info in seq_info) != no_RGI
+    runs = [run for run in fake_tools.read_text().splitlines() if run != "bakta --version"]
+    # One run per sequence, then one for the whole batch
+    assert sum(run.startswith("bakta ") for run in runs) == len(seq_pairs) + 1
+
+
+def test_batch_caches_what_single_reads(fake_tools, tmp_path):
+    seq_pairs = sequences()
+    cache = AnnotationCache(tmp_path / "cache")
+    batch = annotation.annotate_sequences(seq_pairs, str(tmp_path / "batch"), cache=cache)
+
+    for counter, seq in seq_pairs:
+        entry = cache.get(annotation.annotation_cache_key(cache, seq))
+        # A sequence without proteins has no RGI hits, as run_RGI() returns
+        assert entry["rgi"] is not None
+    assert cache.get(annotation.annotation_cache_key(cache, seq_pairs[2][1])) == {"bakta": [], "rgi": []}
+
+    fresh = AnnotationCache(tmp_path / "fresh")
+    single = annotate_one_by_one(seq_pairs, tmp_path / "single", cache=fresh)
+    assert single == batch
+    for counter, seq in seq_pairs:
+        key = annotation.annotation_cache_key(cache, seq)
+        assert fresh.get(key) == cache.get(key)
+
+
+@pytest.mark.parametrize("tool, command", [(Rgi, "rgi -h"), (Bakta, "bakta --version")])
+def test_unknown_version_is_cached(fake_tools, monkeypatch, tool, command):
+    monkeypatch.setenv(f"FAKE_{tool.__name__.upper()}_VERSION", "no version here")
+    monkeypatch.setattr(tool, "_version", None)
+    assert tool.version() == tool_resolver.PROGRAM_VERSION_NA
+    assert tool.version() == tool_resolver.PROGRAM_VERSION_NA
+    # and kept with the resolved tool, for the next process
+    monkeypatch.setattr(tool, "_version", None)
+    monkeypatch.setattr(tool_resolver, "_resolved", {})
+    assert tool.version() == tool_resolver.PROGRAM_VERSION_NA
+    assert fake_tools.read_text().splitlines().count(command) == 1
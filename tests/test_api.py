@@ -0,0 +1,80 @@
+import sys
+from pathlib import Path
+
+import pytest
+from flask import Flask, abort
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import api
+import cache
+
+AVAILABLE = ["id", "name"]
+ROWS = [(1, "Acme"), (2, "Bolt")]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """
+    A route written like the app's JSON API routes, over its own result cache
+    """
+    results = cache.ResultCache()
+    results.follow({"supplier": 1})
+    monkeypatch.setattr(cache, "results", results)
+    app = Flask(__name__)
+
+    @app.route("/suppliers")
+    def suppliers():
+        try:
+            columns = api.projected_columns(AVAILABLE)
+        except ValueError as e:
+            abort(400, str(e))
+        etag = api.etag_for("suppliers", (), ["supplier"], columns)
+        cached = api.not_modified(etag)
+        if cached is not None:
+            return cached
+        return api.json_response({"rows": api.rows_as_dicts(ROWS, columns, AVAILABLE)}, etag)
+
+    return app.test_client()
+
+
+def test_unchanged_tables_answer_304(client):
+    response = client.get("/suppliers")
+    assert response.json == {"rows": [{"id": 1, "name": "Acme"}, {"id": 2, "name": "Bolt"}]}
+    etag = response.headers["ETag"]
+    assert etag.startswith('W/"')
+    again = client.get("/suppliers", headers={"If-None-Match": etag})
+    assert again.status_code == 304 and again.headers["ETag"] == etag
+    assert again.data == b""
+    # A write to a table the response was read from changes it
+    cache.bump("supplier")
+    changed = client.get("/suppliers", headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["ETag"] != etag
+
+
+def test_projections_have_their_own_etags(client):
+    full = client.get("/suppliers").headers["ETag"]
+    names = client.get("/suppliers?columns=name")
+    assert names.json == {"rows": [{"name": "Acme"}, {"name": "Bolt"}]}
+    assert names.headers["ETag"] != full
+    response = client.get("/suppliers?columns=name", headers={"If-None-Match": full})
+    assert response.status_code == 200
+    response = client.get("/suppliers?columns=name", headers={"If-None-Match": names.headers["ETag"]})
+    assert response.status_code == 304
+    assert client.get("/suppliers?columns=nope").status_code == 400
+
+
+def test_workers_answer_each_others_etags(client, monkeypatch):
+    etag = client.get("/suppliers").headers["ETag"]
+    # Another worker process, which read the same versions from the database
+    other = cache.ResultCache()
+    other.follow({"supplier": 1})
+    monkeypatch.setattr(cache, "results", other)
+    assert client.get("/suppliers", headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_large_bodies_are_gzipped(client, monkeypatch):
+    monkeypatch.setattr(api, "GZIP_MIN_SIZE", 10)
+    response = client.get("/suppliers", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
@@ -0,0 +1,114 @@
+import builtins
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import bakta
+from bakta import BaktaResult, iter_features
+
+FEATURES = [
+    {"type": "cds", "contig": "contig_1", "start": 1, "stop": 900, "strand": "+", "gene": "blaTEM",
+     "product": "Beta-lactamase", "locus": "ABC_00005", "nt": "ATG" * 300, "aa": "M" * 300,
+     "db_xrefs": ["SO:0001217"], "ups": {"uniparc_id": "UPI0000000001"}, "rbs_motif": None},
+    {"type": "cds", "contig": "contig_1", "start": 1000, "stop": 12345, "strand": "-", "gene": None,
+     "product": 'Say "hi" \\ café \U0001F9EC\ttab', "locus": "ABC_00010", "score": -1.5e-3},
+    {"type": "trna", "contig": "contig_2", "start": 7, "stop": 80, "strand": "+",
+     "product": "tRNA-Ala", "locus": "ABC_00015", "genes": []},
+]
+
+
+def document(features=FEATURES):
+    """
+    A Bakta-like JSON, with values before the features and the contigs after them
+    """
+    return json.dumps({
+        "genome": {"genus": "Escherichia", "complete": False},
+        "stats": {"no_sequences": 2, "size": 123456789},
+        "features": features,
+        "sequences": [{"id": "contig_1", "nt": "ACGT" * 100}],
+        "version": {"bakta": "1.9.1"},
+    }, ensure_ascii=False)
+
+
+class Trickle:
+    """
+    A text file that returns at most n characters a read
+    """
+    def __init__(self, file, n: int):
+        self.file = file
+        self.n = n
+
+    def read(self, size: int = -1) -> str:
+        return self.file.read(self.n if size < 0 else min(size, self.n))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.file.close()
+
+
+def trickle(monkeypatch, n: int):
+    monkeypatch.setattr(bakta, "open", lambda *args, **kwargs: Trickle(builtins.open(*args, **kwargs), n),
+                        raising=False)
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = tmp_path / "out.json"
+    path.write_text(document(), encoding="utf-8")
+    return path
+
+
+def test_features_equal_json_load(path):
+    with path.open(encoding="utf-8") as f:
+        data = json.load(f)
+    assert list(iter_features(path)) == data["features"]
+    assert BaktaResult.from_json(path).get_for_sarand() == BaktaResult(data=data).get_for_sarand()
+
+
+@pytest.mark.parametrize("n", [1, 2, 3, 5, 7, 64])
+def test_tokens_split_across_reads(path, monkeypatch, n):
+    # Every token, escape and number is cut somewhere for some n
+    trickle(monkeypatch, n)
+    assert list(iter_features(path)) == FEATURES
+
+
+@pytest.mark.parametrize("text", ['{"count": 12345, "features": [{"start": 678}]}',
+                                  '{"count": -1.5e+10 , "features": [{"start": 678}]}'])
+def test_number_ending_at_the_end_of_a_read(tmp_path, monkeypatch, text):
+    path = tmp_path / "out.json"
+    path.write_text(text)
+    # The first read ends right after the first digits of the number, then
+    # right after it: it is not decoded until the read after shows it is whole
+    for n in range(len('{"count": 1'), text.index(",") + 1):
+        trickle(monkeypatch, n)
+        assert list(iter_features(path)) == [{"start": 678}]
+
+
+def test_escaped_strings(tmp_path, monkeypatch):
+    features = [{"product": '\\"', "locus": "\\\\"}, {"product": "🧬 \"é\"", "gene": "a\\nb"}]
+    path = tmp_path / "out.json"
+    # Escaped as json.dumps does, including the key of the features
+    path.write_text(document(features).replace('"features"', '"feat\\u0075res"'), encoding="utf-8")
+    for n in range(1, 8):
+        trickle(monkeypatch, n)
+        assert list(iter_features(path)) == features
+
+
+@pytest.mark.parametrize("text, features", [("{}", []), ('{"features": []}', []), ('{"stats": {}}', [])])
+def test_documents_without_features(tmp_path, text, features):
+    path = tmp_path / "out.json"
+    path.write_text(text)
+    assert list(iter_features(path)) == features
+
+
+def test_truncated_document_is_an_error(tmp_path):
+    path = tmp_path / "out.json"
+    path.write_text(document()[:200])
+    with pytest.raises(ValueError):
+        list(iter_features(path))
@@ -0,0 +1,125 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import cache
+import data_version
+import db
+import schema
+
+
+class Counter:
+    """
+    A compute() that counts its calls
+    """
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.calls
+
+
+def test_write_drops_only_the_results_read_from_the_written_tables():
+    results = cache.ResultCache()
+    parts, suppliers = Counter(), Counter()
+    assert results.get_or_compute("parts", (), ["parts"], parts) == 1
+    assert results.get_or_compute("suppliers", (), ["supplier", "telephone"], suppliers) == 1
+    assert results.get_or_compute("parts", (), ["parts"], parts) == 1
+    results.bump("telephone")
+    assert results.get_or_compute("suppliers", (), ["supplier", "telephone"], suppliers) == 2
+    assert results.get_or_compute("parts", (), ["parts"], parts) == 1
+    stats = results.stats()
+    assert (stats["hits"], stats["misses"], stats["invalidations"], stats["entries"]) == (2, 3, 1, 2)
+
+
+def test_results_are_bounded_and_expire():
+    results = cache.ResultCache(max_entries=2, ttl=0)
+    compute = Counter()
+    for params in [(1,), (2,), (3,)]:
+        results.get_or_compute("parts", params, ["parts"], compute)
+    stats = results.stats()
+    assert (stats["entries"], stats["evictions"]) == (2, 1)
+    # Served for no time at all
+    assert results.get_or_compute("parts", (3,), ["parts"], compute) == 4
+    assert results.stats()["expirations"] == 1
+
+
+def test_shared_store_carries_writes_and_results_across_processes(tmp_path):
+    store = str(tmp_path / "cache.db")
+    first = cache.ResultCache(store=cache.SharedStore(store, 1 << 20))
+    second = cache.ResultCache(store=cache.SharedStore(store, 1 << 20))
+    compute = Counter()
+    first.get_or_compute("parts", (), ["parts"], compute)
+    assert second.get_or_compute("parts", (), ["parts"], compute) == 1
+    assert second.stats()["shared_hits"] == 1
+    first.bump("parts")
+    assert second.get_or_compute("parts", (), ["parts"], compute) == 2
+    assert first.tag(["parts"]) == second.tag(["parts"])
+
+
+def test_processes_tag_the_versions_they_follow_alike():
+    first, second = cache.ResultCache(), cache.ResultCache()
+    # Nothing followed yet: only meaningful within each process
+    assert first.tag(["parts"]) != second.tag(["parts"])
+    for results in (first, second):
+        assert results.follow({"parts": 3, "orders": 1}) == ["orders", "parts"]
+    assert first.tag(["parts"]) == second.tag(["parts"])
+    # A write not yet seen in the database's versions is this process's own
+    first.bump("parts")
+    assert first.tag(["parts"]) != second.tag(["parts"])
+    assert first.tag(["orders"]) == second.tag(["orders"])
+    # until it is followed
+    for results in (first, second):
+        assert results.follow({"parts": 4, "orders": 1}) == ["parts"]
+    assert first.tag(["parts"]) == second.tag(["parts"])
+
+
+def test_follow_drops_the_results_of_changed_tables():
+    results = cache.ResultCache()
+    compute = Counter()
+    results.follow({"parts": 1})
+    results.get_or_compute("parts", (), ["parts"], compute)
+    assert results.follow({"parts": 1}) == []
+    assert results.get_or_compute("parts", (), ["parts"], compute) == 1
+    assert results.follow({"parts": 2}) == ["parts"]
+    assert results.stats()["entries"] == 0
+    assert results.get_or_compute("parts", (), ["parts"], compute) == 2
+
+
+@pytest.fixture
+def conn(tmp_path):
+    pool = db.ConnectionPool(db.SQLiteBackend(str(tmp_path / "muc.db")))
+    conn = pool.acquire()
+    schema.migrate(conn)
+    yield conn
+    conn.close()
+    pool.close()
+
+
+def sync(conn, monkeypatch, results):
+    monkeypatch.setattr(cache, "results", results)
+    monkeypatch.setattr(data_version, "_synced", float("-inf"))
+    return data_version.sync(lambda: conn, {"spend": ("spend_supplier",)})
+
+
+def test_sync_follows_writes_made_outside_the_app(conn, monkeypatch):
+    first, second = cache.ResultCache(), cache.ResultCache()
+    assert "parts" in sync(conn, monkeypatch, first)
+    sync(conn, monkeypatch, second)
+    assert first.tag(["parts", "spend_supplier"]) == second.tag(["parts", "spend_supplier"])
+    compute = Counter()
+    first.get_or_compute("spend", (), ["spend_supplier"], compute)
+    cur = conn.cursor()
+    cur.execute("INSERT INTO parts (_id, price, description) VALUES (1, 2.0, 'nut')")
+    conn.commit()
+    cur.close()
+    # A new part can join order lines, so the spend aggregate's tables move too
+    assert sync(conn, monkeypatch, first) == ["parts", "spend_supplier"]
+    assert first.get_or_compute("spend", (), ["spend_supplier"], compute) == 2
+    assert first.tag(["parts"]) != second.tag(["parts"])
+    sync(conn, monkeypatch, second)
+    assert first.tag(["parts", "spend_supplier"]) == second.tag(["parts", "spend_supplier"])
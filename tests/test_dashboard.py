@@ -0,0 +1,68 @@
+import sys
+import time
+from pathlib import Path
+
+import pytest
+from flask import Flask, jsonify
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import dashboard
+import db
+import metrics
+
+# Never returns unless the database aborts it
+ENDLESS = "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT COUNT(*) FROM c"
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = db.ConnectionPool(db.SQLiteBackend(str(tmp_path / "muc.db")), max_size=4)
+    yield pool
+    pool.close()
+
+
+def endless(connect):
+    return dashboard._fetchone(connect, ENDLESS)[0]
+
+
+def route(connect):
+    return metrics.current_route()
+
+
+def test_timed_out_section_frees_its_thread_and_connection(pool, monkeypatch):
+    monkeypatch.setattr(dashboard, "SECTIONS", {"endless": endless, "quick": lambda connect: 1})
+    out = dashboard.collect(pool.acquire, timeout=0.2)
+    assert out["endless"]["stale"] and out["endless"]["error"] == "timed out"
+    assert out["quick"] == {"value": 1, "stale": False, "error": None, "seconds": out["quick"]["seconds"]}
+    # The query is aborted at the deadline, rather than running on
+    deadline = time.monotonic() + 5
+    while (dashboard._abandoned or pool.stats()["in_use"]) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert dashboard._abandoned == 0
+    assert pool.stats()["in_use"] == 0
+    # and the connection goes back to the pool without the timeout
+    conn = pool.acquire()
+    cur = conn.cursor()
+    cur.execute("WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 300000) "
+                "SELECT COUNT(*) FROM c")
+    assert cur.fetchone()[0] == 300000
+    conn.close()
+
+
+def test_busy_threads_are_not_queued_behind(pool, monkeypatch):
+    monkeypatch.setattr(dashboard, "SECTIONS", {"quick": lambda connect: 1})
+    monkeypatch.setattr(dashboard, "_last_good", {"quick": 0})
+    monkeypatch.setattr(dashboard, "_abandoned", dashboard.DASHBOARD_WORKERS)
+    assert dashboard.collect(pool.acquire)["quick"] == {"value": 0, "stale": True, "error": "busy", "seconds": None}
+
+
+def test_sections_run_in_the_request_context(pool, monkeypatch):
+    monkeypatch.setattr(dashboard, "SECTIONS", {"route": route})
+    app = Flask(__name__)
+
+    @app.route("/dashboard")
+    def show():
+        return jsonify(dashboard.collect(pool.acquire)["route"]["value"])
+
+    assert app.test_client().get("/dashboard").json == "/dashboard"
@@ -0,0 +1,229 @@
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+from flask import Flask, jsonify
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import db
+
+
+def count(conn, sql="SELECT COUNT(*) FROM t"):
+    cur = conn.cursor()
+    cur.execute(sql)
+    value = cur.fetchone()[0]
+    cur.close()
+    return value
+
+
+@pytest.fixture
+def backend(tmp_path):
+    backend = db.SQLiteBackend(str(tmp_path / "muc.db"))
+    raw = backend.connect()
+    raw.execute("CREATE TABLE t (x INT, d DATE)")
+    raw.commit()
+    raw.close()
+    return backend
+
+
+def test_connections_are_reused(backend):
+    pool = db.ConnectionPool(backend, min_size=1, max_size=2)
+    conn = pool.acquire()
+    raw = conn.raw
+    conn.close()
+    # Closing twice hands it back once
+    conn.close()
+    assert pool.stats()["idle"] == 1
+    again = pool.acquire()
+    assert again.raw is raw
+    other = pool.acquire()
+    assert other.raw is not raw
+    stats = pool.stats()
+    assert (stats["size"], stats["in_use"], stats["checkouts"], stats["connects"]) == (2, 2, 3, 2)
+    again.close()
+    other.close()
+    pool.close()
+    assert pool.stats()["size"] == 0
+
+
+def test_returned_connections_are_rolled_back(backend):
+    pool = db.ConnectionPool(backend, max_size=1)
+    conn = pool.acquire()
+    cur = conn.cursor()
+    cur.execute("INSERT INTO t (x) VALUES (%s)", (1,))
+    cur.close()
+    conn.close()
+    conn = pool.acquire()
+    assert count(conn) == 0
+    conn.close()
+
+
+def test_pool_timeout(backend):
+    pool = db.ConnectionPool(backend, max_size=1, timeout=0.05)
+    conn = pool.acquire()
+    with pytest.raises(db.PoolTimeout):
+        pool.acquire()
+    assert pool.stats()["timeouts"] == 1
+    # A waiter gets the connection as soon as it is returned
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.acquire()))
+    pool.timeout = 5
+    waiter.start()
+    conn.close()
+    waiter.join()
+    assert got[0].raw is conn.raw
+    assert pool.stats()["waits"] == 2
+    got[0].close()
+
+
+def test_dead_connection_is_replaced(backend):
+    pool = db.ConnectionPool(backend, min_size=1, max_size=1)
+    raw, _ = pool._idle[0]
+    # The server dropped the idle connection
+    raw.close()
+    conn = pool.acquire()
+    assert conn.raw is not raw
+    assert count(conn) == 0
+    assert pool.stats()["ping_failures"] == 1
+    # A connection that broke while checked out is dropped, and its slot freed
+    conn.raw.close()
+    conn.close()
+    assert pool.stats()["size"] == 0
+    conn = pool.acquire()
+    assert count(conn) == 0
+    conn.close()
+
+
+def test_old_connections_are_recycled(backend):
+    pool = db.ConnectionPool(backend, min_size=1, recycle=0)
+    raw, _ = pool._idle[0]
+    conn = pool.acquire()
+    assert conn.raw is not raw
+    assert pool.stats()["recycled"] == 1
+    conn.close()
+
+
+def test_failed_connect_frees_the_slot(backend, monkeypatch):
+    pool = db.ConnectionPool(backend, min_size=0, max_size=1, timeout=0.05)
+
+    def refuse():
+        raise ConnectionError("refused")
+    monkeypatch.setattr(backend, "connect", refuse)
+    with pytest.raises(ConnectionError):
+        pool.acquire()
+    monkeypatch.undo()
+    pool.acquire().close()
+
+
+def test_sqlite_backend_speaks_the_routes_sql():
+    backend = db.SQLiteBackend()
+    pool = db.ConnectionPool(backend, max_size=2)
+    conn = pool.acquire()
+    assert conn.dialect == "sqlite"
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE t (x INT, d DATE)")
+    cur.executemany("INSERT INTO t (x, d) VALUES (%s, %s)", [(1, "2021-03-04"), (2, "2022-11-30")])
+    conn.commit()
+    cur.execute("SELECT YEAR(d), MONTH(d), GROUP_CONCAT(x SEPARATOR ';') FROM t GROUP BY YEAR(d) ORDER BY 1")
+    # Rows come back as a tuple of tuples, as from MySQLdb
+    assert cur.fetchall() == ((2021, 3, "1"), (2022, 11, "2"))
+    cur.close()
+    # Every connection sees the same in-memory database
+    other = pool.acquire()
+    assert count(other) == 2
+    cur = other.cursor(dict_rows=True)
+    cur.execute("SELECT x FROM t WHERE x = %s", (2,))
+    assert list(cur.fetchall()) == [{"x": 2}]
+    cur.close()
+    other.close()
+    conn.close()
+    # and a new backend its own
+    fresh = db.SQLiteBackend().connect()
+    assert fresh.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0
+
+
+def database(path, x):
+    """
+    A pool over a database at path whose table t holds x, telling the databases apart
+    """
+    backend = db.SQLiteBackend(str(path))
+    raw = backend.connect()
+    raw.execute("CREATE TABLE t (x INT)")
+    raw.execute("INSERT INTO t (x) VALUES (?)", (x,))
+    raw.commit()
+    raw.close()
+    return db.ConnectionPool(backend, min_size=0, max_size=2, timeout=0.05, name=path.stem)
+
+
+@pytest.fixture
+def router(tmp_path):
+    return db.Router(database(tmp_path / "primary.db", 1), [database(tmp_path / "replica.db", 2)],
+                     sticky_seconds=60)
+
+
+def read(conn):
+    value = count(conn, "SELECT x FROM t")
+    conn.close()
+    return value
+
+
+def test_reads_go_to_the_replica(router):
+    assert read(router.acquire_read()) == 2
+    assert router.stats()["replica_reads"] == 1
+
+
+def test_failed_replica_falls_back_to_the_primary(router, tmp_path, monkeypatch):
+    replica = router.replicas[0]
+
+    def refuse():
+        raise ConnectionError("refused")
+    monkeypatch.setattr(replica.backend, "connect", refuse)
+    assert read(router.acquire_read()) == 1
+    assert router.stats()["replicas"][0]["down"]
+    monkeypatch.undo()
+    # Skipped for retry_after, even though it is back
+    assert read(router.acquire_read()) == 1
+    router._down_until[replica.name] = 0
+    assert read(router.acquire_read()) == 2
+
+
+def test_busy_replica_is_not_marked_down(router):
+    held = [router.replicas[0].acquire() for _ in range(2)]
+    assert read(router.acquire_read()) == 1
+    stats = router.stats()
+    assert stats["fallbacks"] == 1 and not stats["replicas"][0]["down"]
+    held.pop().close()
+    assert read(router.acquire_read()) == 2
+    held.pop().close()
+
+
+def test_client_reads_its_writes_from_the_primary(router):
+    app = Flask(__name__)
+    db.init_app(app, router)
+
+    @app.route("/write", methods=["POST"])
+    def write():
+        conn = db.get_connection()
+        cur = conn.cursor()
+        cur.execute("UPDATE t SET x = 3")
+        cur.close()
+        conn.commit()
+        return "", 204
+
+    @app.route("/read")
+    def read_route():
+        return jsonify(count(db.get_read_connection(), "SELECT x FROM t"))
+
+    client = app.test_client()
+    assert client.get("/read").json == 2
+    response = client.post("/write")
+    assert response.headers["Set-Cookie"].startswith(db.STICKY_COOKIE + "=")
+    # The replica has not seen the write yet, the primary has
+    assert client.get("/read").json == 3
+    assert router.stats()["sticky_reads"] == 1
+    # Other clients still read from the replica
+    assert app.test_client().get("/read").json == 2
+    # and every checked out connection went back to its pool
+    assert router.primary.stats()["in_use"] == 0 and router.replicas[0].stats()["in_use"] == 0
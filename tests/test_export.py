@@ -0,0 +1,81 @@
+import csv
+import gzip
+import io
+import sys
+import zlib
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import db
+import export
+import queries
+import rollup
+import schema
+
+
+@pytest.fixture
+def conn(tmp_path):
+    pool = db.ConnectionPool(db.SQLiteBackend(str(tmp_path / "muc.db")))
+    conn = pool.acquire()
+    schema.migrate(conn)
+    cur = conn.cursor()
+    cur.executemany("INSERT INTO supplier (_id, name, email) VALUES (%s, %s, %s)",
+                    [(1, 'Acme, "the" best', "a@x"), (2, "Bolt", None), (3, "Cog\nworks", "c@x")])
+    cur.executemany("INSERT INTO telephone (sup_id, tel) VALUES (%s, %s)", [(1, "111"), (1, "112"), (3, "311")])
+    conn.commit()
+    cur.close()
+    yield conn
+    conn.close()
+    pool.close()
+
+
+def export_rows(conn, name, params=()):
+    """
+    The rows of an export, read as the export route reads them
+    """
+    sql, columns, _ = export.EXPORTS[name]
+    cur = conn.cursor(dict_rows=True, server_side=True)
+    cur.execute(rollup.readable(conn, sql), params)
+    rows = queries.iter_rows(cur, batch_size=2)
+    if name in queries.TABLES:
+        rows = map(queries.TABLES[name].decode, rows)
+    return columns, rows
+
+
+def test_table_export_is_streamed_as_csv(conn):
+    chunks = list(export.csv_chunks(*export_rows(conn, "suppliers"), batch_size=2))
+    # The header on its own, then a chunk per batch of rows
+    assert chunks[0] == b"_id,name,email,phones\r\n"
+    assert len(chunks) == 3
+    assert list(csv.reader(io.StringIO(b"".join(chunks).decode()))) == [
+        ["_id", "name", "email", "phones"],
+        ["1", 'Acme, "the" best', "a@x", "111,112"],
+        ["2", "Bolt", "", ""],
+        ["3", "Cog\nworks", "c@x", "311"],
+    ]
+
+
+def test_exact_batches_end_without_an_empty_chunk():
+    rows = [{"year": year, "total": 1} for year in range(4)]
+    chunks = list(export.csv_chunks(["year", "total"], rows, batch_size=2))
+    assert chunks == [b"year,total\r\n", b"0,1\r\n1,1\r\n", b"2,1\r\n3,1\r\n"]
+    # and an export without rows is just the header
+    assert list(export.csv_chunks(["year", "total"], [])) == [b"year,total\r\n"]
+
+
+def test_gzip_export_is_one_stream_flushed_per_chunk(conn):
+    plain = list(export.csv_chunks(*export_rows(conn, "suppliers"), batch_size=2))
+    compressed = list(export.gzip_chunks(iter(plain)))
+    assert gzip.decompress(b"".join(compressed)) == b"".join(plain)
+    # Every chunk can be decompressed as it arrives, before the stream ends
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk, data in zip(plain, compressed):
+        assert decompressor.decompress(data) == chunk
+
+
+def test_empty_report_exports_the_header(conn):
+    chunks = export.gzip_chunks(export.csv_chunks(*export_rows(conn, "annual-expense", (0, 9999))))
+    assert gzip.decompress(b"".join(chunks)) == b"year,total,line_count\r\n"
@@ -0,0 +1,64 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import db
+import queries
+import schema
+
+SUPPLIERS = queries.TABLES["suppliers"]
+
+
+@pytest.fixture
+def conn(tmp_path):
+    pool = db.ConnectionPool(db.SQLiteBackend(str(tmp_path / "muc.db")))
+    conn = pool.acquire()
+    schema.migrate(conn)
+    cur = conn.cursor()
+    cur.executemany("INSERT INTO supplier (_id, name, email) VALUES (%s, %s, %s)",
+                    [(1, "Acme", "a@x"), (2, "Bolt", "b@x"), (3, "Cog", "c@x")])
+    cur.executemany("INSERT INTO telephone (sup_id, tel) VALUES (%s, %s)",
+                    [(1, "111"), (1, "112"), (1, "113"), (3, "+1 (311), ext. 2")])
+    conn.commit()
+    cur.close()
+    yield conn
+    conn.close()
+    pool.close()
+
+
+def page(conn, cursor=None, size=10, predicates=None, params=None):
+    cur = conn.cursor(dict_rows=True)
+    try:
+        return SUPPLIERS.fetch_page(cur, cursor, size, predicates, params)
+    finally:
+        cur.close()
+
+
+def test_one_row_per_supplier_with_its_phones(conn):
+    rows, next_cursor = page(conn)
+    assert next_cursor is None
+    assert [(row["_id"], sorted(row["phones"])) for row in rows] == [
+        (1, ["111", "112", "113"]),
+        # A supplier without a phone is still listed
+        (2, []),
+        # and a number with commas in it stays one number
+        (3, ["+1 (311), ext. 2"]),
+    ]
+
+
+def test_pages_never_split_a_supplier(conn):
+    first, cursor = page(conn, size=1)
+    assert [row["_id"] for row in first] == [1] and len(first[0]["phones"]) == 3
+    second, cursor = page(conn, cursor, size=1)
+    third, cursor = page(conn, cursor, size=1)
+    assert [row["_id"] for row in second + third] == [2, 3] and cursor is None
+
+
+def test_phone_filter_keeps_every_phone_of_a_match(conn):
+    predicate, params = SUPPLIERS.filter("tel", "112")
+    rows, _ = page(conn, predicates=[predicate], params=params)
+    assert [(row["_id"], sorted(row["phones"])) for row in rows] == [(1, ["111", "112", "113"])]
+    assert page(conn, predicates=[predicate], params=["9%"])[0] == []
@@ -0,0 +1,73 @@
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import scheduler
+from scheduler import CpuScheduler
+
+
+def fitted(budget, max_jobs=None):
+    """
+    A scheduler whose Bakta model is 2 s of start-up plus 0.1 ms per base and thread
+    """
+    scheduler = CpuScheduler(budget=budget, max_jobs=max_jobs)
+    for bases, threads in [(1000, 1), (1000, 4), (100000, 2), (100000, 8)]:
+        scheduler.record('bakta', bases, threads, 2 + 1e-4 * bases / threads)
+    return scheduler
+
+
+def test_short_sequences_run_single_threaded():
+    scheduler = fitted(16, max_jobs=16)
+    assert [scheduler.acquire(1000, pending=1) for _ in range(16)] == [1] * 16
+
+
+def test_long_job_takes_the_cpus_it_can_use():
+    # Nothing else waits, so one long sequence is not held to a 1/16 share
+    assert fitted(16).acquire(10_000_000) == 16
+    # A 9th thread would save less than 5% of the predicted 3.25 s
+    assert fitted(16).acquire(100_000) == 8
+
+
+def test_grant_is_bounded_by_the_fair_share_of_waiting_jobs():
+    scheduler = fitted(16, max_jobs=4)
+    # One more job follows: half the free CPUs each
+    assert scheduler.acquire(10_000_000, pending=1) == 8
+    assert scheduler.acquire(10_000_000) == 8
+    scheduler = fitted(16, max_jobs=4)
+    # More jobs follow than slots are open: a quarter each
+    assert scheduler.acquire(10_000_000, pending=10) == 4
+
+
+def test_jobs_blocked_in_acquire_count_as_waiting():
+    scheduler = fitted(4, max_jobs=4)
+    grants = [scheduler.acquire(10_000_000)]
+    assert grants == [4]
+    waiter = threading.Thread(target=lambda: grants.append(scheduler.acquire(10_000_000)))
+    waiter.start()
+    while scheduler._waiting == 0:
+        time.sleep(0.01)
+    scheduler.release(4)
+    # The waiter takes what it can use once released, having no one behind it
+    waiter.join()
+    assert grants == [4, 4]
+
+
+def test_freed_cpus_run_more_jobs():
+    scheduler = fitted(4, max_jobs=4)
+    grants = [scheduler.acquire(1000, pending=1) for _ in range(4)]
+    scheduler.release(grants.pop())
+    assert scheduler.acquire(1000) == 1
+    assert scheduler.stats()["running"] == 4
+
+
+def test_jobs_are_bounded_by_memory(monkeypatch):
+    monkeypatch.setattr(scheduler, "ANNOTATION_MAX_JOBS", 0)
+    monkeypatch.setattr(scheduler, "ANNOTATION_JOB_MEMORY_MB", 1 << 40)
+    assert CpuScheduler(budget=16).max_jobs == 1
+    monkeypatch.setattr(scheduler, "ANNOTATION_JOB_MEMORY_MB", 1)
+    assert CpuScheduler(budget=16).max_jobs == 16
+    monkeypatch.setattr(scheduler, "ANNOTATION_MAX_JOBS", 3)
+    assert CpuScheduler(budget=16).max_jobs == 3
@@ -0,0 +1,53 @@
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import db
+import schema
+import suppliers
+
+
+@pytest.fixture
+def conn(tmp_path):
+    pool = db.ConnectionPool(db.SQLiteBackend(str(tmp_path / "muc.db")))
+    conn = pool.acquire()
+    schema.migrate(conn)
+    yield conn
+    conn.close()
+    pool.close()
+
+
+def test_bad_rows_are_reported_without_aborting_the_batch(conn):
+    rows = suppliers.parse_json(json.dumps([
+        {"id": 5001, "name": "Acme", "email": "a@x", "numbers": ["111", 112]},
+        {"id": 5002, "name": 123},
+        {"id": 5003, "name": "Bolt", "email": ["b@x"]},
+        {"id": 5004, "name": "Nut", "numbers": 5},
+        {"id": "x", "name": "Pin"},
+        {"id": 5001, "name": "Again"},
+    ]))
+    inserted, errors = suppliers.import_suppliers(conn, rows, chunk_size=2)
+    assert inserted == [5001]
+    assert errors == [
+        (1, "name must be a string"),
+        (2, "email must be a string"),
+        (3, "numbers must be a string or a list"),
+        (4, "id must be an integer"),
+        (5, "Duplicate supplier 5001 in batch"),
+    ]
+    cur = conn.cursor()
+    cur.execute("SELECT tel FROM telephone WHERE sup_id = %s ORDER BY tel", (5001,))
+    assert [row[0] for row in cur.fetchall()] == ["111", "112"]
+    cur.close()
+
+
+def test_existing_suppliers_are_skipped(conn):
+    suppliers.import_suppliers(conn, [{"id": 1, "name": "Acme", "numbers": "1;2"}])
+    rows = suppliers.parse_csv("id,name,email,numbers\n1,Acme,,\n2,Bolt,b@x,\"3,4\"\n")
+    inserted, errors = suppliers.import_suppliers(conn, rows)
+    assert inserted == [2]
+    assert errors == [(0, suppliers.SUPPLIER_EXISTS)]
@@ -0,0 +1,77 @@
+import asyncio
+import os
+import signal
+import sys
+import time
+from multiprocessing import Pool
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import tool_runner
+
+# A tool that starts a child of its own, writes both PIDs and waits
+HANGING_TOOL = """
+import os, subprocess, sys, time
+child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+with open(sys.argv[1] + ".tmp", "w") as f:
+    f.write(f"{os.getpid()} {child.pid}")
+os.rename(sys.argv[1] + ".tmp", sys.argv[1])
+time.sleep(60)
+"""
+
+
+def alive(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # An exited process nobody reaped yet is a zombie
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+    except OSError:
+        pass
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def run_hanging_tool(pid_file):
+    cmd = [sys.executable, "-c", HANGING_TOOL, str(pid_file)]
+    log = Path(str(pid_file) + ".log")
+    return asyncio.run(tool_runner.run(cmd, log, log))
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+@pytest.mark.parametrize("stop", ["terminate", "interrupt"])
+def test_stopped_worker_kills_its_tool(tmp_path, monkeypatch, stop):
+    monkeypatch.setattr(tool_runner, "TOOL_KILL_GRACE_SECONDS", 1)
+    pid_file = tmp_path / "pids"
+    pool = Pool(1, initializer=tool_runner.install_signal_handlers)
+    try:
+        worker = pool._pool[0]
+        pool.apply_async(run_hanging_tool, (pid_file,))
+        assert wait_for(pid_file.exists)
+        pids = [int(pid) for pid in pid_file.read_text().split()]
+        assert all(alive(pid) for pid in pids)
+        if stop == "terminate":
+            # What leaving `with Pool(...)` early, or after a failed unit, does
+            pool.terminate()
+        else:
+            # Ctrl-C reaches the workers but not the tools' sessions
+            os.kill(worker.pid, signal.SIGINT)
+        assert wait_for(lambda: not any(alive(pid) for pid in pids))
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,246 @@
+import asyncio
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import weakref
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import tool_runner
+from config import CONDA_EXE_NAME, TOOL_CACHE_FILE, TOOL_VERSION_TIMEOUT
+
+"""
+Resolving the executables of the tools once, instead of on every run.
+
+"conda run -n" starts an interpreter and activates the environment on every
+call, which costs seconds per annotated sequence. Instead the environment is
+activated once, with "conda run -n <name> env -0", to find the variables
+activation sets and the tool's executable on the activated PATH, and the
+tool is then run directly with those variables. The result is kept in
+TOOL_CACHE_FILE, with the tool's version, under the modification time of the
+environment's conda-meta directory, which changes whenever a package is
+installed or removed, so a stale entry is found again. Tools outside conda
+are resolved on PATH and keyed by the executable's modification time.
+"""
+
+# Set by the shell or by "conda run" itself, and not by activation
+VOLATILE = ('_', 'PWD', 'OLDPWD', 'SHLVL')
+# The version of a tool whose output names none
+PROGRAM_VERSION_NA = 'NA'
+
+
+class ResolvedTool:
+    """
+    A tool's executable and the environment it runs in.
+    """
+    __slots__ = ('executable', 'prefix', 'mtime', 'set_env', 'prepend_env', 'version')
+
+    def __init__(
+            self,
+            executable: str,
+            prefix: Optional[str],
+            mtime: int,
+            set_env: Optional[Dict[str, str]] = None,
+            prepend_env: Optional[Dict[str, str]] = None,
+            version: Optional[str] = None,
+    ):
+        """
+        Args:
+            executable: Absolute path of the tool
+            prefix: The conda environment the tool is installed in, if any
+            mtime: The modification time (ns) the entry is valid for
+            set_env: Variables activation sets
+            prepend_env: Variables activation prepends to, e.g. PATH, with what it prepends
+            version: The tool's version, once checked
+        """
+        self.executable: str = executable
+        self.prefix: Optional[str] = prefix
+        self.mtime: int = mtime
+        self.set_env: Dict[str, str] = set_env or {}
+        self.prepend_env: Dict[str, str] = prepend_env or {}
+        self.version: Optional[str] = version
+
+    def watched(self) -> Path:
+        """
+        The path whose modification invalidates the entry
+        """
+        if self.prefix:
+            return Path(self.prefix) / "conda-meta"
+        return Path(self.executable)
+
+    def is_current(self) -> bool:
+        try:
+            return os.stat(self.watched()).st_mtime_ns == self.mtime and os.access(self.executable, os.X_OK)
+        except OSError:
+            return False
+
+    def env(self) -> Optional[Dict[str, str]]:
+        """
+        The environment to run the tool in, or None for this process's
+        """
+        if not self.set_env and not self.prepend_env:
+            return None
+        env = dict(os.environ)
+        env.update(self.set_env)
+        for name, prefix in self.prepend_env.items():
+            env[name] = prefix + env.get(name, "")
+        return env
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+# key -> ResolvedTool, checked against the disk once per process
+_resolved: Dict[str, ResolvedTool] = {}
+
+# The file lock is held across awaits, so coroutines of a loop take turns
+_locks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]" = weakref.WeakKeyDictionary()
+
+
+def _lock() -> asyncio.Lock:
+    loop = asyncio.get_running_loop()
+    lock = _locks.get(loop)
+    if lock is None:
+        lock = _locks[loop] = asyncio.Lock()
+    return lock
+
+
+def _key(tool: str, env_name: Optional[str]) -> str:
+    return f"{env_name or ''}:{tool}"
+
+
+@contextmanager
+def _cache_file():
+    """
+    The entries of TOOL_CACHE_FILE under an exclusive lock, written back on exit
+    """
+    path = Path(TOOL_CACHE_FILE)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(str(path) + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            try:
+                with path.open() as f:
+                    entries = json.load(f)
+            except (OSError, ValueError):
+                entries = {}
+            before = json.dumps(entries, sort_keys=True)
+            yield entries
+            if json.dumps(entries, sort_keys=True) != before:
+                fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+                with os.fdopen(fd, "w") as f:
+                    json.dump(entries, f)
+                os.replace(tmp, path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _activation(before: Dict[str, str], after: Dict[str, str]) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    The variables activation sets and prepends to, from the environment
+    before and after it
+    """
+    set_env, prepend_env = {}, {}
+    for name, value in after.items():
+        old = before.get(name)
+        if name in VOLATILE or value == old:
+            continue
+        if old and value.endswith(old):
+            prepend_env[name] = value[:-len(old)]
+        else:
+            set_env[name] = value
+    return set_env, prepend_env
+
+
+async def _resolve(tool: str, env_name: Optional[str]) -> Optional[ResolvedTool]:
+    if not env_name:
+        executable = shutil.which(tool)
+        if executable is None:
+            return None
+        return ResolvedTool(executable, None, os.stat(executable).st_mtime_ns)
+    cmd = [CONDA_EXE_NAME, 'run', '-n', env_name, 'env', '-0']
+    try:
+        returncode, stdout, _ = await tool_runner.capture(cmd, TOOL_VERSION_TIMEOUT)
+    except (OSError, TimeoutError):
+        return None
+    if returncode != 0:
+        return None
+    after = dict(item.split("=", 1) for item in stdout.split("\0") if "=" in item)
+    prefix = after.get('CONDA_PREFIX')
+    executable = shutil.which(tool, path=after.get('PATH'))
+    if not prefix or executable is None:
+        return None
+    set_env, prepend_env = _activation(dict(os.environ), after)
+    try:
+        mtime = os.stat(Path(prefix) / "conda-meta").st_mtime_ns
+    except OSError:
+        return None
+    return ResolvedTool(executable, prefix, mtime, set_env, prepend_env)
+
+
+async def resolve(tool: str, env_name: Optional[str] = None) -> Optional[ResolvedTool]:
+    """
+    To find a tool, from the cache when its environment is unchanged
+    Parameters:
+        tool: the name of the tool's executable
+        env_name: the conda environment the tool is installed in, if any
+    Return:
+        the resolved tool, or None if it could not be found
+    """
+    key = _key(tool, env_name)
+    if key in _resolved:
+        return _resolved[key]
+    async with _lock():
+        if key in _resolved:
+            return _resolved[key]
+        with _cache_file() as entries:
+            entry = entries.get(key)
+            resolved = ResolvedTool(**entry) if entry else None
+            if resolved is None or not resolved.is_current():
+                resolved = await _resolve(tool, env_name)
+                if resolved is None:
+                    entries.pop(key, None)
+                else:
+                    entries[key] = resolved.as_dict()
+        if resolved is not None:
+            _resolved[key] = resolved
+        return resolved
+
+
+async def command(tool: str, env_name: Optional[str], args: List[str]) -> Tuple[List[str], Optional[Dict[str, str]]]:
+    """
+    The command running a tool with args, and its environment. Falls back to
+    "conda run" when the environment cannot be resolved.
+    """
+    resolved = await resolve(tool, env_name)
+    if resolved is not None:
+        return [resolved.executable] + args, resolved.env()
+    if env_name:
+        return [CONDA_EXE_NAME, 'run', '-n', env_name, tool] + args, None
+    return [tool] + args, None
+
+
+def cached_version(tool: str, env_name: Optional[str] = None) -> Optional[str]:
+    """
+    The version of a tool stored by store_version(), if resolve() found it current
+    """
+    resolved = _resolved.get(_key(tool, env_name))
+    return resolved.version if resolved is not None else None
+
+
+def store_version(tool: str, env_name: Optional[str], version: str):
+    """
+    To keep a tool's version with its resolved entry
+    """
+    key = _key(tool, env_name)
+    resolved = _resolved.get(key)
+    if resolved is None:
+        return
+    resolved.version = version
+    with _cache_file() as entries:
+        entry = entries.get(key)
+        if entry and entry['mtime'] == resolved.mtime and entry['executable'] == resolved.executable:
+            entry['version'] = version
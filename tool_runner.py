@@ -0,0 +1,151 @@
+import asyncio
+import os
+import signal
+import weakref
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from config import TOOL_KILL_GRACE_SECONDS, TOOL_MAX_CONCURRENCY
+
+"""
+Running the external tools (Bakta, RGI) as asyncio subprocesses.
+
+Every run is started in a session of its own, so that when it times out or
+the task awaiting it is cancelled the whole process group is killed,
+including the children of "conda run" and the aligners the tools start.
+Being in a session of its own, a run gets neither Ctrl-C nor the signal
+that terminates the process running it, so processes that run the tools,
+such as the annotation pool's workers, install_signal_handlers(): the
+signal then interrupts the event loop, asyncio.run() cancels the runs in
+flight, and each kills its process group on the way out.
+Output goes straight to log files instead of being buffered in memory, and
+at most TOOL_MAX_CONCURRENCY runs are in flight per event loop, so one loop
+can orchestrate any number of annotation jobs.
+"""
+
+_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _interrupt(signum, frame):
+    # Once is enough: a second signal must not cut the killing short
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if signum == signal.SIGINT:
+        raise KeyboardInterrupt
+    raise SystemExit(128 + signum)
+
+
+def install_signal_handlers():
+    """
+    To make SIGTERM and SIGINT raise in this process, e.g. as the initializer
+    of a multiprocessing pool, whose terminate() sends its workers SIGTERM,
+    so the tool runs in flight are killed rather than orphaned
+    """
+    signal.signal(signal.SIGTERM, _interrupt)
+    signal.signal(signal.SIGINT, _interrupt)
+
+
+def _semaphore() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(TOOL_MAX_CONCURRENCY)
+    return semaphore
+
+
+def _signal_group(proc: asyncio.subprocess.Process, sig: int):
+    try:
+        os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+async def _stop(proc: asyncio.subprocess.Process):
+    """
+    To terminate a process group, killing it if it outlives the grace period
+    """
+    if proc.returncode is not None:
+        # The leader exited but its children may not have
+        _signal_group(proc, signal.SIGKILL)
+        return
+    _signal_group(proc, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(proc.wait(), TOOL_KILL_GRACE_SECONDS)
+    except asyncio.TimeoutError:
+        pass
+    _signal_group(proc, signal.SIGKILL)
+    await proc.wait()
+
+
+async def _supervise(proc: asyncio.subprocess.Process, cmd: List[str], waiting, timeout: Optional[float]):
+    try:
+        return await asyncio.wait_for(waiting, timeout)
+    except asyncio.TimeoutError:
+        await asyncio.shield(_stop(proc))
+        raise TimeoutError(f"{cmd[0]} did not finish within {timeout} seconds")
+    except asyncio.CancelledError:
+        await asyncio.shield(_stop(proc))
+        raise
+
+
+async def run(
+        cmd: List[str], stdout: Path, stderr: Path, timeout: Optional[float] = None,
+        env: Optional[Dict[str, str]] = None,
+) -> int:
+    """
+    To run a command with its output written to files
+    Parameters:
+        cmd: the command and its arguments
+        stdout: the file the command's standard output is written to
+        stderr: the file the command's standard error is written to
+        timeout: the seconds after which the command is killed (default = never)
+        env: the environment of the command (default = this process's)
+    Return:
+        the exit code of the command
+    """
+    async with _semaphore():
+        with open(stdout, "wb") as out, open(stderr, "wb") as err:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdin=asyncio.subprocess.DEVNULL, stdout=out, stderr=err,
+                env=env, start_new_session=True,
+            )
+            return await _supervise(proc, cmd, proc.wait(), timeout)
+
+
+async def capture(
+        cmd: List[str], timeout: Optional[float] = None, env: Optional[Dict[str, str]] = None,
+) -> Tuple[int, str, str]:
+    """
+    To run a command with a short output, such as a version check
+    Return:
+        the exit code, standard output and standard error of the command
+    """
+    async with _semaphore():
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE, env=env, start_new_session=True,
+        )
+        stdout, stderr = await _supervise(proc, cmd, proc.communicate(), timeout)
+        return proc.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace")
+
+
+def tail(path: Path, size: int = 4096) -> str:
+    """
+    The last `size` bytes of a log file, for error messages
+    """
+    try:
+        with open(path, "rb") as f:
+            f.seek(max(0, f.seek(0, os.SEEK_END) - size))
+            return f.read().decode(errors="replace")
+    except OSError:
+        return ""
+
+
+def remove_logs(*paths: Path):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass